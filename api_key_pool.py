@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import httpx
+
+from session_store import SessionStore
+
+if TYPE_CHECKING:
+    # google.genai は読み込みに時間がかかるので、最初のクライアントを作るときに読み込む
+    from google import genai
+
+logger = logging.getLogger(__name__)
+
+
+class ApiKey:
+    def __init__(self, index: int, key: str):
+        self.index = index
+        self.key = key
+        self.client: "genai.Client | None" = None
+        self.exhausted_until = 0.0  # 429 (クォータ枯渇) による休止期限
+        self.busy_until = 0.0  # 503 (高負荷) による休止期限
+        self.last_used = 0.0
+        # 統計情報
+        self.requests = 0
+        self.exhausted_count = 0
+        self.busy_count = 0
+        self.warm_up_seconds: float | None = None
+
+    def is_exhausted(self, now: float) -> bool:
+        return self.exhausted_until > now
+
+    def is_busy(self, now: float) -> bool:
+        return self.busy_until > now
+
+
+class ApiKeyPool:
+    """
+    APIキーごとのクライアントと状態を保持するプール。
+
+    429 や 503 を受けたキーは一定時間休ませ、
+    新しく割り当てるときは休んでいないキーの中から最も長く使われていないものを選びます。
+    クライアントは作り直さずに使い続け、HTTP接続も長めに保持して再利用します。
+    store を指定すると休止期限をほかのプロセスと共有し、health_refresh_seconds 秒ごとに読み込み直します。
+    """
+
+    def __init__(
+        self,
+        keys: list[str],
+        exhausted_cooldown: float = 60.0,
+        busy_cooldown: float = 5.0,
+        keepalive_expiry: float = 120.0,
+        max_connections: int = 10,
+        store: SessionStore | None = None,
+        health_refresh_seconds: float = 1.0,
+    ):
+        self.keys = [ApiKey(i, key) for i, key in enumerate(keys)]
+        self.exhausted_cooldown = exhausted_cooldown
+        self.busy_cooldown = busy_cooldown
+        self.keepalive_expiry = keepalive_expiry
+        self.max_connections = max_connections
+        self.clients_created = 0
+        # prewarm はスレッドで、get_client はイベントループで呼ばれるので、同じキーのクライアントを二重に作らないようにする
+        self.client_lock = threading.Lock()
+        self.store = store
+        self.health_refresh_seconds = health_refresh_seconds
+        self.health_loaded_at: float | None = None
+
+    @classmethod
+    def from_config(cls, conf_g: dict[str, any], store: SessionStore | None = None) -> "ApiKeyPool":
+        return cls(
+            conf_g["geminiApiKey"],
+            exhausted_cooldown=conf_g.get("keyExhaustedCooldownSeconds", 60.0),
+            busy_cooldown=conf_g.get("keyBusyCooldownSeconds", 5.0),
+            keepalive_expiry=conf_g.get("httpKeepaliveSeconds", 120.0),
+            max_connections=conf_g.get("httpMaxConnections", 10),
+            store=store,
+        )
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def create_client(self, api_key: ApiKey) -> "genai.Client":
+        from google import genai
+        from google.genai import types
+
+        # httpx の既定では5秒で接続を閉じてしまうため、コメントの間隔より長く保持する
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        http_options = types.HttpOptions(async_client_args={"limits": limits})
+        self.clients_created += 1
+        return genai.Client(api_key=api_key.key, http_options=http_options)
+
+    def get_client(self, index: int) -> "genai.Client":
+        api_key = self.keys[index]
+        if api_key.client is None:
+            with self.client_lock:
+                if api_key.client is None:
+                    api_key.client = self.create_client(api_key)
+        return api_key.client
+
+    def prewarm(self) -> None:
+        """すべてのキーのクライアントを先に作っておく。"""
+        for api_key in self.keys:
+            if not api_key.key:
+                continue
+            try:
+                self.get_client(api_key.index)
+            except Exception as e:
+                logger.error(f"Failed to create client for API key #{api_key.index}: {e}")
+
+    async def warm_up(self, model: str) -> None:
+        """各キーで軽いリクエストを送り、TLS接続を確立しておく。"""
+        await asyncio.gather(*(self._warm_up(k, model) for k in self.keys if k.key))
+
+    async def _warm_up(self, api_key: ApiKey, model: str) -> None:
+        start = time.perf_counter()
+        try:
+            await self.get_client(api_key.index).aio.models.get(model=model)
+        except Exception as e:
+            logger.warning(f"Warm-up failed for API key #{api_key.index}: {e}")
+            return
+        api_key.warm_up_seconds = time.perf_counter() - start
+        logger.info(f"API key #{api_key.index} warmed up in {api_key.warm_up_seconds:.3f}s")
+
+    async def aclose(self) -> None:
+        for api_key in self.keys:
+            if api_key.client is None:
+                continue
+            try:
+                await api_key.client.aio.aclose()
+            except Exception as e:
+                logger.warning(f"Failed to close client for API key #{api_key.index}: {e}")
+            api_key.client = None
+
+    # genai.Client から httpx の接続プールまでたどる属性。公開されていないので、版によってはたどれない
+    CONNECTION_POOL_PATH = ("_api_client", "_async_httpx_client", "_transport", "_pool", "connections")
+
+    @classmethod
+    def count_connections(cls, client: "genai.Client | None") -> int | None:
+        """クライアントが保持しているHTTP接続数を返す。取得できない場合は None"""
+        obj = client
+        for name in cls.CONNECTION_POOL_PATH:
+            obj = getattr(obj, name, None)
+            if obj is None:
+                return None
+        try:
+            return len(obj)
+        except TypeError:
+            return None
+
+    def get_stats(self) -> dict[str, any]:
+        now = time.monotonic()
+        return {
+            "clientsCreated": self.clients_created,
+            "keys": [
+                {
+                    "index": k.index,
+                    "clientReady": k.client is not None,
+                    "connections": self.count_connections(k.client),
+                    "requests": k.requests,
+                    "exhaustedCount": k.exhausted_count,
+                    "busyCount": k.busy_count,
+                    "exhausted": k.is_exhausted(now),
+                    "busy": k.is_busy(now),
+                    "warmUpSeconds": k.warm_up_seconds,
+                }
+                for k in self.keys
+            ],
+        }
+
+    def acquire(self, preferred: int | None = None) -> ApiKey | None:
+        """
+        使用するキーを選ぶ。
+
+        Args:
+            preferred: 会話を引き継ぐために優先したいキーの番号
+
+        Returns:
+            選ばれたキー。すべてのキーがクォータ枯渇で休止中なら None
+        """
+        now = time.monotonic()
+        self.refresh_health(now)
+        candidates = [k for k in self.keys if not k.is_exhausted(now)]
+        if not candidates:
+            return None
+
+        api_key = next((k for k in candidates if k.index == preferred), None)
+        if api_key is None:
+            healthy = [k for k in candidates if not k.is_busy(now)] or candidates
+            api_key = min(healthy, key=lambda k: k.last_used)
+
+        api_key.last_used = now
+        api_key.requests += 1
+        return api_key
+
+    def mark_exhausted(self, index: int) -> None:
+        self.keys[index].exhausted_count += 1
+        self.keys[index].exhausted_until = time.monotonic() + self.exhausted_cooldown
+        self.save_health(self.keys[index])
+        logger.warning(f"API key #{index} is exhausted. Cooling down for {self.exhausted_cooldown}s.")
+
+    def mark_busy(self, index: int) -> None:
+        self.keys[index].busy_count += 1
+        self.keys[index].busy_until = time.monotonic() + self.busy_cooldown
+        self.save_health(self.keys[index])
+
+    def save_health(self, api_key: ApiKey) -> None:
+        if self.store is None:
+            return
+        # monotonic の時刻はプロセスごとに基準が違うので、time.time() の時刻にして保存する
+        offset = time.time() - time.monotonic()
+        self.store.save_key_health(api_key.index, api_key.exhausted_until + offset, api_key.busy_until + offset)
+
+    def refresh_health(self, now: float) -> None:
+        """ほかのプロセスが記録した休止期限を取り込む。"""
+        if self.store is None:
+            return
+        if self.health_loaded_at is not None and now - self.health_loaded_at < self.health_refresh_seconds:
+            return
+        self.health_loaded_at = now
+        offset = time.time() - now
+        for index, (exhausted_until, busy_until) in self.store.load_key_health().items():
+            if index >= len(self.keys):
+                continue
+            api_key = self.keys[index]
+            api_key.exhausted_until = max(api_key.exhausted_until, exhausted_until - offset)
+            api_key.busy_until = max(api_key.busy_until, busy_until - offset)
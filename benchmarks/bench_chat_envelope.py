@@ -0,0 +1,87 @@
+"""
+送信するメッセージの準備 (フィールドの整形と JSON への変換) の1メッセージあたりの処理時間を測るマイクロベンチマーク。
+
+以前の方法 (deepcopy して整形し、やり直しのたびに deepcopy と json.dumps をやり直す) と、
+ChatEnvelope で一度だけ組み立て、やり直しでは追加指示だけを足す方法を比べます。
+orjson が入っていれば、そちらのエンコーダーでも測ります。
+
+    python benchmarks/bench_chat_envelope.py
+"""
+import copy
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chat_envelope
+from chat_envelope import ChatEnvelope
+from dict_helper import remove_keys_by_value
+
+COMMENT = {
+    "dateTime": "2026-01-01T20:00:00.000000",
+    "id": "UCxxxxxxxxxxxxxxxxxxxxxx",
+    "displayName": "視聴者さん",
+    "nickname": "しちょうしゃ",
+    "content": "こんばんは！今日の配信も楽しみにしてました。何のゲームをやるんですか？",
+    "needsResponse": False,
+    "noisy": False,
+    "isFirst": False,
+    "isFirstOnStream": True,
+    "additionalRequests": ["<length>", "<additional>"],
+    "story": {"displayName": "視聴者たち", "content": "わこつ / 888 / こんばんは / 草 / 待ってた" * 5},
+}
+RETRY_REQUEST = "返答に`初コメ`という文章を含めないでください。"
+
+
+def get_viewer_status(json_data: dict[str, any]) -> str:
+    if json_data.get("isFirst", False):
+        return "newViewer"
+    if json_data.get("isFirstOnStream", False):
+        return "streamFirst"
+    return "regular"
+
+
+def prepare_before(json_data: dict[str, any], retries: int) -> None:
+    json_data_send = copy.deepcopy(json_data)
+    json_data_send["viewerStatus"] = get_viewer_status(json_data_send)
+    json_data_send.pop("isFirst", None)
+    json_data_send.pop("isFirstOnStream", None)
+    remove_keys_by_value(json_data_send, ["noisy"], False)
+    json.dumps(json_data_send, ensure_ascii=False, separators=(",", ":"))
+    for _ in range(retries):
+        json_data_retry = copy.deepcopy(json_data_send)
+        json_data_retry["additionalRequests"].append(RETRY_REQUEST)
+        json.dumps(json_data_retry, ensure_ascii=False, separators=(",", ":"))
+
+
+def prepare_after(json_data: dict[str, any], retries: int) -> None:
+    fields = {k: v for k, v in json_data.items() if k not in ("isFirst", "isFirstOnStream")}
+    fields["viewerStatus"] = get_viewer_status(json_data)
+    remove_keys_by_value(fields, ["noisy"], False)
+    envelope = ChatEnvelope(fields, tuple(fields.pop("additionalRequests", ())))
+    envelope.to_json()
+    for _ in range(retries):
+        envelope.with_request(RETRY_REQUEST).to_json()
+
+
+def measure(func, retries: int, number: int) -> float:
+    seconds = min(timeit.repeat(lambda: func(COMMENT, retries), number=number, repeat=5))
+    return seconds / number * 1_000_000
+
+
+def main(number: int = 20_000) -> None:
+    encoders = ["json"] + (["orjson"] if chat_envelope.orjson is not None else [])
+    print(f"{'retries':<8} {'before µs':>10} " + " ".join(f"{'after(' + e + ') µs':>18}" for e in encoders))
+    for retries in (0, 1, 3):
+        before = measure(prepare_before, retries, number)
+        afters = []
+        for encoder in encoders:
+            chat_envelope.set_encoder(encoder)
+            afters.append(measure(prepare_after, retries, number))
+        print(f"{retries:<8} {before:>10.2f} " + " ".join(f"{after:>18.2f}" for after in afters))
+
+
+if __name__ == "__main__":
+    main()
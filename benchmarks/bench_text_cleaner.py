@@ -0,0 +1,40 @@
+"""
+clean_and_extract_alt の1コメントあたりの処理時間を測るマイクロベンチマーク。
+
+毎秒1万コメントを処理するときの1コメントあたりの予算(100µs)に対する割合も表示します。
+
+    python benchmarks/bench_text_cleaner.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_cleaner import clean_and_extract_alt
+
+COMMENTS_PER_SECOND = 10_000
+BUDGET_US = 1_000_000 / COMMENTS_PER_SECOND
+
+SAMPLES = {
+    "plain": "こんにちは！今日の配信も楽しみにしてました",
+    "entities": "Q&amp;A コーナーまだですか？ &lt;3",
+    "onecomme": '草<img src="https://example.com/emoji/1f602.svg" alt="😂" class="emoji">'
+    '<img src="https://example.com/emoji/1f602.svg" alt="😂" class="emoji">',
+    "youtube": 'わこつ<img class="emoji" src="https://yt3.ggpht.com/a" alt=":face-blue-smiling:" '
+    'shared-tooltip-text=":face-blue-smiling:"><img class="emoji" src="https://yt3.ggpht.com/b" '
+    'alt=":hand-pink-waving:" shared-tooltip-text=":hand-pink-waving:">',
+    "markup": '<b>重要:</b> <a href="#">詳細</a><img src="x" alt="👍"/>を確認。',
+}
+
+
+def main(number: int = 100_000) -> None:
+    print(f"{'sample':<10} {'µs/comment':>12} {'budget':>8}")
+    for name, text in SAMPLES.items():
+        seconds = min(timeit.repeat(lambda: clean_and_extract_alt(text), number=number, repeat=5))
+        us = seconds / number * 1_000_000
+        print(f"{name:<10} {us:>12.3f} {us / BUDGET_US:>7.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+main.create_app() で作ったアプリのエンドツーエンドの負荷試験。
+
+Gemini Interactions API の代わりに遅延とエラー(429/503/404)を注入できる偽のクライアントを使い、
+ローカルで起動したサーバーへ多数の視聴者から HTTP と WebSocket でコメントを送ります。
+経路ごとの p50/p99 レイテンシ、スループット、API 呼び出し数を表示します。
+
+    python benchmarks/load_test.py --viewers 200 --comments 5 --latency 0.2 --rate-503 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# main.py は起動スクリプトの場所を基準に設定やプロンプトを読むため、リポジトリ直下から起動したことにする
+sys.argv[0] = os.path.join(ROOT, "main.py")
+
+import httpx
+import uvicorn
+import websockets
+from fastapi import FastAPI
+from google.genai import errors
+
+import main
+from api_key_pool import ApiKeyPool
+from config_helper import read_config
+from genai_interactions import GenAIInteractions
+
+COMMENTS = ["こんにちは", "草", "888", "初見です", "今日は何するの？", "かわいい", "おつかれさま"]
+
+
+class FakeStream:
+    """interactions.create(stream=True) が返すイベント列の代わり。"""
+
+    def __init__(self, interaction_id: str, text: str, chunk_size: int = 8):
+        interaction = SimpleNamespace(id=interaction_id)
+        self.events = [SimpleNamespace(event_type="interaction.created", interaction=interaction)]
+        for i in range(0, len(text), chunk_size):
+            delta = SimpleNamespace(type="text", text=text[i : i + chunk_size])
+            self.events.append(SimpleNamespace(event_type="step.delta", delta=delta))
+        self.events.append(SimpleNamespace(event_type="interaction.completed", interaction=interaction))
+        self.closed = False
+
+    async def __aiter__(self):
+        for event in self.events:
+            if self.closed:
+                return
+            yield event
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeInteractions:
+    """遅延とエラーを注入できる client.aio.interactions の代わり。"""
+
+    def __init__(self, latency: float, jitter: float, error_rates: dict[int, float], seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rates = error_rates
+        self.random = random.Random(seed)
+        self.calls: Counter[str] = Counter()
+
+    async def create(self, stream: bool = False, **params):
+        await asyncio.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+
+        r = self.random.random()
+        for code, rate in self.error_rates.items():
+            if code == 404 and not params.get("previous_interaction_id"):
+                continue
+            if r < rate:
+                self.calls[str(code)] += 1
+                raise errors.APIError(code=code, response_json={"error": {"message": "injected", "code": code}})
+            r -= rate
+
+        self.calls["ok"] += 1
+        interaction_id = f"fake-{sum(self.calls.values())}"
+        comment_ids = re.findall(r'"commentId":"(\d+)"', params["input"])
+        if comment_ids:
+            # まとめて送られたコメントには commentId ごとの返答を返す
+            text = json.dumps({i: f"コメント{i}ありがとう！" for i in comment_ids}, ensure_ascii=False)
+        else:
+            text = "コメントありがとう！ゆっくりしていってね。"
+        if stream:
+            return FakeStream(interaction_id, text)
+        return SimpleNamespace(id=interaction_id, output_text=text)
+
+
+@dataclass
+class PathStats:
+    latencies: list[float] = field(default_factory=list)
+    outcomes: Counter[str] = field(default_factory=Counter)
+    elapsed: float = 0.0
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
+
+
+def make_comment(viewer: int, seq: int) -> dict[str, any]:
+    return {
+        "id": f"viewer-{viewer}",
+        "displayName": f"視聴者{viewer}",
+        "nickname": f"視聴者{viewer}",
+        "content": f"{random.choice(COMMENTS)} #{viewer}-{seq}",
+        "isFirst": seq == 0,
+    }
+
+
+async def run_http_viewer(client: httpx.AsyncClient, viewer: int, comments: int, stats: PathStats) -> None:
+    for seq in range(comments):
+        start = time.perf_counter()
+        try:
+            response = await client.post(f"/chat/viewer-{viewer}", json=make_comment(viewer, seq))
+        except httpx.HTTPError:
+            stats.outcomes["transport_error"] += 1
+            continue
+        if response.status_code != 200:
+            stats.outcomes[f"http_{response.status_code}"] += 1
+            continue
+        error_code = response.json().get("errorCode")
+        stats.outcomes["ok" if error_code is None else f"error_{error_code}"] += 1
+        stats.latencies.append(time.perf_counter() - start)
+
+
+async def run_ws_viewer(url: str, viewer: int, comments: int, timeout: float, stats: PathStats) -> None:
+    async with websockets.connect(f"{url}/chat/viewer-{viewer}", max_queue=None) as ws:
+        for seq in range(comments):
+            comment = make_comment(viewer, seq)
+            start = time.perf_counter()
+            await ws.send(json.dumps(comment, ensure_ascii=False))
+            outcome = await wait_ws_reply(ws, comment["content"], timeout)
+            stats.outcomes[outcome] += 1
+            if outcome == "ok":
+                stats.latencies.append(time.perf_counter() - start)
+
+
+async def wait_ws_reply(ws, content: str, timeout: float) -> str:
+    """全員に届くフレームの中から、自分のコメントへの返答を待つ。"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return "timeout"
+        try:
+            frame = json.loads(await asyncio.wait_for(ws.recv(), remaining))
+        except asyncio.TimeoutError:
+            return "timeout"
+        if frame.get("request", {}).get("content") != content:
+            continue
+        if "response" in frame:
+            return "ok" if frame.get("errorCode") is None else f"error_{frame['errorCode']}"
+        if frame.get("errorCode") is not None:
+            return f"rejected_{frame['errorCode']}"
+
+
+def setup_app(args: argparse.Namespace) -> tuple[FakeInteractions, FastAPI]:
+    fake = FakeInteractions(
+        args.latency,
+        args.jitter,
+        {404: args.rate_404, 429: args.rate_429, 503: args.rate_503},
+        args.seed,
+    )
+    fake_client = SimpleNamespace(aio=SimpleNamespace(interactions=fake))
+
+    keys = [f"fake-key-{i}" for i in range(args.keys)]
+    pool = ApiKeyPool(keys, exhausted_cooldown=args.key_cooldown, busy_cooldown=args.key_cooldown)
+    pool.get_client = lambda index: fake_client
+    config = read_config()
+    config["google"]["geminiApiKey"] = keys
+    config["google"]["warmUp"] = False
+    config["fuyukaApi"]["queueSize"] = args.queue_size
+
+    # 本番の会話履歴を上書きしないよう、履歴ファイルは一時ディレクトリに書く
+    tmp_dir = tempfile.mkdtemp(prefix="fuyuka_load_test_")
+    for name in ("FILENAME_INTERACTION_ID", "FILENAME_API_KEY_INDEX", "FILENAME_CHAT_HISTORY"):
+        path = os.path.join(tmp_dir, os.path.basename(getattr(GenAIInteractions, name)))
+        setattr(GenAIInteractions, name, path)
+    return fake, main.create_app(config, key_pool=pool)
+
+
+def print_report(name: str, stats: PathStats) -> None:
+    total = sum(stats.outcomes.values())
+    ok = stats.outcomes["ok"]
+    throughput = ok / stats.elapsed if stats.elapsed else 0.0
+    print(f"[{name}] {total} comments in {stats.elapsed:.2f}s, {throughput:.1f} replies/s")
+    print(f"  p50 {percentile(stats.latencies, 50) * 1000:.1f} ms  p99 {percentile(stats.latencies, 99) * 1000:.1f} ms")
+    print(f"  outcomes: {dict(sorted(stats.outcomes.items()))}")
+
+
+async def run(args: argparse.Namespace) -> None:
+    fake, app = setup_app(args)
+    config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", ws_max_queue=1024)
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    try:
+        if args.mode in ("http", "both"):
+            stats = PathStats()
+            limits = httpx.Limits(max_connections=args.viewers)
+            timeout = httpx.Timeout(args.timeout)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=timeout) as client:
+                start = time.perf_counter()
+                await asyncio.gather(*(run_http_viewer(client, v, args.comments, stats) for v in range(args.viewers)))
+                stats.elapsed = time.perf_counter() - start
+            print_report("HTTP", stats)
+
+        if args.mode in ("ws", "both"):
+            stats = PathStats()
+            start = time.perf_counter()
+            await asyncio.gather(
+                *(run_ws_viewer(f"ws://127.0.0.1:{port}", v, args.comments, args.timeout, stats) for v in range(args.viewers))
+            )
+            stats.elapsed = time.perf_counter() - start
+            print_report("WebSocket", stats)
+
+        print(f"[API] calls: {dict(sorted(fake.calls.items()))}")
+    finally:
+        server.should_exit = True
+        await server_task
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("http", "ws", "both"), default="both")
+    parser.add_argument("--viewers", type=int, default=200, help="同時に送る視聴者の数")
+    parser.add_argument("--comments", type=int, default=5, help="視聴者ごとのコメント数")
+    parser.add_argument("--latency", type=float, default=0.2, help="偽APIの平均応答時間(秒)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="応答時間のゆらぎ(秒)")
+    parser.add_argument("--rate-404", type=float, default=0.0, help="404 を返す割合")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="429 を返す割合")
+    parser.add_argument("--rate-503", type=float, default=0.0, help="503 を返す割合")
+    parser.add_argument("--keys", type=int, default=3, help="APIキーの数")
+    parser.add_argument("--key-cooldown", type=float, default=1.0, help="429/503 を受けたキーを休ませる秒数")
+    parser.add_argument("--queue-size", type=int, default=256, help="返答待ちにできるコメント数の上限")
+    parser.add_argument("--timeout", type=float, default=120.0, help="1コメントの返答を待つ秒数")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import re
+import time
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    # genai_interactions は読み込み時に g.app_name を使うため、型の確認のときだけ読み込む
+    from connection_manager import ConnectionManager
+    from genai_interactions import GenAIInteractions
+    from ng_word_matcher import NgWordMatcher
+    from reply_cache import ReplyCache
+    from request_queue import RequestQueue
+    from story_buffer import StoryBuffer
+
+logger = logging.getLogger(__name__)
+
+# ファイル名にも使うので、パスとして安全な文字だけを許可する
+CHANNEL_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class ChannelLimitError(Exception):
+    """チャンネル数が上限に達していて、新しいチャンネルを作れない場合に送出されます。"""
+
+
+class ChannelSession:
+    """
+    1つの配信(チャンネル)の会話の状態。
+
+    会話の連鎖・履歴・流れのバッファ・NGワード・返答キャッシュ・待ち行列・接続中のクライアントを
+    チャンネルごとに分けて持ちます。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        genai_chat: "GenAIInteractions",
+        story_buffer: "StoryBuffer",
+        ng_word_matcher: "NgWordMatcher",
+        reply_cache: "ReplyCache",
+        request_queue: "RequestQueue",
+        manager: "ConnectionManager",
+        ready: asyncio.Event | None = None,
+    ):
+        self.name = name
+        self.genai_chat = genai_chat
+        self.story_buffer = story_buffer
+        self.ng_word_matcher = ng_word_matcher
+        self.reply_cache = reply_cache
+        self.request_queue = request_queue
+        self.manager = manager
+        # 履歴を読み込み終わったら立つ。読み込み前の履歴に続けて話さないよう、返答の前に待つ
+        if ready is None:
+            ready = asyncio.Event()
+            ready.set()
+        self.ready = ready
+        # 要約などのバックグラウンドタスク
+        self.tasks: list[asyncio.Task] = []
+
+    def is_idle(self) -> bool:
+        """接続中のクライアントも、処理待ちのリクエストも、要約を待つコメントもなければ True"""
+        return not len(self.manager) and self.request_queue.is_idle() and not len(self.story_buffer)
+
+    async def aclose(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await self.request_queue.stop()
+        await self.manager.aclose()
+        # 書き込み待ちの履歴をファイルに反映してから手放す
+        await asyncio.to_thread(self.genai_chat.flush_chat_history)
+
+
+class ChannelRegistry:
+    """
+    チャンネル名から ChannelSession を引く。
+
+    初めて使われたチャンネルの ChannelSession は factory で作ります。
+    APIキーのプールなど factory の外で作ったものは、すべてのチャンネルで共有されます。
+
+    idle_seconds 秒使われず、クライアントも処理待ちもないチャンネルは閉じます (evict_idle)。
+    上限に達したときも、まず使われていないチャンネルを閉じて空きを作ります。
+    閉じたチャンネルも、次に使われたときは保存した履歴から作り直します。
+    """
+
+    def __init__(self, factory: Callable[[str], ChannelSession], max_channels: int = 32, idle_seconds: float = 600.0):
+        self.factory = factory
+        # 0 以下なら無制限
+        self.max_channels = max_channels
+        # 0 以下なら閉じない
+        self.idle_seconds = idle_seconds
+        self.sessions: dict[str, ChannelSession] = {}
+        self.last_used: dict[str, float] = {}
+        # 使われずに閉じたチャンネル。作り直すときは保存した履歴から続ける
+        self.evicted: set[str] = set()
+        # 閉じている途中のチャンネルの aclose (履歴の書き出しを含む)
+        self.closing_tasks: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sessions
+
+    @staticmethod
+    def is_valid_name(name: str) -> bool:
+        return CHANNEL_NAME_PATTERN.fullmatch(name) is not None
+
+    def get(self, name: str) -> ChannelSession:
+        """
+        チャンネルの ChannelSession を返す。なければ作る。
+
+        Raises:
+            ValueError: チャンネル名に使えない文字が含まれている場合
+            ChannelLimitError: チャンネル数が上限に達している場合
+        """
+        session = self.sessions.get(name)
+        if session is not None:
+            self.last_used[name] = time.monotonic()
+            return session
+        if not self.is_valid_name(name):
+            raise ValueError(f"Invalid channel name: {name!r}")
+        if 0 < self.max_channels <= len(self.sessions):
+            for idle_name, idle_session in self.pop_idle():
+                self._close_later(idle_name, idle_session)
+        if 0 < self.max_channels <= len(self.sessions):
+            raise ChannelLimitError(f"Too many channels ({len(self.sessions)}/{self.max_channels})")
+        session = self.sessions[name] = self.factory(name)
+        self.last_used[name] = time.monotonic()
+        logger.info(f"Channel {name} opened")
+        return session
+
+    def pop_idle(self, now: float | None = None) -> list[tuple[str, ChannelSession]]:
+        """idle_seconds 秒使われていない、何もしていないチャンネルを取り除いて返す。閉じるのは呼び出し元"""
+        if self.idle_seconds <= 0:
+            return []
+        now = time.monotonic() if now is None else now
+        idle = [
+            name
+            for name, session in self.sessions.items()
+            if now - self.last_used.get(name, now) >= self.idle_seconds and session.is_idle()
+        ]
+        for name in idle:
+            self.last_used.pop(name, None)
+            self.evicted.add(name)
+            logger.info(f"Channel {name} closed after being idle")
+        return [(name, self.sessions.pop(name)) for name in idle]
+
+    async def evict_idle(self, now: float | None = None) -> int:
+        """使われていないチャンネルを閉じる。閉じた数を返す"""
+        tasks = [self._close_later(name, session) for name, session in self.pop_idle(now)]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return len(tasks)
+
+    def _close_later(self, name: str, session: ChannelSession) -> asyncio.Task:
+        # 閉じ終わる前に同じチャンネルが作り直されたら、wait_closed で履歴の書き出しを待たせる
+        task = asyncio.get_running_loop().create_task(session.aclose())
+        self.closing_tasks[name] = task
+
+        def discard(_: asyncio.Task) -> None:
+            if self.closing_tasks.get(name) is task:
+                del self.closing_tasks[name]
+
+        task.add_done_callback(discard)
+        return task
+
+    async def wait_closed(self, name: str) -> None:
+        """閉じている途中の同じ名前のチャンネルがあれば、閉じ終わるまで待つ"""
+        task = self.closing_tasks.get(name)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def aclose(self) -> None:
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        self.last_used.clear()
+        for session in sessions:
+            await session.aclose()
+        await asyncio.gather(*self.closing_tasks.values(), return_exceptions=True)
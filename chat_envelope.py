@@ -0,0 +1,129 @@
+import json
+import logging
+from collections.abc import Iterator, Mapping
+from types import MappingProxyType
+from typing import Callable
+
+try:
+    # 入っていれば JSON への変換に使う (任意)
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+ADDITIONAL_REQUESTS = "additionalRequests"
+
+
+def dumps_json(obj: any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def dumps_orjson(obj: any) -> str:
+    try:
+        return orjson.dumps(obj).decode("utf-8")
+    except TypeError:
+        # orjson が扱えない値 (文字列以外のキーなど) は標準の json に任せる
+        return dumps_json(obj)
+
+
+_encoder: Callable[[any], str] = dumps_json
+
+
+def set_encoder(name: str = "auto") -> str:
+    """
+    JSON への変換に使うエンコーダーを選ぶ。
+
+    "auto" なら orjson が入っていればそれを、なければ標準の json を使います。
+
+    Returns:
+        選ばれたエンコーダーの名前
+    """
+    global _encoder
+    if name in ("auto", "orjson") and orjson is not None:
+        _encoder = dumps_orjson
+        return "orjson"
+    if name == "orjson":
+        logger.warning("orjson is not installed. Falling back to json.")
+    _encoder = dumps_json
+    return "json"
+
+
+def dumps(obj: any) -> str:
+    """送信するメッセージと同じ形式 (区切りの空白なし、ASCII に変換しない) の JSON にする。"""
+    return _encoder(obj)
+
+
+class ChatEnvelope(Mapping):
+    """
+    モデルへ送る1件のメッセージ。
+
+    作った後は変更できず、JSON にした結果を覚えておきます。
+    NGワードのやり直しで追加指示を足すときは with_request で新しい ChatEnvelope を作り、
+    変わらないフィールドとその JSON は元のものを共有します。
+    """
+
+    __slots__ = ("_fields", "additional_requests", "_fields_json", "_json")
+
+    def __init__(
+        self,
+        fields: dict[str, any],
+        additional_requests: tuple[str, ...] = (),
+        _fields_json: str | None = None,
+    ):
+        # fields はコピーせずに持つので、渡した後に変更しないこと
+        object.__setattr__(self, "_fields", fields)
+        object.__setattr__(self, "additional_requests", tuple(additional_requests))
+        object.__setattr__(self, "_fields_json", _fields_json)
+        object.__setattr__(self, "_json", None)
+
+    @classmethod
+    def from_dict(cls, json_data: dict[str, any]) -> "ChatEnvelope":
+        fields = dict(json_data)
+        return cls(fields, fields.pop(ADDITIONAL_REQUESTS, None) or ())
+
+    def __setattr__(self, name: str, value: any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, key: str) -> any:
+        if key == ADDITIONAL_REQUESTS and self.additional_requests:
+            return list(self.additional_requests)
+        return self._fields[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._fields
+        if self.additional_requests:
+            yield ADDITIONAL_REQUESTS
+
+    def __len__(self) -> int:
+        return len(self._fields) + (1 if self.additional_requests else 0)
+
+    def __repr__(self) -> str:
+        return f"ChatEnvelope({self.to_json()})"
+
+    @property
+    def fields(self) -> Mapping[str, any]:
+        return MappingProxyType(self._fields)
+
+    def with_request(self, request: str) -> "ChatEnvelope":
+        """追加指示を1つ足した ChatEnvelope を返す。フィールドとその JSON は共有する。"""
+        return ChatEnvelope(self._fields, (*self.additional_requests, request), self.fields_json())
+
+    def fields_json(self) -> str:
+        if self._fields_json is None:
+            object.__setattr__(self, "_fields_json", dumps(self._fields))
+        return self._fields_json
+
+    def to_json(self) -> str:
+        if self._json is None:
+            json_str = self.fields_json()
+            if self.additional_requests:
+                # フィールドの JSON の閉じ括弧の前に、追加指示だけを書き足す
+                separator = "," if self._fields else ""
+                requests_json = dumps(self.additional_requests)
+                json_str = f'{json_str[:-1]}{separator}"{ADDITIONAL_REQUESTS}":{requests_json}}}'
+            object.__setattr__(self, "_json", json_str)
+        return self._json
@@ -0,0 +1,84 @@
+import collections
+from typing import Iterable, Iterator
+
+
+class ChatHistory:
+    """
+    (role, text) の会話履歴。
+
+    コンテキスト埋め込み用に整形済みの行も一緒に保持しておき、
+    古いものから1往復(user+model)単位で先頭から捨てます。
+    """
+
+    def __init__(self, records: Iterable[tuple[str, str]] = ()):
+        self.entries: collections.deque[tuple[str, str]] = collections.deque()
+        self.lines: collections.deque[str] = collections.deque()
+        self.chars = 0  # 整形済みの行の合計文字数
+        self.rendered: str | None = None
+        self.extend(records)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        return iter(self.entries)
+
+    def __getitem__(self, index: int) -> tuple[str, str]:
+        return self.entries[index]
+
+    @staticmethod
+    def format_line(role: str, text: str) -> str:
+        label = "ユーザー" if role == "user" else "アシスタント"
+        return f"{label}: {text}"
+
+    def append(self, role: str, text: str) -> None:
+        line = self.format_line(role, text)
+        self.entries.append((role, text))
+        self.lines.append(line)
+        self.chars += len(line)
+        self.rendered = None
+
+    def extend(self, records: Iterable[tuple[str, str]]) -> None:
+        for role, text in records:
+            self.append(role, text)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.lines.clear()
+        self.chars = 0
+        self.rendered = None
+
+    def popleft(self) -> tuple[str, str]:
+        line = self.lines.popleft()
+        self.chars -= len(line)
+        self.rendered = None
+        return self.entries.popleft()
+
+    def trim(self, max_length: int, max_chars: int = 0) -> int:
+        """
+        件数と文字数の上限に収まるまで古い履歴を削除する。
+
+        Args:
+            max_length: 保持するエントリ数の上限
+            max_chars: 整形後の合計文字数の上限 (0 以下なら無制限)
+
+        Returns:
+            削除したエントリ数
+        """
+        removed = 0
+        while self.entries and (
+            len(self.entries) > max_length or (max_chars > 0 and self.chars > max_chars)
+        ):
+            # 1往復 = user+model の2エントリ
+            self.popleft()
+            removed += 1
+            if self.entries and self.entries[0][0] != "user":
+                self.popleft()
+                removed += 1
+        return removed
+
+    def render(self) -> str:
+        """整形済みの履歴を改行区切りで返す。変更がなければ前回の結果を使い回す。"""
+        if self.rendered is None:
+            self.rendered = "\n".join(self.lines)
+        return self.rendered
@@ -12,15 +12,21 @@ def write_json(data: any, path: str):
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
 
-def read_config(name: str = "config.json"):
+def resolve_config_path(name: str = "config.json") -> str | None:
     if not os.path.isabs(name):
         name = os.path.join(g.base_dir, name)
     if not os.path.isfile(name):
         # 無いならひな形を参照
         name += ".template"
         if not os.path.isfile(name):
-            return {}
-    return read_json(name)
+            return None
+    return name
+
+def read_config(name: str = "config.json"):
+    path = resolve_config_path(name)
+    if not path:
+        return {}
+    return read_json(path)
 
 def write_config(data: any, name: str = "config.json"):
     if not os.path.isabs(name):
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+from typing import Callable
+
+from fastapi import WebSocket
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_SECONDS = Histogram(
+    "fuyuka_broadcast_seconds",
+    "Time to serialize one message and queue it for every WebSocket client.",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1),
+)
+SEND_SECONDS = Histogram(
+    "fuyuka_websocket_send_seconds",
+    "Time to send one queued message to one WebSocket client.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+BROADCAST_FAILURES = Counter("fuyuka_broadcast_failures_total", "WebSocket clients dropped because a send failed.")
+SLOW_CLIENT_EVENTS = Counter(
+    "fuyuka_slow_client_events_total",
+    "Messages dropped or clients disconnected because a client's send queue was full, by policy.",
+    ("policy",),
+)
+
+# 送信待ちがあふれたときの扱い
+SLOW_CLIENT_DROP = "drop"  # 古いメッセージから捨てる
+SLOW_CLIENT_DISCONNECT = "disconnect"  # 接続を切る
+
+
+class ClientConnection:
+    """1つの WebSocket と、その送信待ちの待ち行列・送信タスク。"""
+
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue[str] = asyncio.Queue(queue_size)
+        self.writer_task: asyncio.Task | None = None
+        self.dropped = 0
+
+
+class ConnectionManager:
+    """
+    接続中の WebSocket クライアントへの送信をまとめて扱う。
+
+    送るメッセージは1回だけ JSON にして、クライアントごとの上限付きの待ち行列に積みます。
+    実際の送信はクライアントごとの送信タスクが行うので、遅いクライアントや応答のない相手がいても
+    ほかのクライアントや呼び出し元は待たされません。
+    待ち行列があふれたクライアントは slow_client_policy に従って古いメッセージを捨てるか切断します。
+
+    relay を指定すると、broadcast したメッセージをそれにも渡します (ほかのワーカーのクライアントへの中継)。
+    中継されてきたメッセージは broadcast_local で、このプロセスのクライアントにだけ送ります。
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 64,
+        slow_client_policy: str = SLOW_CLIENT_DROP,
+        relay: Callable[[str], None] | None = None,
+    ):
+        self.queue_size = queue_size
+        self.slow_client_policy = slow_client_policy
+        self.relay = relay
+        self.connections: dict[WebSocket, ClientConnection] = {}
+        self.closing_tasks: set[asyncio.Task] = set()
+
+    @property
+    def active_connections(self) -> list[WebSocket]:
+        return list(self.connections)
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        client = ClientConnection(websocket, self.queue_size)
+        client.writer_task = asyncio.create_task(self._write(client))
+        self.connections[websocket] = client
+
+    def disconnect(self, websocket: WebSocket):
+        # すでに削除されている場合も何もしない
+        client = self.connections.pop(websocket, None)
+        if client is None:
+            return
+        if client.writer_task is not None and client.writer_task is not asyncio.current_task():
+            client.writer_task.cancel()
+
+    @staticmethod
+    def dumps(json_data: dict[str, any]) -> str:
+        # WebSocket.send_json と同じ形式
+        return json.dumps(json_data, ensure_ascii=False, separators=(",", ":"))
+
+    async def send_personal_message(self, message: str, websocket: WebSocket):
+        client = self.connections.get(websocket)
+        if client is None:
+            await websocket.send_text(message)
+            return
+        # ブロードキャストと順番が入れ替わらないよう同じ待ち行列に積む
+        self._enqueue(client, message)
+
+    async def broadcast(self, message: str):
+        await self.broadcast_local(message)
+        if self.relay is not None:
+            self.relay(message)
+
+    async def broadcast_local(self, message: str):
+        with BROADCAST_SECONDS.time():
+            for client in list(self.connections.values()):
+                self._enqueue(client, message)
+
+    async def send_personal_json(self, json_data: dict[str, any], websocket: WebSocket):
+        await self.send_personal_message(self.dumps(json_data), websocket)
+
+    async def broadcast_json(self, json_data: dict[str, any]):
+        if not self.connections and self.relay is None:
+            return
+        await self.broadcast(self.dumps(json_data))
+
+    async def aclose(self) -> None:
+        tasks = [c.writer_task for c in self.connections.values() if c.writer_task is not None]
+        self.connections.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *self.closing_tasks, return_exceptions=True)
+
+    def _enqueue(self, client: ClientConnection, message: str) -> None:
+        try:
+            client.queue.put_nowait(message)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        SLOW_CLIENT_EVENTS.inc(self.slow_client_policy)
+        if self.slow_client_policy == SLOW_CLIENT_DISCONNECT:
+            logger.warning("Disconnecting a slow WebSocket client.")
+            self.disconnect(client.websocket)
+            task = asyncio.create_task(self._close(client.websocket))
+            self.closing_tasks.add(task)
+            task.add_done_callback(self.closing_tasks.discard)
+            return
+
+        client.queue.get_nowait()
+        client.dropped += 1
+        client.queue.put_nowait(message)
+
+    async def _write(self, client: ClientConnection) -> None:
+        while True:
+            message = await client.queue.get()
+            try:
+                with SEND_SECONDS.time():
+                    await client.websocket.send_text(message)
+            except Exception:
+                # 送信失敗した接続はここで除外
+                BROADCAST_FAILURES.inc()
+                self.disconnect(client.websocket)
+                return
+
+    @staticmethod
+    async def _close(websocket: WebSocket) -> None:
+        try:
+            await websocket.close(code=1008)
+        except Exception as e:
+            logger.debug("Failed to close a slow WebSocket client: %s", e)
@@ -2,12 +2,11 @@ import asyncio
 import json
 import logging
 import os
-import pickle
 import random
 
-from google import genai
 from google.genai import chats, errors
 from google.genai.types import (
+    Content,
     GenerateContentConfig,
     GenerateContentResponse,
     GoogleSearch,
@@ -18,13 +17,17 @@ from google.genai.types import (
 )
 
 import global_value as g
+from api_key_pool import ApiKeyPool
 from cache_helper import get_cache_filepath
+from history_journal import JournalWriter, migrate_pickle, read_lines
 
 logger = logging.getLogger(__name__)
 
 
 class GenAIChat:
-    FILENAME_CHAT_HISTORY = get_cache_filepath(f"{g.app_name}_gen_ai_chat_history.pkl")
+    FILENAME_CHAT_HISTORY = get_cache_filepath(f"{g.app_name}_gen_ai_chat_history.jsonl")
+    # 以前の版が pickle で保存していた履歴
+    FILENAME_LEGACY_CHAT_HISTORY = get_cache_filepath(f"{g.app_name}_gen_ai_chat_history.pkl")
     FILENAME_API_KEY_INDEX = get_cache_filepath(f"{g.app_name}_api_key_index.pkl")
 
     GENAI_SAFETY_SETTINGS = [
@@ -52,12 +55,18 @@ class GenAIChat:
 
     GOOGLE_SEARCH_TOOL = Tool(google_search=GoogleSearch())
 
-    def __init__(self):
+    # 履歴ファイルの書き込みはイベントループを止めないよう専用スレッドで行う
+    JOURNAL_WRITER = JournalWriter()
+
+    def __init__(self, key_pool: ApiKeyPool | None = None):
         self.last_error_code = None
+        self.key_pool = key_pool
         self.api_key_index = None
-        self.client = None
         self.chat_history = None
         self.genai_chat = None
+        self.saved_chat = None  # 最後に履歴を保存したときのチャットセッション
+        self.saved_length = 0  # saved_chat の履歴のうち保存済みの件数
+        self.journal_length = 0  # 履歴ファイルに書かれているレコード数
 
     @staticmethod
     def get_error_message(error_code: int) -> str:
@@ -81,33 +90,30 @@ class GenAIChat:
         with open(cls.FILENAME_API_KEY_INDEX, "w") as f:
             json.dump(index, f)
 
-    def get_api_key_index(self, inc_value: int = 0) -> int:
+    def get_key_pool(self) -> ApiKeyPool:
+        if self.key_pool is None:
+            self.key_pool = ApiKeyPool.from_config(g.config["google"])
+        return self.key_pool
+
+    def select_api_key(self) -> bool:
         if self.api_key_index is None:
             self.api_key_index = self.load_api_key_index()
 
-        i = self.api_key_index
-        i += inc_value
-        conf_g = g.config["google"]
-        # if 0 <= i and i < len(conf_g["geminiApiKey"]):
-        if 0 > i or i >= len(conf_g["geminiApiKey"]):
-            i = 0
-
-        if i != self.api_key_index:
-            self.save_api_key_index(i)
-
-        self.api_key_index = i
-        return self.api_key_index
-
-    def get_api_key(self) -> str:
-        i = self.get_api_key_index()
-        conf_g = g.config["google"]
-        return conf_g["geminiApiKey"][i]
+        api_key = self.get_key_pool().acquire(self.api_key_index)
+        if api_key is None:
+            return False
 
-    def get_client(self) -> genai.Client:
-        if self.client is None:
-            self.client = genai.Client(api_key=self.get_api_key())
+        if api_key.index != self.api_key_index:
+            # チャットセッションはクライアントに紐づくため作り直す
+            self.genai_chat = None
+            self.api_key_index = api_key.index
+            self.save_api_key_index(api_key.index)
+        return True
 
-        return self.client
+    def get_client(self):
+        if self.api_key_index is None:
+            self.select_api_key()
+        return self.get_key_pool().get_client(self.api_key_index)
 
     def get_chat(self) -> chats.AsyncChat:
         if self.genai_chat is None:
@@ -127,20 +133,53 @@ class GenAIChat:
         self.last_error_code = None
         self.chat_history = None
         self.genai_chat = None
+        self.saved_chat = None
+        self.saved_length = 0
+        self.journal_length = 0
+        self.JOURNAL_WRITER.remove(self.FILENAME_CHAT_HISTORY)
+
+    @staticmethod
+    def dump_content(content: Content) -> dict[str, any]:
+        return content.model_dump(mode="json", exclude_none=True)
 
     def load_chat_history(self) -> bool:
+        # 以前の版が pickle で保存した履歴があれば、SDK のクラスだけを許可して読み込み、ジャーナルに書き直す
+        migrate_pickle(
+            self.FILENAME_LEGACY_CHAT_HISTORY, self.FILENAME_CHAT_HISTORY, self.dump_content, ("google.genai.types",)
+        )
         if not os.path.isfile(self.FILENAME_CHAT_HISTORY):
             return False
-        with open(self.FILENAME_CHAT_HISTORY, "rb") as f:
-            self.chat_history = pickle.load(f)
-            self.genai_chat = None
-            return True
+        max_len = g.config["google"]["maxHistoryLength"]
+        self.chat_history = read_lines(self.FILENAME_CHAT_HISTORY, Content.model_validate, max_len + max_len % 2)
+        self.journal_length = len(self.chat_history)
+        self.genai_chat = None
+        return True
 
     def save_chat_history(self) -> None:
+        """増えた履歴を追記する。実際の書き込みはバックグラウンドで行われる。"""
         if not self.genai_chat:
             return
-        with open(self.FILENAME_CHAT_HISTORY, "wb") as f:
-            pickle.dump(self.get_chat()._curated_history, f)
+        curated_history = self.genai_chat._curated_history
+        max_len = g.config["google"]["maxHistoryLength"]
+        if self.saved_chat is not self.genai_chat or self.journal_length > max_len * 2:
+            # チャットセッションを作り直した後や、追記でファイルが大きくなったら全体を書き直す
+            self.JOURNAL_WRITER.compact_objects(
+                self.FILENAME_CHAT_HISTORY, [self.dump_content(c) for c in curated_history]
+            )
+            self.journal_length = len(curated_history)
+        else:
+            new_contents = curated_history[self.saved_length :]
+            if new_contents:
+                self.JOURNAL_WRITER.append_objects(
+                    self.FILENAME_CHAT_HISTORY, [self.dump_content(c) for c in new_contents]
+                )
+                self.journal_length += len(new_contents)
+        self.saved_chat = self.genai_chat
+        self.saved_length = len(curated_history)
+
+    def flush_chat_history(self) -> None:
+        """書き込み待ちの履歴がすべてファイルに反映されるまで待つ。"""
+        self.JOURNAL_WRITER.flush()
 
     def remove_old_history(self) -> None:
         if not self.genai_chat:
@@ -149,6 +188,8 @@ class GenAIChat:
         conf_g = g.config["google"]
         if len(curated_history) > conf_g["maxHistoryLength"]:
             del curated_history[0:2]  # del index 0,1
+            # 消したのは保存済みの古い履歴
+            self.saved_length = max(self.saved_length - 2, 0)
 
     async def generate_text(self, gcr: GenerateContentResponse, data: any) -> str:
         retry_count = 0  # 503用のリトライカウンタ
@@ -172,13 +213,14 @@ class GenAIChat:
                 match e.code:
                     case 429:
                         # トークン枯渇
-                        self.last_error_code = None
-                        self.get_api_key_index(1)
-                        self.client = None
-                        self.genai_chat = None
-                        continue
+                        self.get_key_pool().mark_exhausted(self.api_key_index)
+                        if self.select_api_key():
+                            self.last_error_code = None
+                            continue
+                        self.last_error_code = 429
                     case 503:
                         # 高需要（サーバー過負荷）
+                        self.get_key_pool().mark_busy(self.api_key_index)
                         if retry_count < max_retries:
                             # 指数バックオフの計算
                             # 2^0, 2^1, 2^2... と増やす (1s, 2s, 4s, 8s...)
@@ -2,30 +2,86 @@ import asyncio
 import json
 import logging
 import os
-import pickle
 import random
-
-from google import genai
+import time
+from typing import Awaitable, Callable
 
 import global_value as g
+from api_key_pool import ApiKeyPool
 from cache_helper import get_cache_filepath
+from chat_envelope import ChatEnvelope, dumps
+from chat_history import ChatHistory
+from history_journal import JournalWriter, migrate_pickle, read_journal
+from metrics import Counter, Histogram
+from session_store import SessionStore
 
 logger = logging.getLogger(__name__)
 
+MODEL_REQUEST_SECONDS = Histogram(
+    "fuyuka_model_request_seconds",
+    "Time spent in generate_text including retries, by outcome (ok or HTTP status code).",
+    ("outcome",),
+)
+MODEL_RETRIES = Counter(
+    "fuyuka_model_retryable_errors_total",
+    "Model requests that failed with a retryable status code (404, 429, 503).",
+    ("code",),
+)
+API_KEY_SWITCHES = Counter(
+    "fuyuka_api_key_switches_total",
+    "Times the conversation moved to another API key.",
+)
+
+
+# 期限までに返答できなかった場合の last_error_code
+TIMEOUT_ERROR_CODE = 504
+# ステータスコードの分からないエラーで返答できなかった場合の last_error_code
+UNKNOWN_ERROR_CODE = 500
+
+
+class StreamError(Exception):
+    """ストリーム中に error イベントを受け取った場合に送出されます。"""
+
+    def __init__(self, code: int | None, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class StreamInterruptedError(Exception):
+    """返答の一部を送った後にストリームが失敗した場合に送出されます。"""
+
 
 class GenAIInteractions:
     FILENAME_INTERACTION_ID = get_cache_filepath(f"{g.app_name}_interaction_id.txt")
     FILENAME_API_KEY_INDEX = get_cache_filepath(f"{g.app_name}_api_key_index.pkl")
-    FILENAME_CHAT_HISTORY = get_cache_filepath(f"{g.app_name}_gen_ai_interactions_history.pkl")
+    FILENAME_CHAT_HISTORY = get_cache_filepath(f"{g.app_name}_gen_ai_interactions_history.jsonl")
+
+    # 履歴ファイルの書き込みはイベントループを止めないよう専用スレッドで行う
+    JOURNAL_WRITER = JournalWriter()
 
     GOOGLE_SEARCH_TOOL = [{"type": "google_search"}]
 
-    def __init__(self):
+    def __init__(
+        self, key_pool: ApiKeyPool | None = None, channel: str | None = None, store: SessionStore | None = None
+    ):
+        if channel is not None:
+            # チャンネルごとに別のファイルへ保存する (None ならクラス属性のファイルを使う)
+            self.FILENAME_INTERACTION_ID = get_cache_filepath(f"{g.app_name}_{channel}_interaction_id.txt")
+            self.FILENAME_API_KEY_INDEX = get_cache_filepath(f"{g.app_name}_{channel}_api_key_index.pkl")
+            self.FILENAME_CHAT_HISTORY = get_cache_filepath(f"{g.app_name}_{channel}_gen_ai_interactions_history.jsonl")
+        self.channel = channel
+        # store を指定するとファイルの代わりにそちらへ保存し、ほかのプロセスと状態を共有する
+        self.store = store
+        self.store_channel = channel or "default"
+        self.store_version = 0  # 最後に読み書きしたときの store の version
         self.last_error_code = None
+        self.key_pool = key_pool
         self.api_key_index = None
-        self.client = None
         self.interaction_id = None
-        self.history: list[tuple[str, str]] = []  # (role, text) のリスト
+        self.history = ChatHistory()  # (role, text) の履歴
+        self.journal_length = 0  # 履歴ファイルに書かれているレコード数
+        # 履歴ファイルの中身が history と同じ会話のものか。読み込まずに始めたなら、前回の会話が残っている
+        self.journal_synced = False
 
     @staticmethod
     def get_error_message(error_code: int) -> str:
@@ -33,99 +89,167 @@ class GenAIInteractions:
             case 429:
                 # トークン枯渇
                 return g.RESOURCE_EXHAUSTED_MESSAGE
+            case 504:
+                # 返答が間に合わなかった
+                return g.TIMEOUT_MESSAGE
             case _:
                 return g.STOP_CANDIDATE_MESSAGE
 
-    @classmethod
-    def load_api_key_index(cls) -> int:
+    def load_api_key_index(self) -> int:
+        if self.store is not None:
+            return self.store.load(self.store_channel).api_key_index or 0
         i = 0
-        if os.path.isfile(cls.FILENAME_API_KEY_INDEX):
-            with open(cls.FILENAME_API_KEY_INDEX, "r") as f:
+        if os.path.isfile(self.FILENAME_API_KEY_INDEX):
+            with open(self.FILENAME_API_KEY_INDEX, "r") as f:
                 i = json.load(f)
         return i
 
-    @classmethod
-    def save_api_key_index(cls, index: int) -> int:
-        with open(cls.FILENAME_API_KEY_INDEX, "w") as f:
-            json.dump(index, f)
-
-    def get_api_key_index(self, inc_value: int = 0) -> int:
+    def save_api_key_index(self, index: int) -> None:
+        if self.store is not None:
+            self.store_version = self.store.save_api_key_index(self.store_channel, index)
+            return
+        self.JOURNAL_WRITER.write_text(self.FILENAME_API_KEY_INDEX, json.dumps(index))
+
+    def get_key_pool(self) -> ApiKeyPool:
+        if self.key_pool is None:
+            self.key_pool = ApiKeyPool.from_config(g.config["google"])
+        return self.key_pool
+
+    async def run_store(self, func: Callable, *args):
+        """store を読み書きする func(*args) を、イベントループを止めずに呼ぶ。"""
+        if self.store is None:
+            return func(*args)
+        return await self.store.run(func, *args)
+
+    async def select_api_key(self) -> bool:
+        """
+        使用するAPIキーを選ぶ。
+
+        Returns:
+            すべてのキーがクォータ枯渇で休止中なら False
+        """
         if self.api_key_index is None:
-            self.api_key_index = self.load_api_key_index()
-
-        i = self.api_key_index
-        i += inc_value
-        conf_g = g.config["google"]
-        # if 0 <= i and i < len(conf_g["geminiApiKey"]):
-        if 0 > i or i >= len(conf_g["geminiApiKey"]):
-            i = 0
-
-        if i != self.api_key_index:
-            self.save_api_key_index(i)
+            self.api_key_index = await self.run_store(self.load_api_key_index)
 
-        self.api_key_index = i
-        return self.api_key_index
-
-    def get_api_key(self) -> str:
-        i = self.get_api_key_index()
-        conf_g = g.config["google"]
-        return conf_g["geminiApiKey"][i]
+        api_key = self.get_key_pool().acquire(self.api_key_index)
+        if api_key is None:
+            return False
 
-    def get_client(self) -> genai.Client:
-        if self.client is None:
-            self.client = genai.Client(api_key=self.get_api_key())
+        if api_key.index != self.api_key_index:
+            API_KEY_SWITCHES.inc()
+            # interaction はキーごとに保存されるため、別のキーには引き継げない
+            if self.interaction_id:
+                self.interaction_id = None
+                await self.run_store(self.delete_interaction_id_file)
+            self.api_key_index = api_key.index
+            await self.run_store(self.save_api_key_index, api_key.index)
+        return True
 
-        return self.client
+    def get_client(self):
+        return self.get_key_pool().get_client(self.api_key_index)
 
     def reset_chat_history(self) -> None:
         self.last_error_code = None
         self.interaction_id = None
-        self.history = []
+        self.history.clear()
+        self.journal_length = 0
+        self.journal_synced = True
+        if self.store is not None:
+            self.store_version = self.store.clear(self.store_channel)
+            return
         for filepath in [self.FILENAME_INTERACTION_ID, self.FILENAME_CHAT_HISTORY]:
-            if os.path.isfile(filepath):
-                try:
-                    os.remove(filepath)
-                except Exception as e:
-                    logger.error(f"Failed to delete file {filepath}: {e}")
+            self.JOURNAL_WRITER.remove(filepath)
+
+    def delete_interaction_id_file(self) -> None:
+        if self.store is not None:
+            self.store_version = self.store.save_interaction_id(self.store_channel, None)
+            return
+        self.JOURNAL_WRITER.remove(self.FILENAME_INTERACTION_ID)
 
     def load_chat_history(self) -> bool:
+        if self.store is not None:
+            return self.load_from_store()
         loaded = False
         if os.path.isfile(self.FILENAME_INTERACTION_ID):
             with open(self.FILENAME_INTERACTION_ID, "r") as f:
                 self.interaction_id = f.read().strip()
                 loaded = True
-        if os.path.isfile(self.FILENAME_CHAT_HISTORY):
-            with open(self.FILENAME_CHAT_HISTORY, "rb") as f:
-                self.history = pickle.load(f)
+        # 以前の版が pickle で保存した履歴があれば、ジャーナルに書き直してから読む
+        legacy_path = os.path.splitext(self.FILENAME_CHAT_HISTORY)[0] + ".pkl"
+        migrate_pickle(legacy_path, self.FILENAME_CHAT_HISTORY, lambda record: {"role": record[0], "text": record[1]})
+        # 残すのは末尾の maxHistoryLength 件 (往復がずれないよう偶数に切り上げる) だけなので、その分だけ読む
+        max_len = g.config["google"]["maxHistoryLength"]
+        records = read_journal(self.FILENAME_CHAT_HISTORY, max_len + max_len % 2)
+        self.journal_length = len(records)
+        self.journal_synced = True
+        self.history = ChatHistory(records)
+        self.remove_old_history()
         return loaded
 
-    def save_chat_history(self, interaction_id: str) -> None:
+    def save_chat_history(self, interaction_id: str, records: list[tuple[str, str]] = ()) -> None:
+        """interaction_id と新しく増えた履歴を書き込む。実際の書き込みはバックグラウンドで行われる。"""
         self.interaction_id = interaction_id
-        with open(self.FILENAME_INTERACTION_ID, "w") as f:
-            f.write(interaction_id)
-        with open(self.FILENAME_CHAT_HISTORY, "wb") as f:
-            pickle.dump(self.history, f)
+        if self.store is not None:
+            # 別のプロセスがすぐに続きを処理できるよう、その場で書き込む
+            keep = g.config["google"]["maxHistoryLength"] * 2
+            self.store_version = self.store.save_history(self.store_channel, interaction_id, records, keep)
+            return
+        self.JOURNAL_WRITER.write_text(self.FILENAME_INTERACTION_ID, interaction_id)
+        if not self.journal_synced:
+            # 前回の会話を読み込まずに始めたので、追記せずに今の会話だけで書き直す
+            self.JOURNAL_WRITER.compact(self.FILENAME_CHAT_HISTORY, list(self.history))
+            self.journal_length = len(self.history)
+            self.journal_synced = True
+            return
+        if not records:
+            return
+
+        self.JOURNAL_WRITER.append(self.FILENAME_CHAT_HISTORY, records)
+        self.journal_length += len(records)
+        # 追記でファイルが履歴の上限の2倍を超えたら、現在の履歴だけで書き直す
+        max_len = g.config["google"]["maxHistoryLength"]
+        if self.journal_length > max_len * 2:
+            self.JOURNAL_WRITER.compact(self.FILENAME_CHAT_HISTORY, list(self.history))
+            self.journal_length = len(self.history)
+
+    def load_from_store(self) -> bool:
+        state = self.store.load(self.store_channel)
+        self.interaction_id = state.interaction_id
+        self.api_key_index = state.api_key_index
+        self.history = ChatHistory(state.history)
+        self.remove_old_history()
+        self.store_version = state.version
+        return state.interaction_id is not None
+
+    def sync_from_store(self) -> bool:
+        """ほかのプロセスが store の状態を書き換えていたら読み込み直す。読み込み直したら True"""
+        if self.store is None or self.store.get_version(self.store_channel) == self.store_version:
+            return False
+        self.load_from_store()
+        return True
+
+    def flush_chat_history(self) -> None:
+        """書き込み待ちの履歴がすべてファイルに反映されるまで待つ。"""
+        self.JOURNAL_WRITER.flush()
 
     def remove_old_history(self) -> None:
-        """maxHistoryLength を超えた古い履歴エントリを削除する。"""
+        """maxHistoryLength と maxHistoryChars に収まるまで古い履歴エントリを削除する。"""
         conf_g = g.config["google"]
         max_len = conf_g["maxHistoryLength"]
-        if len(self.history) > max_len:
-            # 古い履歴から削除（1往復 = user+model の2エントリ）
-            del self.history[0:2]
+        max_chars = conf_g.get("maxHistoryChars", 0)
+        self.history.trim(max_len, max_chars)
 
     def build_context_input(self, message: str) -> str:
         """interaction_id がない場合にローカル履歴をコンテキストとして埋め込んだ入力を生成する。"""
         if not self.history:
             return message
-        lines = ["[直前の会話の文脈]"]
-        for role, text in self.history:
-            label = "ユーザー" if role == "user" else "アシスタント"
-            lines.append(f"{label}: {text}")
-        lines.append("")
-        lines.append("上記のやり取りを踏まえて、以下の新しいメッセージに応答してください。")
-        lines.append(message)
-        return "\n".join(lines)
+        return "\n".join([
+            "[直前の会話の文脈]",
+            self.history.render(),
+            "",
+            "上記のやり取りを踏まえて、以下の新しいメッセージに応答してください。",
+            message,
+        ])
 
     def _extract_status_code(self, e: Exception) -> int | None:
         """例外オブジェクトから HTTP ステータスコードを抽出するヘルパーメソッド"""
@@ -150,7 +274,106 @@ class GenAIInteractions:
 
         return None
 
-    async def generate_text(self, message: str) -> str:
+    @staticmethod
+    async def read_stream(stream, on_delta: Callable[[str], Awaitable[bool | None]]) -> tuple[str | None, str, bool]:
+        """
+        ストリームを読み、テキストの差分を届くたびに on_delta へ渡す。
+
+        on_delta が False を返したら生成を打ち切ります。
+        打ち切り・エラー・取り消し (時間切れや切断) のどれで抜けても、ストリームは閉じて接続を返します。
+
+        Returns:
+            (interaction_id, テキスト, 打ち切ったかどうか)
+        """
+        interaction_id = None
+        chunks = []
+        try:
+            async for event in stream:
+                event_type = getattr(event, "event_type", None)
+                if event_type in ("interaction.created", "interaction.completed"):
+                    interaction = getattr(event, "interaction", None)
+                    interaction_id = getattr(interaction, "id", None) or interaction_id
+                elif event_type == "step.delta":
+                    delta = event.delta
+                    if getattr(delta, "type", None) != "text" or not delta.text:
+                        continue
+                    chunks.append(delta.text)
+                    if await on_delta(delta.text) is False:
+                        return interaction_id, "".join(chunks), True
+                elif event_type == "error":
+                    error = getattr(event, "error", None)
+                    raise StreamError(getattr(error, "code", None), getattr(error, "message", "") or "stream error")
+        except Exception as e:
+            if chunks:
+                # 途中まで送ってしまった返答はやり直せない
+                raise StreamInterruptedError(str(e)) from e
+            raise
+        finally:
+            try:
+                await stream.close()
+            except Exception as e:
+                logger.debug("Failed to close the stream: %s", e)
+        return interaction_id, "".join(chunks), False
+
+    async def generate_text(
+        self,
+        message: str,
+        on_delta: Callable[[str], Awaitable[bool | None]] | None = None,
+        deadline: float | None = None,
+        accept: Callable[[str], bool] | None = None,
+    ) -> str:
+        """
+        メッセージを送って返答を得る。
+
+        on_delta を指定するとストリーミングで受け取り、テキストの差分が届くたびに呼び出します。
+        on_delta が False を返した場合は生成を打ち切り、その返答は会話にも履歴にも残しません。
+        accept を指定すると、最後まで生成した返答を会話に残す前に渡し、False を返したら同じく残さずに返します。
+        deadline (time.monotonic の時刻) を指定すると、リトライを含めてその時刻までに返答できなければ
+        呼び出し中のリクエストを取り消し、タイムアウトのメッセージを返します。
+        """
+        start = time.perf_counter()
+        outcome = None
+        try:
+            return await self._generate_text(message, on_delta, deadline, accept)
+        except asyncio.CancelledError:
+            # 呼び出し元が待つのをやめた
+            outcome = "cancelled"
+            raise
+        finally:
+            if outcome is None:
+                outcome = "ok" if self.last_error_code is None else str(self.last_error_code)
+            MODEL_REQUEST_SECONDS.observe(time.perf_counter() - start, outcome)
+
+    def timed_out(self) -> str:
+        logger.warning("Deadline exceeded. Giving up the request.")
+        self.last_error_code = TIMEOUT_ERROR_CODE
+        return self.get_error_message(TIMEOUT_ERROR_CODE)
+
+    async def create_interaction(
+        self, params: dict[str, any], on_delta: Callable[[str], Awaitable[bool | None]] | None
+    ) -> tuple[str | None, str, bool]:
+        """
+        interaction を作る。
+
+        Returns:
+            (interaction_id, テキスト, 打ち切ったかどうか)
+        """
+        client = self.get_client()
+        if on_delta is None:
+            interaction = await client.aio.interactions.create(**params)
+            return interaction.id, interaction.output_text, False
+        stream = await client.aio.interactions.create(**params, stream=True)
+        return await self.read_stream(stream, on_delta)
+
+    async def _generate_text(
+        self,
+        message: str,
+        on_delta: Callable[[str], Awaitable[bool | None]] | None,
+        deadline: float | None,
+        accept: Callable[[str], bool] | None,
+    ) -> str:
+        # 前回のリクエストのエラーコードを持ち越さない
+        self.last_error_code = None
         retry_count = 0  # 503用のリトライカウンタ
         max_retries = 5  # 最大リトライ回数
 
@@ -159,9 +382,12 @@ class GenAIInteractions:
         max_key_switches = len(conf_g["geminiApiKey"]) # キーの総数
 
         while True:
-            try:
-                client = self.get_client()
+            if not await self.select_api_key():
+                logger.error("All API keys are exhausted.")
+                self.last_error_code = 429
+                return self.get_error_message(429)
 
+            try:
                 params = {
                     "model": conf_g["modelName"],
                     "system_instruction": g.BASE_PROMPT,
@@ -178,22 +404,50 @@ class GenAIInteractions:
                     # APIキー切り替え後の初回など: ローカル履歴をコンテキストとして埋め込む
                     params["input"] = self.build_context_input(message)
 
-                interaction = await client.aio.interactions.create(**params)
-
-                if interaction.id:
-                    self.save_chat_history(interaction.id)
+                if deadline is None:
+                    interaction_id, output_text, aborted = await self.create_interaction(params, on_delta)
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        return self.timed_out()
+                    try:
+                        # 時間切れなら呼び出し中のリクエストを取り消す
+                        interaction_id, output_text, aborted = await asyncio.wait_for(
+                            self.create_interaction(params, on_delta), timeout
+                        )
+                    except asyncio.TimeoutError:
+                        return self.timed_out()
+                if aborted:
+                    # 打ち切った返答は会話の連鎖に含めない
+                    return output_text
+                if output_text and accept is not None and not accept(output_text.rstrip()):
+                    # 受け入れられなかった返答も、打ち切った返答と同じく会話の連鎖に含めない
+                    return output_text.rstrip()
 
                 # レスポンスからテキストを抽出
-                if interaction.output_text:
-                    response_text = interaction.output_text.rstrip()
-                    logger.debug(f"Response: {response_text}")
+                response_text = ""
+                records = []
+                if output_text:
+                    response_text = output_text.rstrip()
+                    logger.debug("Response: %s", response_text)
                     # ローカル履歴に追記
-                    self.history.append(("user", message))
-                    self.history.append(("model", response_text))
+                    records = [("user", message), ("model", response_text)]
+                    self.history.extend(records)
                     self.remove_old_history()
-                    return response_text
 
-                return ""
+                if interaction_id:
+                    await self.run_store(self.save_chat_history, interaction_id, records)
+
+                return response_text
+
+            except StreamInterruptedError as e:
+                status_code = self._extract_status_code(e.__cause__)
+                logger.error(f"Stream interrupted ({status_code}): {e}")
+                if status_code is None:
+                    self.last_error_code = UNKNOWN_ERROR_CODE
+                    return g.ERROR_MESSAGE
+                self.last_error_code = status_code
+                return self.get_error_message(status_code)
 
             except Exception as e:
                 # エラーオブジェクトやメッセージからステータスコードを確実に特定する
@@ -202,45 +456,43 @@ class GenAIInteractions:
                 # ------------------------------------------------------------------
                 # ステータスコードに応じた分岐処理
                 # ------------------------------------------------------------------
+                if status_code in (404, 429, 503):
+                    MODEL_RETRIES.inc(str(status_code))
+
                 if status_code == 404:
                     # 【404: セッション消失（IDをクリアして同じキーで即時リトライ）】
                     logger.warning("Session (interaction_id) not found on server. Clearing ID and retrying with local history...")
                     self.interaction_id = None  # IDを初期化して、次回ループで build_context_input を通す
-
-                    if os.path.isfile(self.FILENAME_INTERACTION_ID):
-                        try:
-                            os.remove(self.FILENAME_INTERACTION_ID)
-                        except Exception as ex:
-                            logger.error(f"Failed to delete file: {ex}")
+                    await self.run_store(self.delete_interaction_id_file)
                     continue  # 同じキーのままループの先頭に戻って再試行
 
                 elif status_code == 429:
                     # 【429: トークン・クォータ枯渇（キー切り替え）】
                     key_switch_count += 1
+                    self.get_key_pool().mark_exhausted(self.api_key_index)
                     if key_switch_count >= max_key_switches:
                         logger.error("All API keys are exhausted.")
                         self.last_error_code = 429
                         return self.get_error_message(429)
 
+                    # 休止中のキーは select_api_key で選ばれなくなる
                     logger.warning("Token/Quota exhausted, switching API key...")
                     self.last_error_code = None
-                    self.get_api_key_index(1)
-                    self.client = None
                     self.interaction_id = None
                     retry_count = 0
-
-                    if os.path.isfile(self.FILENAME_INTERACTION_ID):
-                        try:
-                            os.remove(self.FILENAME_INTERACTION_ID)
-                        except Exception as ex:
-                            logger.error(f"Failed to delete file: {ex}")
+                    await self.run_store(self.delete_interaction_id_file)
                     continue
 
                 elif status_code == 503:
                     # 【503: 高需要・サーバー負荷（指数バックオフリトライ）】
+                    # 会話は同じキーで続けるが、新しく割り当てるときはこのキーを避ける
+                    self.get_key_pool().mark_busy(self.api_key_index)
                     if retry_count < max_retries:
                         delay = (2 ** retry_count) + random.uniform(0, 1)
-                        logger.warning(f"503 Service Unavailable. Retrying in {delay:.2f}s...")
+                        if deadline is not None and time.monotonic() + delay >= deadline:
+                            # 待っている間に時間切れになるなら、すぐにあきらめる
+                            return self.timed_out()
+                        logger.warning("503 Service Unavailable. Retrying in %.2fs...", delay)
                         await asyncio.sleep(delay)
                         retry_count += 1
                         continue
@@ -257,11 +509,25 @@ class GenAIInteractions:
                         return self.get_error_message(self.last_error_code)
                     else:
                         logger.exception(f"Unexpected Error: {e}")
+                        self.last_error_code = UNKNOWN_ERROR_CODE
                         return g.ERROR_MESSAGE
 
-    async def send_message(self, message: str) -> str:
-        return await self.generate_text(message)
-
-    async def send_message_by_json(self, json_data: dict[str, any]) -> str:
-        json_str = json.dumps(json_data, ensure_ascii=False, separators=(",", ":"))
-        return await self.send_message(json_str)
+    async def send_message(
+        self,
+        message: str,
+        on_delta: Callable[[str], Awaitable[bool | None]] | None = None,
+        deadline: float | None = None,
+        accept: Callable[[str], bool] | None = None,
+    ) -> str:
+        return await self.generate_text(message, on_delta, deadline, accept)
+
+    async def send_message_by_json(
+        self,
+        json_data: dict[str, any] | ChatEnvelope,
+        on_delta: Callable[[str], Awaitable[bool | None]] | None = None,
+        deadline: float | None = None,
+        accept: Callable[[str], bool] | None = None,
+    ) -> str:
+        # ChatEnvelope は JSON にした結果を覚えているので、やり直しのたびに変換し直さない
+        json_str = json_data.to_json() if isinstance(json_data, ChatEnvelope) else dumps(json_data)
+        return await self.send_message(json_str, on_delta, deadline, accept)
@@ -0,0 +1,236 @@
+import json
+import logging
+import mmap
+import os
+import pickle
+import queue
+import threading
+from typing import Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 1行目のヘッダーで形式と版を示し、2行目から1行に1レコードの JSON を並べる
+JOURNAL_FORMAT = "fuyuka-history"
+JOURNAL_VERSION = 1
+HEADER = json.dumps({"format": JOURNAL_FORMAT, "version": JOURNAL_VERSION}, separators=(",", ":")) + "\n"
+
+
+def write_text_atomic(path: str, text: str) -> None:
+    """一時ファイルに書いてから置き換えることで、書きかけのファイルを残さない。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def dump_lines(objects: list[dict[str, any]]) -> str:
+    return "".join(json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n" for obj in objects)
+
+
+def to_objects(records: list[tuple[str, str]]) -> list[dict[str, str]]:
+    return [{"role": role, "text": text} for role, text in records]
+
+
+def to_record(obj: dict[str, any]) -> tuple[str, str]:
+    return obj["role"], obj["text"]
+
+
+def _read_header(mm: mmap.mmap) -> tuple[int, int]:
+    """先頭のヘッダーを読み、(ヘッダーの長さ, 形式のバージョン) を返す。ヘッダーのない旧形式はバージョン0"""
+    end = mm.find(b"\n")
+    if end < 0:
+        return 0, 0
+    try:
+        header = json.loads(mm[:end])
+    except ValueError:
+        return 0, 0
+    if not isinstance(header, dict) or header.get("format") != JOURNAL_FORMAT:
+        return 0, 0
+    return end + 1, header.get("version", 0)
+
+
+def _find_tail(mm: mmap.mmap, begin: int, end: int, limit: int) -> int:
+    """begin から end までの行のうち、最後の limit 行が始まる位置を返す。"""
+    cursor = end
+    for _ in range(limit):
+        if cursor <= begin:
+            break
+        newline = mm.rfind(b"\n", begin, cursor - 1)
+        cursor = newline + 1 if newline >= 0 else begin
+    return cursor
+
+
+def read_lines(
+    path: str, parse: Callable[[dict[str, any]], T] = to_record, limit: int | None = None
+) -> list[T]:
+    """
+    ジャーナルファイルの各行を parse で変換して読み込む。
+
+    ファイルは mmap で開き、limit を指定すると末尾から limit 行だけを探して変換します。
+    書き込み途中で終了した場合などに壊れたレコードがあれば、
+    そこから後ろを切り詰めて以降の追記が正しく続くようにします。
+    ヘッダーのない旧形式のファイルは、読み込んだ分だけでヘッダー付きの形式に書き直します。
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return []
+
+    records = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        file_size = len(mm)
+        header_size, version = _read_header(mm)
+        if version > JOURNAL_VERSION:
+            # 新しい版で書かれたファイルは壊さないよう、読まずにそのまま残す
+            logger.warning(f"{path} has unsupported version {version}. Ignored.")
+            return []
+
+        # 改行で終わっていない末尾の行は書きかけ
+        valid_size = max(mm.rfind(b"\n") + 1, header_size)
+        begin = header_size if limit is None else _find_tail(mm, header_size, valid_size, limit)
+        position = begin
+        lines = []
+        while position < valid_size:
+            newline = mm.find(b"\n", position, valid_size)
+            line = mm[position:newline]
+            try:
+                records.append(parse(json.loads(line)))
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Broken record found in {path}. Truncating after {len(records)} records.")
+                valid_size = position
+                break
+            lines.append(mm[position : newline + 1])
+            position = newline + 1
+
+    if version < JOURNAL_VERSION:
+        write_text_atomic(path, HEADER + b"".join(lines).decode("utf-8"))
+        logger.info(f"Upgraded {path} to version {JOURNAL_VERSION}.")
+    elif valid_size < file_size:
+        with open(path, "r+b") as f:
+            f.truncate(valid_size)
+    return records
+
+
+def read_journal(path: str, limit: int | None = None) -> list[tuple[str, str]]:
+    """ジャーナルファイルから (role, text) のリストを読み込む。"""
+    return read_lines(path, to_record, limit)
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+    """組み込みのコンテナと allowed_modules のクラスだけを復元する Unpickler"""
+
+    SAFE_BUILTINS = {"list", "tuple", "dict", "set", "frozenset", "str", "bytes", "int", "float", "bool"}
+
+    def __init__(self, file, allowed_modules: tuple[str, ...] = ()):
+        super().__init__(file)
+        self.allowed_modules = allowed_modules
+
+    def find_class(self, module: str, name: str):
+        if module == "builtins" and name in self.SAFE_BUILTINS:
+            return super().find_class(module, name)
+        if module == "collections" and name in ("deque", "OrderedDict"):
+            return super().find_class(module, name)
+        if module in self.allowed_modules:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed")
+
+
+def migrate_pickle(
+    pickle_path: str,
+    path: str,
+    to_object: Callable[[any], dict[str, any]],
+    allowed_modules: tuple[str, ...] = (),
+) -> bool:
+    """
+    旧形式の .pkl の履歴をジャーナルファイルに書き直す。
+
+    ジャーナルファイルがすでにある場合は何もしません。
+    書き直した .pkl は .pkl.bak に名前を変えて残します。
+
+    Returns:
+        書き直したら True
+    """
+    if not os.path.isfile(pickle_path) or os.path.exists(path):
+        return False
+    try:
+        with open(pickle_path, "rb") as f:
+            items = RestrictedUnpickler(f, allowed_modules).load()
+        objects = [to_object(item) for item in items]
+    except Exception as e:
+        logger.warning(f"Failed to migrate {pickle_path}: {e}")
+        return False
+    write_text_atomic(path, HEADER + dump_lines(objects))
+    os.replace(pickle_path, f"{pickle_path}.bak")
+    logger.info(f"Migrated {len(objects)} records from {pickle_path} to {path}.")
+    return True
+
+
+class JournalWriter:
+    """
+    履歴ファイルへの書き込みを専用スレッドで順番に実行する。
+
+    呼び出し側は書き込みを積むだけなので、イベントループを止めません。
+    """
+
+    def __init__(self):
+        self.tasks: queue.Queue = queue.Queue()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def _ensure_thread(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="JournalWriter", daemon=True)
+                self.thread.start()
+
+    def _put(self, func, *args) -> None:
+        self._ensure_thread()
+        self.tasks.put((func, args))
+
+    def append(self, path: str, records: list[tuple[str, str]]) -> None:
+        """ジャーナルの末尾に (role, text) のレコードを追記する。"""
+        self.append_objects(path, to_objects(records))
+
+    def append_objects(self, path: str, objects: list[dict[str, any]]) -> None:
+        self._put(self._append, path, list(objects))
+
+    def compact(self, path: str, records: list[tuple[str, str]]) -> None:
+        """ジャーナルを現在の履歴だけで書き直す。"""
+        self.compact_objects(path, to_objects(records))
+
+    def compact_objects(self, path: str, objects: list[dict[str, any]]) -> None:
+        self._put(write_text_atomic, path, HEADER + dump_lines(objects))
+
+    def write_text(self, path: str, text: str) -> None:
+        self._put(write_text_atomic, path, text)
+
+    def remove(self, path: str) -> None:
+        self._put(self._remove, path)
+
+    def flush(self) -> None:
+        """積まれている書き込みがすべて終わるまで待つ。"""
+        self.tasks.join()
+
+    @staticmethod
+    def _append(path: str, objects: list[dict[str, any]]) -> None:
+        with open(path, "a", encoding="utf-8") as f:
+            if f.tell() == 0:
+                f.write(HEADER)
+            f.write(dump_lines(objects))
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def _run(self) -> None:
+        while True:
+            func, args = self.tasks.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Failed to write history file: {e}")
+            finally:
+                self.tasks.task_done()
@@ -1,21 +1,49 @@
-import msvcrt
+import os
+import sys
 import time
 
+# キー入力を確かめる間隔 (秒)。CPU を使い切らないよう、確かめる合間は眠る
+POLL_INTERVAL = 0.05
 
-def input_with_timeout(prompt, timeout=3):
+
+def input_with_timeout(prompt, timeout=3, default="n"):
     print(prompt, end="", flush=True)
-    start_time = time.time()
-    input_str = ""
+    if sys.stdin is None or not sys.stdin.isatty():
+        # サービスやパイプから起動されたときは、入力を待たずにデフォルトで進行する
+        print()
+        return default
+
+    if os.name == "nt":
+        input_str = _input_windows(timeout)
+    else:
+        input_str = _input_posix(timeout)
+
+    if input_str is None:
+        print(f"\nタイムアウト：デフォルト({default})で進行します。")
+        return default
+    return input_str.strip()
 
-    while True:
-        if msvcrt.kbhit(): # キーが押されたかチェック
-            char = msvcrt.getche().decode("utf-8")
+
+def _input_windows(timeout):
+    import msvcrt
+
+    deadline = time.monotonic() + timeout
+    input_str = ""
+    while time.monotonic() < deadline:
+        while msvcrt.kbhit(): # キーが押されたかチェック
+            char = msvcrt.getwche()
             if char in ("\r", "\n"): # エンターキー
-                break
+                print()
+                return input_str
             input_str += char
+        time.sleep(POLL_INTERVAL)
+    return None
 
-        if (time.time() - start_time) > timeout:
-            print("\nタイムアウト：デフォルト(n)で進行します。")
-            return "n"
 
-    return input_str.strip()
+def _input_posix(timeout):
+    import select
+
+    ready, _, _ = select.select([sys.stdin], [], [], timeout)
+    if not ready:
+        return None
+    return sys.stdin.readline()
@@ -1,5 +1,13 @@
+import atexit
+import copy
+import gzip
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
 import sys
+import threading
 
 
 class ForceFilter(logging.Filter):
@@ -19,19 +27,142 @@ def to_log_level(log_level_str: str):
     return log_level
 
 
-def setup_app_logging(log_level_str: str, log_file_path="app.log"):
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    ログを待ち行列に積むだけの QueueHandler
+
+    標準の QueueHandler は積む前にフォーマッターで1行に整形しますが、
+    ここでは msg % args だけを呼び出し元で組み立て、時刻や例外のトレースバックを含めた整形は書き出すスレッドに任せます。
+    引数は呼び出したときの値で文字列になるので、後から変更されても書き出す内容は変わりません。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+
+class GzipRotator:
+    """
+    ローテートしたログファイルを別スレッドで gzip 圧縮する。
+
+    ログの書き出しは名前の変更だけで続けられ、圧縮を待ちません。
+    次のローテートは前回の圧縮が終わるのを待ってから行います。
+    """
+
+    def __init__(self):
+        self.thread: threading.Thread | None = None
+
+    @staticmethod
+    def namer(name: str) -> str:
+        return name + ".gz"
+
+    def __call__(self, source: str, dest: str) -> None:
+        pending = f"{dest}.pending"
+        os.replace(source, pending)
+        self.thread = threading.Thread(target=self._compress, args=(pending, dest), name="LogCompressor", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _compress(source: str, dest: str) -> None:
+        try:
+            with open(source, "rb") as f_in, gzip.open(f"{dest}.tmp", "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(f"{dest}.tmp", dest)
+            os.remove(source)
+        except OSError as e:
+            print(f"Failed to compress {source}: {e}", file=sys.stderr)
+
+    def join(self) -> None:
+        if self.thread is not None:
+            self.thread.join()
+
+
+class CompressionAwareRollover:
+    """前回の圧縮が終わってから、古いファイルの名前をずらしてローテートする。"""
+
+    def doRollover(self) -> None:
+        if isinstance(self.rotator, GzipRotator):
+            self.rotator.join()
+        super().doRollover()
+
+
+class RotatingFileHandler(CompressionAwareRollover, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class TimedRotatingFileHandler(CompressionAwareRollover, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+def create_file_handler(
+    log_file_path: str, max_bytes: int = 0, when: str = "", backup_count: int = 5, compress: bool = False
+) -> logging.FileHandler:
+    """max_bytes か when を指定するとローテートするファイルハンドラを作る。"""
+    if max_bytes > 0:
+        handler = RotatingFileHandler(
+            log_file_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+    elif when:
+        handler = TimedRotatingFileHandler(
+            log_file_path, when=when, backupCount=backup_count, encoding="utf-8"
+        )
+    else:
+        return logging.FileHandler(log_file_path, mode="a", encoding="utf-8")
+    if compress:
+        handler.rotator = GzipRotator()
+        handler.namer = handler.rotator.namer
+    return handler
+
+
+# 待ち行列を使う場合に、ファイルと画面への書き出しを行うリスナー
+_listener: logging.handlers.QueueListener | None = None
+
+
+def shutdown_app_logging() -> None:
+    """待ち行列に残っているログをすべて書き出し、リスナーを止める。"""
+    global _listener
+    listener = _listener
+    _listener = None
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+        rotator = getattr(handler, "rotator", None)
+        if isinstance(rotator, GzipRotator):
+            rotator.join()
+
+
+def setup_app_logging(
+    log_level_str: str,
+    log_file_path="app.log",
+    use_queue: bool = True,
+    max_bytes: int = 0,
+    when: str = "",
+    backup_count: int = 5,
+    compress: bool = True,
+):
     """
     アプリケーション全体のロギング設定を行います。
     ルートロガーにハンドラを設定するのが最も確実です。
+
+    use_queue が True なら、ルートロガーには待ち行列に積むだけのハンドラを付け、
+    メッセージの組み立てとファイル・画面への書き出しは別スレッドで行います。
+    max_bytes (サイズ) か when (時刻, TimedRotatingFileHandler と同じ指定) でログファイルをローテートし、
+    compress が True なら古いファイルを別スレッドで gzip 圧縮します。
     """
 
     # 既存のハンドラをクリア（二重設定を防ぐため）
+    shutdown_app_logging()
     root_logger = logging.getLogger()
     if root_logger.handlers:
-        for handler in root_logger.handlers:
+        for handler in list(root_logger.handlers):
             root_logger.removeHandler(handler)
 
-    # ロガー自体のレベルは一番低いもの
+    # ロガー自体のレベルは一番低いもの (force 付きのログを通すため)
     root_logger.setLevel(logging.DEBUG)
 
     # フォーマッター
@@ -47,16 +178,30 @@ def setup_app_logging(log_level_str: str, log_file_path="app.log"):
     # 画面出力 (StreamHandler)
     console_handler = logging.StreamHandler(sys.stdout)
     console_handler.setFormatter(formatter)
-    console_handler.addFilter(log_filter)
-    root_logger.addHandler(console_handler)
 
     # ファイル出力 (FileHandler)
-    file_handler = logging.FileHandler(log_file_path, mode="a", encoding="utf-8")
+    file_handler = create_file_handler(log_file_path, max_bytes, when, backup_count, compress)
     file_handler.setFormatter(formatter)
-    file_handler.addFilter(log_filter)
-    root_logger.addHandler(file_handler)
+
+    if not use_queue:
+        for handler in (console_handler, file_handler):
+            handler.addFilter(log_filter)
+            root_logger.addHandler(handler)
+        return
+
+    # 捨てるログは待ち行列に積む前にふるい落とす
+    queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(log_filter)
+    root_logger.addHandler(queue_handler)
+
+    global _listener
+    _listener = logging.handlers.QueueListener(queue_handler.queue, console_handler, file_handler)
+    _listener.start()
 
     # 外部ライブラリのログが大量に出る場合は、必要に応じてここでレベルを設定
     # logging.getLogger('requests').setLevel(logging.WARNING)
 
     # logging.info("ロギング設定が完了しました。")
+
+
+atexit.register(shutdown_app_logging)
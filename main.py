@@ -6,105 +6,250 @@ import logging
 import os
 import re
 import sys
+import time
 from contextlib import asynccontextmanager
 
-import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import (
+    APIRouter,
+    FastAPI,
+    HTTPException,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
 from pydantic import BaseModel
 
 import global_value as g
-from config_helper import read_config
-from input_helper import input_with_timeout
-from logging_setup import setup_app_logging
+from startup_helper import STARTUP_CONTINUE, PhaseTimer, parse_startup_mode
 
-is_testing = os.environ.get("APP_TESTING") == "True"
+startup_timer = PhaseTimer()
 
 g.app_name = "ai_moderator_fuyuka"
 g.base_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
 
-if not is_testing:
-    res = input_with_timeout("前回の続きですか？(y/n) [10秒以内に未入力なら 'n']: ", timeout=10)
-    is_continue = (res == "y")
-else:
-    is_continue = False
-
-g.config = read_config()
-
-# ロガーの設定
-setup_app_logging(g.config["logLevel"], log_file_path=f"{g.app_name}.log")
 logger = logging.getLogger(__name__)
 
+from api_key_pool import ApiKeyPool
+from cache_helper import get_cache_filepath
+from channel_registry import ChannelLimitError, ChannelRegistry, ChannelSession
+from chat_envelope import ChatEnvelope, set_encoder
+from config_helper import read_config
+from connection_manager import ConnectionManager
 from dict_helper import remove_keys_by_value
 
 # from genai_chat import GenAIChat
 from genai_interactions import GenAIInteractions
-from ng_words_helper import read_ng_words
+from input_helper import input_with_timeout
+from logging_setup import setup_app_logging
+from metrics import REGISTRY, Counter, Gauge, Histogram
+from ng_word_matcher import NgWordMatcher
+from prompt_compactor import PromptCompactor
+from reply_cache import ReplyCache
+from request_queue import RequestDroppedError, RequestQueue, RequestQueueFullError
+from session_store import MemorySessionStore, SessionStore, SqliteSessionStore
+from story_buffer import StoryBuffer
 from text_cleaner import clean_and_extract_alt
 from text_helper import read_text
 
-g.BASE_PROMPT = read_text("prompts/base_prompt.txt")
-g.ADDITIONAL_REQUESTS_PROMPT = read_text("prompts/additional_requests_prompt.txt")
-g.ERROR_MESSAGE = read_text("messages/error_message.txt")
-g.STOP_CANDIDATE_MESSAGE = read_text("messages/stop_candidate_message.txt")
-g.RESOURCE_EXHAUSTED_MESSAGE = read_text("messages/resource_exhausted_message.txt")
+# 以下は create_app で設定ファイルから作る。読み込んだだけでは設定もログも触らない
+ng_word_matcher: NgWordMatcher | None = None
+session_store: SessionStore | None = None
+reply_cache: ReplyCache | None = None
+prompt_compactor: PromptCompactor | None = None
+story_buffer: StoryBuffer | None = None
+api_key_pool: ApiKeyPool | None = None
+genai_chat: GenAIInteractions | None = None
+request_queue: RequestQueue | None = None
+manager: ConnectionManager | None = None
+channel_registry: ChannelRegistry | None = None
+# 履歴の復元はポートを開いてからバックグラウンドで行い、終わるまで返答の処理を待たせる
+history_restored: asyncio.Event | None = None
+restore_on_startup = False
+
+fuyuka_port = 38321
+queue_size = 16
+batch_threshold = 3
+batch_max_size = 10
+stream_default = False
+ng_word_max_retries = 3
+stale_comment_seconds = 30
+request_timeout_seconds = 30
+
+DEFAULT_CHANNEL = "default"
+# ほかのワーカーが送ったメッセージを store から読みに行く間隔 (秒)
+BROADCAST_RELAY_INTERVAL = 0.1
+# 使われていないチャンネルを探す間隔 (秒)
+CHANNEL_SWEEP_INTERVAL = 60
+
+
+def create_session_store() -> SessionStore | None:
+    """設定の sessionStore に従って会話の状態の保存先を作る。"file" なら従来どおりチャンネルごとのファイルに保存する。"""
+    kind = g.config["fuyukaApi"].get("sessionStore", "file")
+    if kind == "memory":
+        return MemorySessionStore()
+    if kind == "sqlite":
+        path = g.config["fuyukaApi"].get("sessionStorePath") or get_cache_filepath(f"{g.app_name}_sessions.sqlite3")
+        # WebSocket へ送るメッセージを中継するのは、ほかのワーカーと store を共有するときだけ
+        return SqliteSessionStore(path, relays_messages=g.config["fuyukaApi"].get("workers", 1) > 1)
+    return None
+
+
+def create_story_buffer(channel: str = DEFAULT_CHANNEL) -> StoryBuffer:
+    return StoryBuffer(
+        g.config["fuyukaApi"].get("storyFlushChars", 1000),
+        g.config["fuyukaApi"].get("storyMaxChars", 4000),
+        g.config["fuyukaApi"].get("storyFlushSeconds", 60),
+        session_store,
+        channel,
+    )
+
+
+def create_connection_manager(channel: str = DEFAULT_CHANNEL) -> ConnectionManager:
+    relay = None
+    if session_store is not None and session_store.relays_messages:
+        # ほかのワーカーに接続しているクライアントにも届くよう、store を通して中継する
+        def relay(message: str) -> None:
+            session_store.publish(channel, message)
+
+    return ConnectionManager(
+        g.config["fuyukaApi"].get("clientQueueSize", 64),
+        g.config["fuyukaApi"].get("slowClientPolicy", "drop"),
+        relay,
+    )
+
+
+def create_session_lock(channel: str, chat: GenAIInteractions):
+    """store を共有するほかのプロセスと、チャンネルの会話を1件ずつ処理するためのロックを作る。"""
+    if session_store is None:
+        return None
 
-g.storyteller = ""
-g.story_buffer = ""
+    @asynccontextmanager
+    async def lock():
+        async with session_store.lock(channel):
+            # ほかのプロセスが会話を進めていたら、その続きから話す
+            await chat.run_store(chat.sync_from_store)
+            yield
+
+    return lock
+
+# 記録するのは数値の更新だけにして、/metrics が呼ばれたときにまとめて文字列にする
+STARTUP_PHASE_SECONDS = Gauge("fuyuka_startup_phase_seconds", "Time spent in each startup phase.", ("phase",))
+REPLY_SECONDS = Histogram("fuyuka_reply_seconds", "Time to produce a reply in send_message_genai_chat, including NG word retries.")
+NG_WORD_REGENERATIONS = Counter("fuyuka_ng_word_regenerations_total", "Replies regenerated because they contained NG words.")
+NG_WORD_GIVE_UPS = Counter("fuyuka_ng_word_give_ups_total", "Replies dropped after too many NG word retries.")
+STORY_COMMENTS = Counter("fuyuka_story_comments_total", "Noisy comments added to the story buffer.")
+Gauge("fuyuka_request_queue_depth", "Requests waiting in the request queue.").set_function(lambda: len(request_queue))
+Gauge("fuyuka_story_buffer_chars", "Characters waiting in the story buffer.").set_function(lambda: story_buffer.chars)
+Counter("fuyuka_story_dropped_total", "Noisy comments dropped from the full story buffer.").set_function(
+    lambda: story_buffer.dropped
+)
+Counter("fuyuka_requests_expired_total", "Regular comments dropped after waiting too long in the queue.").set_function(
+    lambda: request_queue.expired
+)
+Counter("fuyuka_requests_evicted_total", "Queued comments dropped to make room for higher priority ones.").set_function(
+    lambda: request_queue.evicted
+)
+Counter("fuyuka_reply_cache_hits_total", "Replies served from the reply cache.").set_function(lambda: reply_cache.hits)
+Counter("fuyuka_reply_cache_misses_total", "Reply cache lookups that missed.").set_function(lambda: reply_cache.misses)
+Gauge("fuyuka_websocket_connections", "Connected WebSocket clients.").set_function(lambda: len(manager))
+
+
+def get_session(session: ChannelSession | None = None) -> ChannelSession:
+    """session が None なら既定のチャンネルを返す。既定のチャンネルはモジュールの変数をそのまま使う。"""
+    if session is not None:
+        return session
+    return ChannelSession(
+        DEFAULT_CHANNEL, genai_chat, story_buffer, ng_word_matcher, reply_cache, request_queue, manager, history_restored
+    )
+
+
+def create_channel_session(channel: str) -> ChannelSession:
+    """既定以外のチャンネルを作る。APIキーのプールと接続はすべてのチャンネルで共有する。"""
+    channel_chat = GenAIInteractions(api_key_pool, channel, session_store)
+    session = ChannelSession(
+        channel,
+        channel_chat,
+        create_story_buffer(channel),
+        NgWordMatcher(f"ng_words_{channel}.json", fallback_name="ng_words.json"),
+        ReplyCache.from_config(g.config["fuyukaApi"]),
+        RequestQueue(queue_size, batch_threshold, batch_max_size, create_session_lock(channel, channel_chat)),
+        create_connection_manager(channel),
+        asyncio.Event(),
+    )
+    if (restore_on_startup or channel in channel_registry.evicted) and session_store is None:
+        # store を使うときは、最初にロックを取ったときに sync_from_store で読み込む
+        session.tasks.append(create_background_task(restore_channel_history(session)))
+    else:
+        session.ready.set()
+    session.tasks.append(create_background_task(summarize_story(session)))
+    return session
 
-fuyuka_port = g.config["fuyukaApi"]["port"]
 
-# genai_chat = GenAIChat()
-genai_chat = GenAIInteractions()
-if is_continue and genai_chat.load_chat_history():
-    print("会話履歴を復元しました。")
+async def restore_channel_history(session: ChannelSession) -> None:
+    """チャンネルの会話履歴をスレッドで読み込み、終わったら返答の処理を再開させる。"""
+    try:
+        # 使われずに閉じたチャンネルを作り直したときは、前のセッションが履歴を書き出し終わってから読む
+        await channel_registry.wait_closed(session.name)
+        await asyncio.to_thread(session.genai_chat.load_chat_history)
+    except Exception as e:
+        logger.error(f"Failed to restore chat history for channel {session.name}: {e}")
+    finally:
+        session.ready.set()
 
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+Gauge("fuyuka_channels", "Channels opened in addition to the default channel.").set_function(
+    lambda: len(channel_registry)
+)
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
 
-    def disconnect(self, websocket: WebSocket):
-        # すでに削除されている場合の ValueError を防ぐ
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+def get_channel_session(channel: str) -> ChannelSession:
+    if channel == DEFAULT_CHANNEL:
+        return get_session()
+    return channel_registry.get(channel)
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
 
-    async def broadcast(self, message: str):
-        # 送信失敗した接続を特定するためにコピーを作成してループ
-        for connection in self.active_connections[:]:
-            try:
-                await connection.send_text(message)
-            except Exception:
-                # 送信失敗した接続はここで除外
-                self.disconnect(connection)
+class DeltaBroadcaster:
+    """ストリーミング中の返答を、連番付きの差分フレームとして全クライアントへ送る。"""
 
-    async def send_personal_json(self, json_data: dict[str, any], websocket: WebSocket):
-        await websocket.send_json(json_data)
+    def __init__(self, id: str, manager: ConnectionManager):
+        self.id = id
+        self.manager = manager
+        self.seq = 0
 
-    async def broadcast_json(self, json_data: dict[str, any]):
-        # 送信失敗した接続を特定するためにコピーを作成してループ
-        for connection in self.active_connections[:]:
-            try:
-                await connection.send_json(json_data)
-            except Exception:
-                # 送信失敗した接続はここで除外
-                self.disconnect(connection)
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
 
+    async def send_delta(self, delta: str) -> None:
+        await self.manager.broadcast_json({
+            "type": "delta",
+            "id": self.id,
+            "seq": self.next_seq(),
+            "delta": delta,
+        })
 
-manager = ConnectionManager()
+    async def send_reset(self) -> None:
+        # 打ち切った返答の表示をクライアント側で破棄してもらう
+        await self.manager.broadcast_json({
+            "type": "reset",
+            "id": self.id,
+            "seq": self.next_seq(),
+        })
 
 localtime = datetime.datetime.now()
 localtime_iso_8601 = localtime.isoformat()
 answerLength = 30
 
+BATCH_REQUEST = (
+    "複数のコメントをまとめて送ります。"
+    "`comments`の各コメントへの返答を、`commentId`をキー、返答を値にしたJSONオブジェクトのみで出力してください。"
+)
+STORY_REQUEST = "`story` is the recent noisy comments. Get a general idea of the flow of the conversation from it as well."
+FLOW_REQUEST = "Get a general idea of the flow of the conversation."
+LENGTH_REQUEST = f"あなたの回答は{answerLength}文字以内にまとめてください"
+
 
 class ChatModel(BaseModel):
     dateTime: str = localtime_iso_8601
@@ -114,7 +259,7 @@ class ChatModel(BaseModel):
     content: str = "おはようございます。今日もよろしくお願いします。"
     needsResponse: bool = False
     noisy: bool = False
-    additionalRequests: list[str] = [f"あなたの回答は{answerLength}文字以内にまとめてください"]
+    additionalRequests: list[str] = [LENGTH_REQUEST]
 
 
 class ChatResult(BaseModel):
@@ -130,7 +275,8 @@ class Result(BaseModel):
 
 chat_template = json.dumps(jsonable_encoder(ChatModel()), indent=2, ensure_ascii=False)
 
-html = f"""
+def build_chat_test_html(port: int) -> str:
+    return f"""
 <!DOCTYPE html>
 <html>
     <head>
@@ -148,7 +294,7 @@ html = f"""
         <ul id='messages'>
         </ul>
         <script>
-            const fuyuka_port = {fuyuka_port}
+            const fuyuka_port = {port}
             const client_id = Date.now()
             document.querySelector("#ws-id").textContent = client_id;
             const chat_endpoint = `ws://localhost:${{fuyuka_port}}/chat/${{client_id}}`
@@ -173,22 +319,142 @@ html = f"""
 """
 
 
+# 実行中のタスクが途中でガベージコレクトされないよう参照を保持する
+background_tasks: set[asyncio.Task] = set()
+
+
+def create_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def restore_history() -> None:
+    """前回の会話履歴をバックグラウンドで読み込み、終わったら返答の処理を再開させる。"""
+    timer = PhaseTimer()
+    try:
+        if await asyncio.to_thread(genai_chat.load_chat_history):
+            print("会話履歴を復元しました。")
+    except Exception as e:
+        logger.error(f"Failed to restore chat history: {e}")
+    finally:
+        history_restored.set()
+    timer.mark("restore")
+    STARTUP_PHASE_SECONDS.set(timer.total(), "restore")
+    logger.info("Chat history restored in %.0fms", timer.total() * 1000, extra={'force': True})
+
+
+async def prepare_api_key_pool() -> None:
+    await asyncio.to_thread(api_key_pool.prewarm)
+    if g.config["google"].get("warmUp", True):
+        await api_key_pool.warm_up(g.config["google"]["modelName"])
+
+
+async def relay_broadcasts() -> None:
+    """ほかのワーカーが送ったメッセージを store から読み、このワーカーのクライアントへ送る。"""
+    after_id = await session_store.run(session_store.latest_message_id)
+    while True:
+        await asyncio.sleep(BROADCAST_RELAY_INTERVAL)
+        try:
+            messages = await session_store.run(session_store.poll_messages, after_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to read relayed messages: {e}")
+            continue
+        for after_id, channel, message in messages:
+            if channel == DEFAULT_CHANNEL:
+                target = manager
+            elif channel in channel_registry:
+                target = channel_registry.get(channel).manager
+            else:
+                # このワーカーにはそのチャンネルのクライアントがいない
+                continue
+            await target.broadcast_local(message)
+
+
+async def evict_idle_channels() -> None:
+    """使われていないチャンネルを定期的に閉じ、接続や履歴の書き込み待ちを手放す。"""
+    while True:
+        await asyncio.sleep(min(CHANNEL_SWEEP_INTERVAL, channel_registry.idle_seconds))
+        try:
+            await channel_registry.evict_idle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to close idle channels: {e}")
+
+
 def remove_newlines(value: str) -> str:
     return re.sub(r"[\r\n]", " ", value)
 
-def update_viewerStatus(json_data: dict[str, any]):
-    # popで値を取り出しつつ、辞書から安全に削除する（キーがなければFalseになる）
-    is_first = json_data.pop("isFirst", False)
-    is_first_on_stream = json_data.pop("isFirstOnStream", False)
-
-    if is_first:
-        viewerStatus = "newViewer"
-    elif is_first_on_stream:
-        viewerStatus = "streamFirst"
+def get_viewerStatus(json_data: dict[str, any]) -> str:
+    if json_data.get("isFirst", False):
+        return "newViewer"
+    elif json_data.get("isFirstOnStream", False):
+        return "streamFirst"
     else:
-        viewerStatus = "regular"
+        return "regular"
+
+
+# 待ち行列で先に処理する順 (大きいほど先)
+PRIORITY_REGULAR = 0
+PRIORITY_STREAM_FIRST = 1
+PRIORITY_NEEDS_RESPONSE = 2
+
+
+def get_priority(json_data: dict[str, any]) -> int:
+    """初見さんと返答が必要なコメントを優先する。"""
+    if json_data.get("needsResponse", False) or get_viewerStatus(json_data) == "newViewer":
+        return PRIORITY_NEEDS_RESPONSE
+    if get_viewerStatus(json_data) == "streamFirst":
+        return PRIORITY_STREAM_FIRST
+    return PRIORITY_REGULAR
+
 
-    json_data["viewerStatus"] = viewerStatus
+def get_max_wait(priority: int) -> float | None:
+    """いつものコメントは、待たせすぎたら返答せずに捨てる。"""
+    if priority == PRIORITY_REGULAR and stale_comment_seconds > 0:
+        return stale_comment_seconds
+    return None
+
+
+def get_deadline() -> float | None:
+    """受け付けたコメントに返答し終える期限 (time.monotonic の時刻)。待ち行列で待つ時間も含む。"""
+    if request_timeout_seconds <= 0:
+        return None
+    return time.monotonic() + request_timeout_seconds
+
+
+def submit_reply(
+    json_data: dict[str, any], stream: DeltaBroadcaster | None, session: ChannelSession
+) -> asyncio.Future:
+    """
+    返答のリクエストを待ち行列に積む。ストリーミングしない場合は、混雑時にまとめて返答できる。
+
+    Raises:
+        RequestQueueFullError: 待ち行列が満杯の場合
+    """
+    priority = get_priority(json_data)
+    return session.request_queue.submit_nowait(
+        reply_genai_chat,
+        copy.deepcopy(json_data),
+        stream,
+        session,
+        get_deadline(),
+        batch_func=reply_genai_chat_batch if stream is None else None,
+        priority=priority,
+        max_wait=get_max_wait(priority),
+    )
+
+
+def prepare_fields(json_data: dict[str, any]) -> dict[str, any]:
+    """送信する形に整えたフィールドの辞書を作る。json_data は変更しない (値はコピーせずに共有する)。"""
+    fields = {k: v for k, v in json_data.items() if k not in ("isFirst", "isFirstOnStream")}
+    fields["viewerStatus"] = get_viewerStatus(json_data)
+    remove_keys_by_value(fields, ["noisy"], False)
+    return fields
 
 def append_additional_request(
     json_data: dict[str, any], value: str
@@ -200,147 +466,708 @@ def append_additional_request(
 def clean_and_extract_alt_by_json(json_data: dict[str, any]) -> None:
     json_data["content"] = clean_and_extract_alt(json_data["content"])
 
-async def flow_story_genai_chat() -> str:
-    if not g.story_buffer:
+def create_prompt_compactor(enabled: bool = True) -> PromptCompactor:
+    """毎回送っている定型の追加指示を、キーで参照できるように登録する。"""
+    return PromptCompactor(
+        {
+            "additional": g.ADDITIONAL_REQUESTS_PROMPT,
+            "length": LENGTH_REQUEST,
+            "batch": BATCH_REQUEST,
+            "story": STORY_REQUEST,
+            "flow": FLOW_REQUEST,
+        },
+        enabled,
+    )
+
+
+def compact_prompt(json_data: dict[str, any]) -> int:
+    if prompt_compactor is None:
+        return 0
+    return prompt_compactor.compact(json_data)
+
+
+def record_compaction(saved: int) -> None:
+    if prompt_compactor is not None:
+        prompt_compactor.record(saved)
+
+
+def build_envelope(json_data: dict[str, any]) -> ChatEnvelope:
+    fields = prepare_fields(json_data)
+    requests = fields.pop("additionalRequests", None) or []
+    if prompt_compactor is not None:
+        requests, saved = prompt_compactor.compact_requests(requests)
+        record_compaction(saved)
+    return ChatEnvelope(fields, tuple(requests))
+
+
+async def attach_story(json_data: dict[str, any], session: ChannelSession | None = None) -> None:
+    """まだ要約していない流れがあれば、このリクエストに添えて一緒に送る。"""
+    story = await get_session(session).story_buffer.atake()
+    if story is None:
         return
+    storyteller, content = story
+    json_data["story"] = {"displayName": storyteller, "content": content}
+    append_additional_request(json_data, STORY_REQUEST)
+
+
+async def flow_story_genai_chat(session: ChannelSession | None = None) -> str:
+    session = get_session(session)
+    await session.ready.wait()
+    story = await session.story_buffer.atake()
+    if story is None:
+        # 先に返答のリクエストへ添えて送られている
+        return ""
+    storyteller, content = story
 
     localtime = datetime.datetime.now()
     localtime_iso_8601 = localtime.isoformat()
     json_data = {
         "dateTime": localtime_iso_8601,
         "id": None,
-        "displayName": g.storyteller,
-        "content": g.story_buffer.rstrip(),
+        "displayName": storyteller,
+        "content": content,
         "needsResponse": False,
         "noisy": True,
-        "additionalRequests": ["Get a general idea of the flow of the conversation."],
+        "additionalRequests": [FLOW_REQUEST],
     }
-    response_text = await send_message_genai_chat(json_data)
-    g.story_buffer = ""
+    response_text = await send_message_genai_chat(json_data, session=session)
     return remove_newlines(response_text)
 
 
-async def _flow_story(json_data: dict[str, any]) -> str:
-    g.storyteller = json_data["displayName"]
-    g.story_buffer += json_data["content"] + " "
-    if len(g.story_buffer) <= 1000:
-        return ""
-    response_text = await flow_story_genai_chat()
-    return remove_newlines(response_text)
+def _flow_story(json_data: dict[str, any], session: ChannelSession | None = None) -> None:
+    STORY_COMMENTS.inc()
+    get_session(session).story_buffer.append(json_data["displayName"], json_data["content"])
 
 
-async def send_message_genai_chat(json_data: dict[str, any]) -> str:
-    ng_words = read_ng_words()
-    pattern = "|".join(ng_words)
-    json_data_send = copy.deepcopy(json_data)
-    update_viewerStatus(json_data_send)
-    remove_keys_by_value(json_data_send, ["noisy"], False)
+async def summarize_story(session: ChannelSession | None = None) -> None:
+    """たまった流れを、返答を待たせないようリクエストが途切れたときに要約させる。"""
+    session = get_session(session)
     while True:
-        response_text = await genai_chat.send_message_by_json(json_data_send)
+        await session.story_buffer.wait_due()
+        if not session.request_queue.is_idle():
+            # 混雑中は次の返答のリクエストに添えて送られるのを待つ
+            await asyncio.sleep(1)
+            continue
+        try:
+            await session.request_queue.submit(flow_story_genai_chat, session)
+        except RequestQueueFullError:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Failed to summarize story: {e}")
+
+
+def build_ng_words_retry_content(matched_words: list[str]) -> str:
+    # 指摘文に具体的なキーワードをすべて埋め込む
+    words = "、".join(f"`{word}`" for word in matched_words)
+    return f"返答に{words}という文章を含めないでください。"
+
+
+async def send_message_genai_chat(
+    json_data: dict[str, any],
+    stream: DeltaBroadcaster | None = None,
+    session: ChannelSession | None = None,
+    deadline: float | None = None,
+) -> str:
+    with REPLY_SECONDS.time():
+        return await _send_message_genai_chat(json_data, stream, get_session(session), deadline)
+
+
+async def _send_message_genai_chat(
+    json_data: dict[str, any], stream: DeltaBroadcaster | None, session: ChannelSession, deadline: float | None
+) -> str:
+    # 送るメッセージは一度だけ組み立て、やり直しでは追加指示だけを足す
+    envelope = build_envelope(json_data)
+
+    scanner = None
+
+    async def on_delta(delta: str) -> bool:
+        released_text = scanner.feed(delta)
+        if scanner.matched_words:
+            # NGワードが出た時点で生成を打ち切る
+            return False
+        if stream is not None and released_text:
+            await stream.send_delta(remove_newlines(released_text))
+        return True
+
+    checked_words: list[str] | None = None
+
+    def accept(text: str) -> bool:
+        # 最後まで生成した返答は、会話に残す前に全文で確かめる
+        nonlocal checked_words
+        checked_words = session.ng_word_matcher.find_words(text)
+        return not checked_words
+
+    # 差分を受け取るクライアントがいるときだけストリーミングする。
+    # ストリーミングしなければ、途中で切れた呼び出しも 429/503 のやり直しやキーの切り替えができる
+    delta_handler = on_delta if stream is not None else None
+    matched_words: list[str] = []
+    envelope_retry = envelope
+    for retry_count in range(ng_word_max_retries + 1):
+        scanner = session.ng_word_matcher.scanner()
+        checked_words = None
+        # 期限を過ぎていれば、やり直しの途中でもタイムアウトのメッセージがすぐに返る
+        response_text = await session.genai_chat.send_message_by_json(
+            envelope_retry, delta_handler, deadline, accept=accept
+        )
         if not response_text:
             return response_text
 
-        match = re.search(pattern, response_text, re.IGNORECASE)
-        if match:
-            matched_word = match.group()
-            logger.warning(response_text)
-            # 指摘文に具体的なキーワードを埋め込む
-            content = (
-                f"{json_data['dateTime']}の出力ですが`{matched_word}`という文章を含めずやり直してください。"
-            )
-            logger.warning(content)
-            json_data_send["content"] = content
-        else:
+        # モデルが生成しなかった返答(エラーメッセージなど)も全文で確かめる
+        new_words = scanner.matched_words or checked_words
+        if checked_words is None and not new_words:
+            new_words = session.ng_word_matcher.find_words(response_text)
+        if not new_words:
+            if stream is not None:
+                rest = scanner.finish()
+                if rest:
+                    await stream.send_delta(remove_newlines(rest))
             return remove_newlines(response_text)
 
+        logger.warning(response_text)
+        if stream is not None:
+            await stream.send_reset()
+        matched_words = list(dict.fromkeys(matched_words + new_words))
+        if retry_count == ng_word_max_retries:
+            break
+        NG_WORD_REGENERATIONS.inc()
+        # 打ち切った返答も accept で受け入れなかった返答も会話に残らないので、
+        # 元のメッセージにこれまでのNGワードをすべて添えて送り直す
+        content = build_ng_words_retry_content(matched_words)
+        logger.warning(content)
+        envelope_retry = envelope.with_request(content)
+
+    logger.error(f"NG words remained after {ng_word_max_retries} retries: {matched_words}")
+    NG_WORD_GIVE_UPS.inc()
+    return ""
+
+
+def make_reply_cache_key(json_data: dict[str, any], session: ChannelSession | None = None) -> tuple | None:
+    return get_session(session).reply_cache.make_key(
+        json_data.get("content", ""),
+        get_viewerStatus(json_data),
+        json_data.get("additionalRequests", []),
+    )
+
+
+def get_cached_reply(json_data: dict[str, any], key: tuple | None, session: ChannelSession | None = None) -> str | None:
+    nickname, display_name = json_data.get("nickname", ""), json_data.get("displayName", "")
+    return get_session(session).reply_cache.get(key, nickname, display_name)
+
+
+def put_cached_reply(
+    json_data: dict[str, any], key: tuple | None, reply: str, session: ChannelSession | None = None
+) -> None:
+    nickname, display_name = json_data.get("nickname", ""), json_data.get("displayName", "")
+    get_session(session).reply_cache.put(key, reply, nickname, display_name)
+
+
+async def reply_genai_chat(
+    json_data: dict[str, any],
+    stream: DeltaBroadcaster | None = None,
+    session: ChannelSession | None = None,
+    deadline: float | None = None,
+) -> tuple[str, int | None]:
+    session = get_session(session)
+    # 復元前の履歴に続けて話さないよう、起動直後のリクエストは復元が終わるまで待たせる
+    await session.ready.wait()
+    cache_key = make_reply_cache_key(json_data, session)
+    cached_reply = get_cached_reply(json_data, cache_key, session)
+    if cached_reply is not None:
+        # よくあるコメントにはモデルを呼ばずに以前の返答を使い回す
+        if stream is not None:
+            await stream.send_delta(cached_reply)
+        return cached_reply, None
+
+    await attach_story(json_data, session)
+    append_additional_request(json_data, g.ADDITIONAL_REQUESTS_PROMPT)
+    response_text = await send_message_genai_chat(json_data, stream, session, deadline)
+    # 待ち行列で直列化しているので、ここで読むエラーコードはこのリクエストのもの
+    error_code = session.genai_chat.last_error_code
+    if error_code is None:
+        put_cached_reply(json_data, cache_key, response_text, session)
+    return response_text, error_code
+
+
+def parse_batch_response(response_text: str) -> dict[str, str]:
+    text = response_text.strip()
+    # コードブロックで囲まれて返ってくる場合がある
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {str(k): v for k, v in data.items() if isinstance(v, str)}
+
+
+async def reply_genai_chat_batch(args_list: list[tuple]) -> list[tuple[str, int | None]]:
+    # 同じ待ち行列のリクエストはすべて同じチャンネルのもの (引数は reply_genai_chat と同じ並び)
+    session = get_session(args_list[0][2] if len(args_list[0]) > 2 else None)
+    await session.ready.wait()
+    # まとめた返答は全員に返すので、いちばん遅い期限まで待つ
+    deadlines = [args[3] for args in args_list if len(args) > 3]
+    deadline = None if not deadlines or None in deadlines else max(deadlines)
+    json_data_list = [args[0] for args in args_list]
+    cache_keys = [make_reply_cache_key(json_data, session) for json_data in json_data_list]
+    results: list[tuple[str, int | None] | None] = []
+    for json_data, cache_key in zip(json_data_list, cache_keys):
+        cached_reply = get_cached_reply(json_data, cache_key, session)
+        results.append((cached_reply, None) if cached_reply is not None else None)
+    # キャッシュから返せなかったコメントだけをまとめて送る
+    misses = [i for i, result in enumerate(results) if result is None]
+    if not misses:
+        return results
+
+    comments = []
+    saved = 0
+    for i in misses:
+        json_data_send = prepare_fields(json_data_list[i])
+        json_data_send["commentId"] = str(i)
+        # コメントごとの追加指示も定型のものはキーで送る (元の json_data は変更しない)
+        saved += compact_prompt(json_data_send)
+        comments.append(json_data_send)
+
+    localtime = datetime.datetime.now()
+    batch_json = {
+        "dateTime": localtime.isoformat(),
+        "comments": comments,
+        "additionalRequests": [g.ADDITIONAL_REQUESTS_PROMPT, BATCH_REQUEST],
+    }
+    await attach_story(batch_json, session)
+    saved += compact_prompt(batch_json)
+    # まとめて送るのは 1 件のメッセージなので、統計にも一度だけ数える
+    record_compaction(saved)
+    response_text = await session.genai_chat.send_message_by_json(batch_json, None, deadline)
+    error_code = session.genai_chat.last_error_code
+    if error_code is not None:
+        # 同じエラーメッセージを何度も流さないよう、先頭のリクエストにだけ返す
+        for n, i in enumerate(misses):
+            results[i] = (response_text if n == 0 else "", error_code)
+        return results
+
+    replies = parse_batch_response(response_text)
+    for i in misses:
+        reply = replies.get(str(i))
+        if reply is not None and not session.ng_word_matcher.find_words(reply):
+            reply = remove_newlines(reply.rstrip())
+            put_cached_reply(json_data_list[i], cache_keys[i], reply, session)
+            results[i] = (reply, None)
+        else:
+            # まとめて返答できなかったコメントは個別に処理する
+            results[i] = await reply_genai_chat(json_data_list[i], None, session, deadline)
+    return results
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     caption = "電脳娘フユカ(AIモデレーター Fuyuka API)"
     # startup
-    logger.info(caption + "スタートしました。", extra={'force': True})
+    # ポートをすぐに開けるよう、クライアントの準備と履歴の復元はバックグラウンドで行う
+    create_background_task(prepare_api_key_pool())
+    if not history_restored.is_set():
+        create_background_task(restore_history())
+    story_task = create_background_task(summarize_story())
+    relay_task = None
+    if session_store is not None and session_store.relays_messages:
+        relay_task = create_background_task(relay_broadcasts())
+    sweep_task = None
+    if channel_registry.idle_seconds > 0:
+        sweep_task = create_background_task(evict_idle_channels())
+    startup_timer.mark("server")
+    for phase, elapsed in startup_timer.phases:
+        STARTUP_PHASE_SECONDS.set(elapsed, phase)
+    logger.info(caption + "スタートしました。(%s)", startup_timer.format(), extra={'force': True})
     yield
     # shutdown
+    story_task.cancel()
+    if relay_task is not None:
+        relay_task.cancel()
+    if sweep_task is not None:
+        sweep_task.cancel()
+    await channel_registry.aclose()
+    await request_queue.stop()
+    await manager.aclose()
+    await asyncio.to_thread(genai_chat.flush_chat_history)
+    await api_key_pool.aclose()
+    if session_store is not None:
+        session_store.close()
     logger.info(caption + "終了しました。", extra={'force': True})
 
 
-app = FastAPI(lifespan=lifespan)
+router = APIRouter()
 
 
-@app.get("/")
+@router.get("/")
 async def chat_test() -> str:
-    return HTMLResponse(html)
+    return HTMLResponse(build_chat_test_html(fuyuka_port))
+
+
+def resolve_channel(channel: str) -> ChannelSession:
+    try:
+        return get_channel_session(channel)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    except ChannelLimitError as e:
+        logger.warning("Channel %s rejected: %s", channel, e)
+        raise HTTPException(status_code=503, detail="Too many channels")
+
+
+async def wait_for_disconnect(request: Request) -> None:
+    # 本文を読み終えた後に届くのは切断の通知だけ
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def wait_reply(future: asyncio.Future, request: Request) -> tuple[str, int | None] | None:
+    """返答を待つ。待っている間にクライアントが切断したらリクエストを取り消して None を返す。"""
+    disconnect = asyncio.ensure_future(wait_for_disconnect(request))
+    try:
+        await asyncio.wait([future, disconnect], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+    if not future.done():
+        future.cancel()
+        return None
+    return future.result()
 
 
-@app.post("/chat/{id}")
-async def chat_endpoint(id: str, chat: ChatModel) -> ChatResult:
+async def handle_chat(id: str, chat: ChatModel, session: ChannelSession, request: Request) -> ChatResult:
     json_data = jsonable_encoder(chat)
     clean_and_extract_alt_by_json(json_data)
 
     if json_data.get("noisy", False):
         # 例外: noisyの場合、flow_storyとしてバッファにためておく
-        await _flow_story(json_data)
+        _flow_story(json_data, session)
         return None
 
     response_json = {
         "id": id,
         "request": json_data,
     }
-    await manager.broadcast_json(response_json)
+    try:
+        future = submit_reply(json_data, None, session)
+    except RequestQueueFullError as e:
+        logger.warning("Client #%s rejected: %s", id, e)
+        raise HTTPException(status_code=503, detail="Too many requests")
+    await session.manager.broadcast_json(response_json)
 
-    await flow_story_genai_chat()
-    append_additional_request(json_data, g.ADDITIONAL_REQUESTS_PROMPT)
-    response_text = await send_message_genai_chat(json_data)
+    try:
+        reply = await wait_reply(future, request)
+    except RequestDroppedError as e:
+        logger.info("Client #%s dropped: %s", id, e)
+        reply = "", 503
+    if reply is None:
+        logger.info("Client #%s disconnected before the reply", id)
+        # 返答を受け取る相手がいないので、ステータスだけ記録に残す
+        return Response(status_code=499)
+    response_text, error_code = reply
 
     response_json["response"] = response_text
-    response_json["errorCode"] = genai_chat.last_error_code
-    await manager.broadcast_json(response_json)
+    response_json["errorCode"] = error_code
+    await session.manager.broadcast_json(response_json)
     return JSONResponse(response_json)
 
 
-@app.websocket("/chat/{id}")
-async def chat_ws(websocket: WebSocket, id: str) -> None:
+@router.post("/chat/{id}")
+async def chat_endpoint(id: str, chat: ChatModel, request: Request) -> ChatResult:
+    return await handle_chat(id, chat, get_session(), request)
+
+
+@router.post("/channels/{channel}/chat/{id}")
+async def channel_chat_endpoint(channel: str, id: str, chat: ChatModel, request: Request) -> ChatResult:
+    return await handle_chat(id, chat, resolve_channel(channel), request)
+
+
+async def respond_chat_ws(
+    response_json: dict[str, any],
+    future: asyncio.Future,
+    stream: DeltaBroadcaster | None = None,
+    session: ChannelSession | None = None,
+) -> None:
+    manager = get_session(session).manager
+    try:
+        await manager.broadcast_json(response_json)
+
+        try:
+            response_text, error_code = await future
+        except RequestDroppedError as e:
+            logger.info("Client #%s dropped: %s", response_json["id"], e)
+            # 表示中のコメントを片付けられるよう、返答しなかったことを知らせる
+            response_text, error_code = "", 503
+            if stream is None:
+                response_json["response"] = response_text
+                response_json["errorCode"] = error_code
+                await manager.broadcast_json(response_json)
+                return
+        if stream is not None:
+            # ストリーミングの場合は、空でも終わりを知らせる最後のフレームを送る
+            response_json["type"] = "final"
+            response_json["seq"] = stream.next_seq()
+        elif not response_text:
+            return
+
+        response_json["response"] = response_text
+        response_json["errorCode"] = error_code
+        await manager.broadcast_json(response_json)
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+
+
+async def handle_chat_ws(websocket: WebSocket, id: str, session: ChannelSession) -> None:
+    manager = session.manager
     await manager.connect(websocket)
+    # 切断したら取り消す、このクライアントの返答待ちのリクエスト
+    pending: set[asyncio.Future] = set()
     try:
         while True:
             json_data = await websocket.receive_json()
+            # stream: true なら返答を差分フレームで少しずつ送る
+            is_stream = json_data.pop("stream", stream_default)
             clean_and_extract_alt_by_json(json_data)
             if json_data.get("noisy", False):
                 # 例外: noisyの場合、flow_storyとしてバッファにためておく
-                asyncio.create_task(_flow_story(json_data))
+                _flow_story(json_data, session)
                 continue
 
             response_json = {
                 "id": id,
                 "request": json_data,
             }
-            await manager.broadcast_json(response_json)
-
-            await flow_story_genai_chat()
-            append_additional_request(json_data, g.ADDITIONAL_REQUESTS_PROMPT)
-            response_text = await send_message_genai_chat(json_data)
-            if not response_text:
+            stream = DeltaBroadcaster(id, manager) if is_stream else None
+            try:
+                future = submit_reply(json_data, stream, session)
+            except RequestQueueFullError as e:
+                # 過負荷の場合は待たせずに送信元へだけ返す
+                logger.warning("Client #%s rejected: %s", id, e)
+                response_json["errorCode"] = 503
+                await manager.send_personal_json(response_json, websocket)
                 continue
 
-            response_json["response"] = response_text
-            response_json["errorCode"] = genai_chat.last_error_code
-            await manager.broadcast_json(response_json)
+            pending.add(future)
+            future.add_done_callback(pending.discard)
+            # 返答を待たずに次のコメントを受け付け、混雑時はまとめて処理できるようにする
+            create_background_task(respond_chat_ws(response_json, future, stream, session))
     except WebSocketDisconnect:
-        logger.info(f"Client #{id} disconnected normally")
+        logger.info("Client #%s disconnected normally", id)
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
     finally:
         # 正常終了でも異常終了でも必ずリストから削除
         manager.disconnect(websocket)
-        logger.info(f"Cleanup for Client #{id} completed")
+        for future in list(pending):
+            # 送信元がいなくなったリクエストにモデルを使わせない
+            future.cancel()
+        logger.info("Cleanup for Client #%s completed", id)
+
+
+@router.websocket("/chat/{id}")
+async def chat_ws(websocket: WebSocket, id: str) -> None:
+    await handle_chat_ws(websocket, id, get_session())
+
+
+@router.websocket("/channels/{channel}/chat/{id}")
+async def channel_chat_ws(websocket: WebSocket, channel: str, id: str) -> None:
+    try:
+        session = get_channel_session(channel)
+    except (ValueError, ChannelLimitError) as e:
+        logger.warning("Client #%s rejected: %s", id, e)
+        await websocket.close(code=1008)
+        return
+    await handle_chat_ws(websocket, id, session)
+
+
+@router.get("/pool_stats")
+async def pool_stats() -> dict:
+    return JSONResponse(api_key_pool.get_stats())
 
 
-@app.get("/reset_chat")
+@router.get("/metrics")
+async def metrics() -> str:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def sum_cache_stats(stats: list[dict[str, any]]) -> dict[str, any]:
+    total = {
+        "enabled": any(s["enabled"] for s in stats),
+        **{key: sum(s[key] for s in stats) for key in ("size", "hits", "misses", "expired", "evictions")},
+    }
+    lookups = total["hits"] + total["misses"]
+    total["hitRate"] = total["hits"] / lookups if lookups else 0.0
+    return total
+
+
+@router.get("/cache_stats")
+async def cache_stats(channel: str | None = None) -> dict:
+    """channel を指定すればそのチャンネルの、省略すれば開いているすべてのチャンネルを合わせた統計を返す。"""
+    if channel is not None:
+        if channel != DEFAULT_CHANNEL and channel not in channel_registry:
+            raise HTTPException(status_code=404, detail="Channel not found")
+        return JSONResponse(get_channel_session(channel).reply_cache.get_stats())
+    stats = {DEFAULT_CHANNEL: reply_cache.get_stats()}
+    for name, session in channel_registry.sessions.items():
+        stats[name] = session.reply_cache.get_stats()
+    return JSONResponse({**sum_cache_stats(list(stats.values())), "channels": stats})
+
+
+@router.get("/prompt_stats")
+async def prompt_stats() -> dict:
+    # prompt_compactor はすべてのチャンネルで共有しているので、すべてのチャンネルを合わせた統計になる
+    return JSONResponse(prompt_compactor.get_stats())
+
+
+async def reset_session(session: ChannelSession) -> None:
+    session.story_buffer.clear()
+    session.reply_cache.clear()
+    await session.genai_chat.run_store(session.genai_chat.reset_chat_history)
+
+
+@router.get("/reset_chat")
 async def reset_chat() -> Result:
-    g.story_buffer = ""
-    genai_chat.reset_chat_history()
+    await reset_session(get_session())
     return JSONResponse({"result": True})
 
 
+@router.get("/channels/{channel}/reset_chat")
+async def reset_channel_chat(channel: str) -> Result:
+    if channel != DEFAULT_CHANNEL and channel not in channel_registry:
+        # 使われていないチャンネルをリセットのためだけに作らない
+        raise HTTPException(status_code=404, detail="Channel not found")
+    await reset_session(get_channel_session(channel))
+    return JSONResponse({"result": True})
+
+
+
+def configure_logging(config: dict[str, any]) -> None:
+    setup_app_logging(
+        config["logLevel"],
+        log_file_path=f"{g.app_name}.log",
+        use_queue=config.get("logQueue", True),
+        max_bytes=config.get("logMaxBytes", 0),
+        when=config.get("logRotateWhen", ""),
+        backup_count=config.get("logBackupCount", 5),
+        compress=config.get("logCompress", True),
+    )
+
+
+def create_app(
+    config: dict[str, any] | None = None,
+    *,
+    restore: bool = False,
+    store: SessionStore | None = None,
+    key_pool: ApiKeyPool | None = None,
+    chat: GenAIInteractions | None = None,
+) -> FastAPI:
+    """
+    設定からアプリを作る。
+
+    config を省略すると設定ファイルを読みます。store・key_pool・chat を渡すと、設定から作る代わりにそれを使います。
+    restore が True なら、前回の会話履歴をポートを開いてからバックグラウンドで復元します。
+
+    作ったものはモジュールの変数に入れ、ルートのハンドラーはそれを読みます。
+    そのため使えるアプリは1プロセスに1つだけで、もう一度呼ぶと前に作ったアプリも新しい状態を使います。
+    複数のアプリが必要なら、ワーカーのプロセスを分けてください (create_worker_app)。
+    """
+    global ng_word_matcher, session_store, reply_cache, prompt_compactor, story_buffer, api_key_pool, genai_chat
+    global request_queue, manager, channel_registry, history_restored, restore_on_startup
+    global fuyuka_port, queue_size, batch_threshold, batch_max_size, stream_default
+    global ng_word_max_retries, stale_comment_seconds, request_timeout_seconds
+
+    g.config = read_config() if config is None else config
+    conf_api = g.config["fuyukaApi"]
+    fuyuka_port = conf_api["port"]
+    queue_size = conf_api.get("queueSize", 16)
+    batch_threshold = conf_api.get("batchThreshold", 3)
+    batch_max_size = conf_api.get("batchMaxSize", 10)
+    stream_default = conf_api.get("stream", False)
+    ng_word_max_retries = conf_api.get("ngWordMaxRetries", 3)
+    stale_comment_seconds = conf_api.get("staleCommentSeconds", 30)
+    request_timeout_seconds = conf_api.get("requestTimeoutSeconds", 30)
+
+    g.ADDITIONAL_REQUESTS_PROMPT = read_text("prompts/additional_requests_prompt.txt")
+    prompt_compactor = create_prompt_compactor(conf_api.get("compactPrompts", True))
+    # 定型の追加指示はシステム指示に一度だけ書き、各メッセージではキーで参照させる
+    g.BASE_PROMPT = prompt_compactor.system_instruction(read_text("prompts/base_prompt.txt"))
+    g.ERROR_MESSAGE = read_text("messages/error_message.txt")
+    g.STOP_CANDIDATE_MESSAGE = read_text("messages/stop_candidate_message.txt")
+    g.RESOURCE_EXHAUSTED_MESSAGE = read_text("messages/resource_exhausted_message.txt")
+    g.TIMEOUT_MESSAGE = read_text("messages/timeout_message.txt")
+
+    set_encoder(conf_api.get("jsonEncoder", "auto"))
+    ng_word_matcher = NgWordMatcher()
+    if store is None:
+        store = create_session_store()
+        if store is not None and not restore:
+            # 続きでなければ、前回の会話を消しておく
+            store.clear_all()
+    session_store = store
+    reply_cache = ReplyCache.from_config(conf_api)
+    story_buffer = create_story_buffer()
+    api_key_pool = key_pool if key_pool is not None else ApiKeyPool.from_config(g.config["google"], session_store)
+    # genai_chat = GenAIChat(api_key_pool)
+    genai_chat = chat if chat is not None else GenAIInteractions(api_key_pool, store=session_store)
+    # genai_chat の呼び出しはすべてこの待ち行列を通して直列化する
+    request_queue = RequestQueue(
+        queue_size, batch_threshold, batch_max_size, create_session_lock(DEFAULT_CHANNEL, genai_chat)
+    )
+    manager = create_connection_manager()
+    channel_registry = ChannelRegistry(
+        create_channel_session, conf_api.get("maxChannels", 32), conf_api.get("channelIdleSeconds", 600)
+    )
+
+    restore_on_startup = restore
+    history_restored = asyncio.Event()
+    if not restore:
+        history_restored.set()
+
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(router)
+    startup_timer.mark("app")
+    return app
+
+
+def create_worker_app() -> FastAPI:
+    """複数のワーカーで起動したときに、各ワーカーが呼ぶ。会話の状態は store から読み込む。"""
+    config = read_config()
+    configure_logging(config)
+    return create_app(config, restore=True)
+
+
+def main() -> None:
+    import uvicorn
+
+    startup_timer.mark("import")
+    startup_mode = parse_startup_mode(sys.argv[1:], os.environ)
+    if startup_mode is not None:
+        # --continue / --fresh か FUYUKA_STARTUP が指定されていれば確認せずに起動する
+        is_continue = (startup_mode == STARTUP_CONTINUE)
+    else:
+        res = input_with_timeout("前回の続きですか？(y/n) [10秒以内に未入力なら 'n']: ", timeout=10)
+        is_continue = (res == "y")
+    startup_timer.mark("prompt")
+
+    config = read_config()
+    startup_timer.mark("config")
+    configure_logging(config)
+    startup_timer.mark("logging")
+
+    port = config["fuyukaApi"]["port"]
+    workers = config["fuyukaApi"].get("workers", 1)
+    if workers > 1 and config["fuyukaApi"].get("sessionStore") == "sqlite":
+        if not is_continue:
+            # ワーカーが読み込む前に前回の会話を消しておく
+            g.config = config
+            store = create_session_store()
+            store.clear_all()
+            store.close()
+        uvicorn.run("main:create_worker_app", factory=True, host="0.0.0.0", port=port, workers=workers)
+    else:
+        if workers > 1:
+            logger.warning('workers > 1 requires sessionStore "sqlite". Running with a single worker.')
+        uvicorn.run(create_app(config, restore=is_continue), host="0.0.0.0", port=port)
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=fuyuka_port)
+    main()
@@ -0,0 +1,163 @@
+import bisect
+import math
+import time
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    """メトリクスをまとめ、Prometheus のテキスト形式で出力する。"""
+
+    def __init__(self):
+        self.metrics: list["Metric"] = []
+
+    def register(self, metric: "Metric") -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    """
+    メトリクスの基底クラス。
+
+    記録時は辞書の値を更新するだけにして、文字列への変換は出力するときにまとめて行います。
+    ラベルの値は記録時に位置引数で渡します。
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry | None = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple[str, ...], float] = {}
+        self.function: Callable[[], float] | None = None
+        if registry is not None:
+            registry.register(self)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """出力するときに function を呼んで値を求める。記録のコストがかからない。"""
+        self.function = function
+
+    def get(self, *labelvalues: str) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.values.get(labelvalues, 0.0)
+
+    def format_labels(self, labelvalues: tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(self.labelnames, labelvalues)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {_format_value(self.function())}"]
+        return [
+            f"{self.name}{self.format_labels(labelvalues)} {_format_value(value)}"
+            for labelvalues, value in self.values.items()
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0.0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        registry: Registry | None = REGISTRY,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        # ラベルの値ごとの [各バケットの件数..., +Infの件数], 合計
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        counts = self.counts.get(labelvalues)
+        if counts is None:
+            counts = self.counts[labelvalues] = [0] * (len(self.buckets) + 1)
+            self.sums[labelvalues] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labelvalues] += value
+
+    def time(self, *labelvalues: str) -> "Timer":
+        return Timer(self, labelvalues)
+
+    def get_count(self, *labelvalues: str) -> int:
+        return sum(self.counts.get(labelvalues, ()))
+
+    def render(self) -> list[str]:
+        lines = []
+        for labelvalues, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{self.format_labels(labelvalues, le)} {cumulative}")
+            labels = self.format_labels(labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(self.sums[labelvalues])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Timer:
+    """with 文で囲んだ処理の経過時間をヒストグラムに記録する。"""
+
+    def __init__(self, histogram: Histogram, labelvalues: tuple[str, ...]):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+        self.start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
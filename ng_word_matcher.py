@@ -0,0 +1,132 @@
+import logging
+import os
+import re
+
+from config_helper import resolve_config_path
+from ng_words_helper import read_ng_words
+
+logger = logging.getLogger(__name__)
+
+
+class NgWordMatcher:
+    """
+    NGワードの判定器。
+
+    ng_words.json は初回とファイル更新時(mtime変化)にだけ読み込み、
+    エスケープ済みの単一パターンにコンパイルして使い回します。
+    """
+
+    def __init__(self, name: str | None = "ng_words.json", fallback_name: str | None = None):
+        self.name = name
+        # name のファイルがなければこちらを読む (チャンネル別のNGワードがない場合など)
+        self.fallback_name = fallback_name
+        self.loaded = False
+        self.path = None
+        self.mtime_ns = None
+        self.words: list[str] = []
+        self.pattern: re.Pattern | None = None
+        self.max_length = 0  # 最長のNGワードの文字数
+
+    @classmethod
+    def from_words(cls, words: list[str]) -> "NgWordMatcher":
+        """ファイルを参照せず、指定したNGワードだけで判定する。"""
+        matcher = cls(name=None)
+        matcher.set_words(words)
+        return matcher
+
+    def set_words(self, words: list[str]) -> None:
+        # 空文字はどこにでもマッチしてしまうため除外する
+        self.words = [w for w in dict.fromkeys(words) if w]
+        self.max_length = max((len(w) for w in self.words), default=0)
+        if not self.words:
+            self.pattern = None
+            return
+        # 長い語を優先してマッチさせる（「初コメ」と「初」など）
+        escaped = [re.escape(w) for w in sorted(self.words, key=len, reverse=True)]
+        self.pattern = re.compile("|".join(escaped), re.IGNORECASE)
+
+    def reload_if_modified(self) -> bool:
+        """NGワードファイルが更新されていれば読み直す。読み直した場合 True を返す。"""
+        if self.name is None:
+            return False
+
+        path = resolve_config_path(self.name)
+        if not path and self.fallback_name is not None:
+            path = resolve_config_path(self.fallback_name)
+        mtime_ns = None
+        if path:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                path = None
+
+        if self.loaded and path == self.path and mtime_ns == self.mtime_ns:
+            return False
+
+        self.loaded = True
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.set_words(read_ng_words(path) if path else [])
+        logger.info(f"NG words loaded: {len(self.words)} words")
+        return True
+
+    def find_matches(self, text: str) -> list[tuple[int, int, str]]:
+        """マッチしたNGワードの (開始位置, 終了位置, 文字列) のリストを返す。"""
+        self.reload_if_modified()
+        if not self.pattern or not text:
+            return []
+        return [(m.start(), m.end(), m.group()) for m in self.pattern.finditer(text)]
+
+    def find_words(self, text: str) -> list[str]:
+        """マッチしたNGワードを重複なしで出現順に返す。"""
+        return list(dict.fromkeys(word for _, _, word in self.find_matches(text)))
+
+    def scanner(self) -> "NgWordScanner":
+        """ストリーミングで届くテキストを少しずつ判定する NgWordScanner を返す。"""
+        self.reload_if_modified()
+        return NgWordScanner(self.pattern, self.max_length)
+
+
+class NgWordScanner:
+    """
+    チャンクに分かれて届くテキストのNGワード判定器。
+
+    チャンクの境目をまたぐNGワードを見逃さないよう、
+    最長のNGワードより1文字短い分だけ末尾を保留し、次のチャンクと合わせて判定します。
+    判定済みの部分は読み直さないので、全体の判定量はテキストの長さに比例します。
+    """
+
+    def __init__(self, pattern: re.Pattern | None, max_length: int):
+        self.pattern = pattern
+        self.holdback = max(max_length - 1, 0)
+        self.text = ""
+        self.released = 0  # NGワードを含まないと確定して返した文字数
+        self.matched_words: list[str] = []
+
+    def feed(self, chunk: str) -> str:
+        """
+        チャンクを追加し、NGワードを含まないと確定した部分を返す。
+
+        NGワードが見つかった場合は matched_words に追加し、空文字を返します。
+        """
+        self.text += chunk
+        if self.matched_words:
+            return ""
+        if self.pattern is not None:
+            # 確定済みの部分より前から始まるNGワードは、前回までの判定で見つかっている
+            words = [m.group() for m in self.pattern.finditer(self.text, self.released)]
+            if words:
+                self.matched_words = list(dict.fromkeys(words))
+                return ""
+        end = max(len(self.text) - self.holdback, self.released)
+        released_text = self.text[self.released:end]
+        self.released = end
+        return released_text
+
+    def finish(self) -> str:
+        """テキストが最後まで届いたら、保留していた残りを返す。"""
+        if self.matched_words:
+            return ""
+        released_text = self.text[self.released:]
+        self.released = len(self.text)
+        return released_text
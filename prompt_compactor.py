@@ -0,0 +1,128 @@
+import json
+import logging
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+SAVED_BYTES = Histogram(
+    "fuyuka_prompt_compaction_saved_bytes",
+    "Input bytes saved per message by replacing fixed additional requests with their keys, "
+    "net of the instructions added to the system instruction.",
+    buckets=(0, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+
+
+def _encoded_size(text: str) -> int:
+    # send_message_by_json と同じく、JSON の文字列として送ったときのバイト数
+    return len(json.dumps(text, ensure_ascii=False).encode("utf-8"))
+
+
+class PromptCompactor:
+    """
+    毎回同じ追加指示を、システム指示に一度だけ書いてキーで参照させる。
+
+    previous_interaction_id で会話をつなぐと、毎回送った追加指示はそのまま会話に残り、
+    ターンごとに入力トークンとして数えられます。定型の指示はシステム指示に載せ、
+    各メッセージの additionalRequests では `<キー>` で参照するだけにします。
+    """
+
+    def __init__(self, instructions: dict[str, str], enabled: bool = True):
+        # 空の指示は送る意味がないので登録しない
+        self.instructions = {key: text.strip() for key, text in instructions.items() if text and text.strip()}
+        self.keys = {text: key for key, text in self.instructions.items()}
+        self.enabled = enabled
+        # 統計情報
+        self.requests = 0
+        self.saved_bytes = 0
+        # システム指示に書き足したバイト数。システム指示は毎回送るので、メッセージごとにこの分だけ増える
+        self.instruction_bytes = 0
+
+    @staticmethod
+    def ref(key: str) -> str:
+        return f"<{key}>"
+
+    def system_instruction(self, base_prompt: str) -> str:
+        """base_prompt の後ろに、キーで参照する定型の追加指示を書き足す。"""
+        if not self.enabled or not self.instructions:
+            return base_prompt
+        lines = [
+            base_prompt.rstrip(),
+            "",
+            "# 定型の追加指示",
+            "`additionalRequests` の `<キー>` は、以下の同じキーの指示を表す。書かれている場合だけ従う。",
+        ]
+        for key, text in self.instructions.items():
+            lines.extend(["", f"## {self.ref(key)}", text])
+        instruction = "\n".join(lines)
+        self.instruction_bytes = len(instruction.encode("utf-8")) - len(base_prompt.encode("utf-8"))
+        return instruction
+
+    def compact(self, json_data: dict[str, any]) -> int:
+        """
+        json_data の additionalRequests のうち、定型の指示をキーに置き換える。
+        統計には数えないので、送るメッセージごとに record で記録する。
+
+        Returns:
+            減った入力のバイト数
+        """
+        requests = json_data.get("additionalRequests")
+        if not self.enabled or not requests:
+            return 0
+        json_data["additionalRequests"], saved = self.compact_requests(requests)
+        return saved
+
+    def compact_requests(self, requests: list[str]) -> tuple[list[str], int]:
+        """
+        追加指示のうち、定型の指示をキーに置き換えたリストを返す。requests は変更しない。
+
+        Returns:
+            (置き換えた追加指示, 減った入力のバイト数)
+        """
+        if not self.enabled or not requests:
+            return list(requests), 0
+        saved = 0
+        compacted = []
+        for text in requests:
+            if not isinstance(text, str):
+                compacted.append(text)
+                continue
+            stripped = text.strip()
+            if not stripped:
+                # 空の指示は送らない (区切りのカンマの分も減る)
+                saved += _encoded_size(text) + 1
+                continue
+            key = self.keys.get(stripped)
+            if key is None:
+                compacted.append(text)
+                continue
+            ref = self.ref(key)
+            saved += _encoded_size(text) - _encoded_size(ref)
+            compacted.append(ref)
+        return compacted, saved
+
+    def record(self, saved: int) -> None:
+        """
+        送るメッセージ 1 件分の減ったバイト数を記録する。
+
+        まとめて送るコメントのように、1 件のメッセージで何度も compact したときは合計して一度だけ記録する。
+        """
+        if not self.enabled:
+            return
+        self.requests += 1
+        self.saved_bytes += saved
+        SAVED_BYTES.observe(saved - self.instruction_bytes)
+        logger.debug("Prompt compaction saved %d bytes (net %d)", saved, saved - self.instruction_bytes)
+
+    def get_stats(self) -> dict[str, any]:
+        # 追加指示で減った分から、毎回送るシステム指示で増えた分を引いたものが実際に減った入力
+        net_saved_bytes = self.saved_bytes - self.instruction_bytes * self.requests
+        return {
+            "enabled": self.enabled,
+            "instructions": len(self.instructions),
+            "instructionBytes": self.instruction_bytes,
+            "requests": self.requests,
+            "savedBytes": self.saved_bytes,
+            "netSavedBytes": net_saved_bytes,
+            "netSavedBytesPerRequest": net_saved_bytes / self.requests if self.requests else 0.0,
+        }
@@ -0,0 +1,119 @@
+import collections
+import re
+import time
+import unicodedata
+
+# 返答中の呼び名を差し替えるための目印 (コメントに含まれることのない文字で囲む)
+NICKNAME_PLACEHOLDER = "\x00nickname\x00"
+DISPLAY_NAME_PLACEHOLDER = "\x00displayName\x00"
+
+_REPEAT_PATTERN = re.compile(r"(.)\1{3,}")
+
+
+def normalize_content(content: str) -> str:
+    """
+    表記ゆれを吸収したキャッシュ用の文字列を返す。
+
+    全角半角と大文字小文字をそろえ、空白と記号を除き、
+    4文字以上の同じ文字の連続は3文字に詰めます (「8888」→「888」)。
+    """
+    text = unicodedata.normalize("NFKC", content).lower()
+    text = "".join(c for c in text if not c.isspace() and unicodedata.category(c)[0] not in ("P", "S"))
+    return _REPEAT_PATTERN.sub(r"\1\1\1", text)
+
+
+class ReplyCache:
+    """
+    挨拶や絵文字の連投など、よくあるコメントへの返答を使い回すキャッシュ。
+
+    正規化したコメント・viewerStatus・追加リクエストをキーにして、
+    最大 max_size 件を ttl 秒だけ保持します (LRUで追い出し)。
+    返答中の呼び名はテンプレート化しておき、取り出すときに相手の呼び名へ差し替えます。
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 300.0, max_content_length: int = 20):
+        # 0 以下なら無効
+        self.max_size = max_size
+        self.ttl = ttl
+        # 長いコメントは質問などの可能性が高いので対象にしない
+        self.max_content_length = max_content_length
+        self.entries: collections.OrderedDict[tuple, tuple[float, str]] = collections.OrderedDict()
+        # 統計情報
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, conf: dict[str, any]) -> "ReplyCache":
+        return cls(
+            conf.get("replyCacheSize", 0),
+            conf.get("replyCacheTtlSeconds", 300.0),
+            conf.get("replyCacheMaxContentLength", 20),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def make_key(self, content: str, viewer_status: str, additional_requests: list[str]) -> tuple | None:
+        """キャッシュのキーを返す。キャッシュの対象外なら None"""
+        if not self.enabled:
+            return None
+        normalized = normalize_content(content)
+        if not normalized or len(normalized) > self.max_content_length:
+            return None
+        return normalized, viewer_status, tuple(additional_requests)
+
+    @staticmethod
+    def _names(nickname: str, display_name: str) -> list[tuple[str, str]]:
+        # 1文字の名前は本文と区別できないので差し替えない
+        names = [(nickname, NICKNAME_PLACEHOLDER), (display_name, DISPLAY_NAME_PLACEHOLDER)]
+        return sorted(((n, p) for n, p in names if n and len(n) > 1), key=lambda x: len(x[0]), reverse=True)
+
+    def get(self, key: tuple | None, nickname: str = "", display_name: str = "") -> str | None:
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, template = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return template.replace(NICKNAME_PLACEHOLDER, nickname).replace(DISPLAY_NAME_PLACEHOLDER, display_name)
+
+    def put(self, key: tuple | None, reply: str, nickname: str = "", display_name: str = "") -> None:
+        if key is None or not reply:
+            return
+        template = reply
+        for name, placeholder in self._names(nickname, display_name):
+            template = template.replace(name, placeholder)
+        self.entries[key] = (time.monotonic() + self.ttl, template)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def get_stats(self) -> dict[str, any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,277 @@
+import asyncio
+import collections
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class RequestQueueFullError(Exception):
+    """待ち行列が満杯でリクエストを受け付けられない場合に送出されます。"""
+
+
+class RequestDroppedError(Exception):
+    """受け付けたリクエストが、処理される前に待ち行列から捨てられた場合に送出されます。"""
+
+
+@dataclass
+class QueuedRequest:
+    future: asyncio.Future
+    func: Callable[..., Awaitable[Any]]
+    args: tuple
+    # 同じ batch_func を持つリクエストは、混雑時にまとめて1回で処理できる
+    batch_func: Callable[[list[tuple]], Awaitable[list[Any]]] | None = None
+    # 大きいほど先に処理する
+    priority: int = 0
+    # この時刻 (time.monotonic) までに処理を始められなければ捨てる
+    deadline: float | None = None
+
+    def is_expired(self, now: float) -> bool:
+        return self.deadline is not None and self.deadline <= now
+
+
+class RequestQueue:
+    """
+    モデル呼び出しを到着順に1件ずつ処理する待ち行列。
+
+    GenAIInteractions は interaction_id や履歴を共有しているため、
+    同時に呼び出すと会話の連鎖が分岐してしまいます。
+    ここで直列化し、結果はリクエストごとの Future で呼び出し元へ返します。
+
+    batch_threshold より多くのまとめられるリクエストが待っている場合は、
+    最大 batch_max_size 件を batch_func に渡して1回で処理します。
+
+    priority の大きいリクエストは先に処理し、同じ priority の中では到着順に処理します。
+    満杯のときに来たリクエストは、それより priority の小さいリクエストがあれば入れ替わります。
+    max_wait を指定したリクエストは、その秒数のうちに処理を始められなければ捨てます。
+
+    処理中のリクエストの Future がすべて取り消されたら、その処理も取り消します。
+
+    lock を指定すると、各リクエストを lock() で囲んで処理します。
+    ほかのプロセスと会話を共有しているときに、プロセスをまたいで直列化するために使います。
+    ロックを取れなかったリクエストの Future は、その例外で終わります。
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 16,
+        batch_threshold: int = 0,
+        batch_max_size: int = 10,
+        lock: Callable[[], AsyncContextManager] | None = None,
+    ):
+        # 0 以下なら無制限
+        self.maxsize = maxsize
+        # 0 以下ならまとめ処理をしない
+        self.batch_threshold = batch_threshold
+        self.batch_max_size = batch_max_size
+        self.lock = lock
+        self.pending: collections.deque[QueuedRequest] = collections.deque()
+        self.wakeup: asyncio.Event | None = None
+        self.worker_task: asyncio.Task | None = None
+        self.current_futures: list[asyncio.Future] = []
+        self.current_job: asyncio.Task | None = None
+        # 統計情報
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def is_full(self) -> bool:
+        return 0 < self.maxsize <= len(self.pending)
+
+    def is_idle(self) -> bool:
+        return not self.pending and self.current_job is None
+
+    def ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        task = self.worker_task
+        if task is not None and not task.done() and task.get_loop() is loop:
+            return
+        if task is not None and task.get_loop() is not loop:
+            # 別のイベントループに紐づいた待ち行列は引き継げない
+            self.pending.clear()
+        self.wakeup = asyncio.Event()
+        self.worker_task = loop.create_task(self._worker())
+
+    def submit_nowait(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        batch_func: Callable[[list[tuple]], Awaitable[list[Any]]] | None = None,
+        priority: int = 0,
+        max_wait: float | None = None,
+    ) -> asyncio.Future:
+        """
+        リクエストを待ち行列に積み、結果を受け取る Future を返します。
+
+        Future は、処理される前に捨てられると RequestDroppedError になります。
+
+        Raises:
+            RequestQueueFullError: 待ち行列が満杯で、priority の小さいリクエストもない場合
+        """
+        self.ensure_worker()
+        if self.is_full() and not self._evict(priority):
+            raise RequestQueueFullError(f"Request queue is full ({len(self.pending)}/{self.maxsize})")
+        future = asyncio.get_running_loop().create_future()
+        deadline = time.monotonic() + max_wait if max_wait is not None and max_wait > 0 else None
+        self._insert(QueuedRequest(future, func, args, batch_func, priority, deadline))
+        self.wakeup.set()
+        return future
+
+    def _insert(self, request: QueuedRequest) -> None:
+        # ほとんどは同じ priority なので、後ろから探して挿入する位置を決める
+        index = len(self.pending)
+        while index > 0 and self.pending[index - 1].priority < request.priority:
+            index -= 1
+        self.pending.insert(index, request)
+
+    def _evict(self, priority: int) -> bool:
+        """priority より小さいリクエストのうち最も後ろのものを捨てる。捨てられなければ False"""
+        victim = self.pending[-1] if self.pending else None
+        if victim is None or victim.priority >= priority:
+            return False
+        self.pending.pop()
+        self.evicted += 1
+        self._drop(victim, "Evicted by a higher priority request")
+        return True
+
+    def _drop(self, request: QueuedRequest, reason: str) -> None:
+        if not request.future.done():
+            request.future.set_exception(RequestDroppedError(reason))
+
+    async def submit(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        return await self.submit_nowait(func, *args, **kwargs)
+
+    async def stop(self) -> None:
+        task = self.worker_task
+        current_futures = self.current_futures
+        current_job = self.current_job
+        self.worker_task = None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if current_job is not None:
+            current_job.cancel()
+        for future in current_futures:
+            future.cancel()
+        while self.pending:
+            self.pending.popleft().future.cancel()
+
+    def _take_batch(self, first: QueuedRequest) -> list[QueuedRequest]:
+        """first と同じ batch_func を持つ待ちリクエストを、混雑していれば取り出す。"""
+        if first.batch_func is None or self.batch_threshold <= 0:
+            return [first]
+
+        now = time.monotonic()
+        same = [
+            r
+            for r in self.pending
+            if r.batch_func is first.batch_func and not r.future.done() and not r.is_expired(now)
+        ]
+        # first 自身も待っていた1件として数える
+        if len(same) + 1 <= self.batch_threshold:
+            return [first]
+
+        batch = [first] + same[: max(self.batch_max_size - 1, 0)]
+        for request in batch[1:]:
+            self.pending.remove(request)
+        return batch
+
+    async def _run(self, coro: Awaitable[Any], futures: list[asyncio.Future]) -> asyncio.Task:
+        # 別タスクで実行し、例外のトレースバックに待ち行列のフレームを含めない
+        job = asyncio.ensure_future(coro)
+
+        def cancel_if_abandoned(_: asyncio.Future) -> None:
+            # 待っている呼び出し元がいなくなったら処理を取り消し、モデルを次のリクエストに空ける
+            if not job.done() and all(f.cancelled() for f in futures):
+                job.cancel()
+
+        for future in futures:
+            future.add_done_callback(cancel_if_abandoned)
+        self.current_futures = futures
+        self.current_job = job
+        try:
+            await asyncio.wait([job])
+        finally:
+            self.current_futures = []
+            self.current_job = None
+        return job
+
+    async def _run_batch(self, batch: list[QueuedRequest], futures: list[asyncio.Future]) -> asyncio.Task:
+        request = batch[0]
+        if len(batch) == 1:
+            return await self._run(request.func(*request.args), futures)
+        logger.info("Processing %d requests as one batch", len(batch))
+        return await self._run(request.batch_func([r.args for r in batch]), futures)
+
+    async def _run_locked(self, batch: list[QueuedRequest], futures: list[asyncio.Future]) -> asyncio.Task:
+        job = None
+        try:
+            async with self.lock():
+                job = await self._run_batch(batch, futures)
+        except Exception as e:
+            if job is None:
+                raise
+            # 処理は終わっているので、ロックを返せなかったことだけ記録する
+            logger.error(f"Failed to release the request queue lock: {e}")
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            request = self.pending.popleft()
+            if request.future.done():
+                # 呼び出し元がすでに待つのをやめている
+                continue
+            if request.is_expired(time.monotonic()):
+                # 待たせすぎたリクエストは、いまさら返答しても意味がない
+                self.expired += 1
+                self._drop(request, "Waited too long in the request queue")
+                continue
+
+            batch = self._take_batch(request)
+            futures = [r.future for r in batch]
+            if self.lock is None:
+                job = await self._run_batch(batch, futures)
+            else:
+                # ロックも別タスクで取り、例外のトレースバックに待ち行列のフレームを含めない
+                locked = asyncio.ensure_future(self._run_locked(batch, futures))
+                try:
+                    await asyncio.wait([locked])
+                except asyncio.CancelledError:
+                    locked.cancel()
+                    for future in futures:
+                        future.cancel()
+                    raise
+                if locked.exception() is not None:
+                    # ロックを取れなかったときも、待っている呼び出し元には必ず結果を返す
+                    logger.error(f"Failed to lock the request queue: {locked.exception()}")
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(locked.exception())
+                    continue
+                job = locked.result()
+
+            results = None
+            if not job.cancelled() and job.exception() is None:
+                results = [job.result()] if len(batch) == 1 else job.result()
+
+            for i, future in enumerate(futures):
+                if future.done():
+                    continue
+                if job.cancelled():
+                    future.cancel()
+                elif job.exception() is not None:
+                    future.set_exception(job.exception())
+                else:
+                    future.set_result(results[i])
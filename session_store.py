@@ -0,0 +1,530 @@
+import asyncio
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SessionState:
+    """1つのチャンネルの会話の状態。version は書き換えるたびに増える。"""
+
+    interaction_id: str | None = None
+    api_key_index: int | None = None
+    history: list[tuple[str, str]] = field(default_factory=list)
+    version: int = 0
+
+
+class SessionStore(ABC):
+    """
+    会話の状態 (interaction_id・履歴・noisyなコメント・APIキーの休止期限) の保存先。
+
+    書き換えるメソッドは書き換えた後のチャンネルの version を返します。
+    手元の version と比べれば、ほかのプロセスが書き換えたかどうかが分かります。
+    同じチャンネルの会話は lock で囲んで、プロセスをまたいで1件ずつ処理します。
+    APIキーの休止期限はプロセスをまたいで比べられるよう、time.time() の時刻で保存します。
+    イベントループから呼ぶときは run を通すと、ファイルを読み書きする store でもループを止めません。
+
+    relays_messages が True の store は、WebSocket へ送るメッセージをほかのプロセスへ中継できます。
+    publish で書いたメッセージを、ほかのプロセスが poll_messages で読んで自分のクライアントへ送ります。
+    """
+
+    # publish したメッセージがほかのプロセスに届くなら True
+    relays_messages = False
+
+    async def run(self, func: Callable, *args):
+        """func(*args) を呼ぶ。ファイルを読み書きする store では別のスレッドで呼ぶ。"""
+        return func(*args)
+
+    def flush(self) -> None:
+        """後回しにした書き込みがすべて反映されるまで待つ。"""
+
+    @abstractmethod
+    def get_version(self, channel: str) -> int:
+        """チャンネルの version を返す。まだ書かれていなければ 0"""
+
+    @abstractmethod
+    def load(self, channel: str) -> SessionState:
+        """チャンネルの状態と履歴を同じ時点のものとして読む。"""
+
+    @abstractmethod
+    def save_history(self, channel: str, interaction_id: str, records: list[tuple[str, str]], keep: int) -> int:
+        """interaction_id を書き換え、records を履歴に追記して、新しいほうから keep 件だけ残す。"""
+
+    @abstractmethod
+    def save_interaction_id(self, channel: str, interaction_id: str | None) -> int:
+        """interaction_id だけを書き換える。"""
+
+    @abstractmethod
+    def save_api_key_index(self, channel: str, index: int) -> int:
+        """会話に使っているAPIキーの番号を書き換える。"""
+
+    @abstractmethod
+    def clear(self, channel: str) -> int:
+        """interaction_id と履歴を消す。"""
+
+    @abstractmethod
+    def clear_all(self) -> None:
+        """すべてのチャンネルの interaction_id・履歴・noisyなコメントを消す。"""
+
+    @abstractmethod
+    def append_story(self, channel: str, display_name: str, content: str) -> None:
+        """noisyなコメントを1件ためる。"""
+
+    @abstractmethod
+    def take_story(self, channel: str) -> list[tuple[str, str]]:
+        """ためた (発言者, 本文) を古い順に取り出し、空にする。"""
+
+    @abstractmethod
+    def clear_story(self, channel: str) -> None:
+        """ためたコメントを捨てる。"""
+
+    @abstractmethod
+    def save_key_health(self, index: int, exhausted_until: float, busy_until: float) -> None:
+        """APIキーの休止期限 (time.time() の時刻) を書く。"""
+
+    @abstractmethod
+    def load_key_health(self) -> dict[int, tuple[float, float]]:
+        """APIキーの番号ごとの (クォータ枯渇の休止期限, 高負荷の休止期限)"""
+
+    @abstractmethod
+    def lock(self, channel: str):
+        """チャンネルの会話を1件ずつ処理するための async with で使うロック"""
+
+    def publish(self, channel: str, message: str) -> None:
+        """チャンネルの WebSocket クライアントへ送るメッセージを、ほかのプロセスへ中継する。"""
+
+    def latest_message_id(self) -> int:
+        """中継したメッセージの最後の番号。これより後のメッセージから poll_messages で読む。"""
+        return 0
+
+    def poll_messages(self, after_id: int) -> list[tuple[int, str, str]]:
+        """after_id より後に、ほかのプロセスが publish した (番号, チャンネル, メッセージ) を古い順に返す。"""
+        return []
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """プロセスのメモリに保存する。プロセスをまたいでは共有できない。"""
+
+    def __init__(self):
+        self.states: dict[str, SessionState] = {}
+        self.stories: dict[str, list[tuple[str, str]]] = {}
+        self.key_health: dict[int, tuple[float, float]] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def _state(self, channel: str) -> SessionState:
+        state = self.states.get(channel)
+        if state is None:
+            state = self.states[channel] = SessionState()
+        return state
+
+    def _bump(self, state: SessionState) -> int:
+        state.version += 1
+        return state.version
+
+    def get_version(self, channel: str) -> int:
+        return self._state(channel).version
+
+    def load(self, channel: str) -> SessionState:
+        state = self._state(channel)
+        return SessionState(state.interaction_id, state.api_key_index, list(state.history), state.version)
+
+    def save_history(self, channel: str, interaction_id: str, records: list[tuple[str, str]], keep: int) -> int:
+        state = self._state(channel)
+        state.interaction_id = interaction_id
+        state.history.extend(records)
+        del state.history[: max(len(state.history) - keep, 0)]
+        return self._bump(state)
+
+    def save_interaction_id(self, channel: str, interaction_id: str | None) -> int:
+        state = self._state(channel)
+        state.interaction_id = interaction_id
+        return self._bump(state)
+
+    def save_api_key_index(self, channel: str, index: int) -> int:
+        state = self._state(channel)
+        state.api_key_index = index
+        return self._bump(state)
+
+    def clear(self, channel: str) -> int:
+        state = self._state(channel)
+        state.interaction_id = None
+        state.history.clear()
+        return self._bump(state)
+
+    def clear_all(self) -> None:
+        for channel in list(self.states):
+            self.clear(channel)
+        self.stories.clear()
+
+    def append_story(self, channel: str, display_name: str, content: str) -> None:
+        self.stories.setdefault(channel, []).append((display_name, content))
+
+    def take_story(self, channel: str) -> list[tuple[str, str]]:
+        return self.stories.pop(channel, [])
+
+    def clear_story(self, channel: str) -> None:
+        self.stories.pop(channel, None)
+
+    def save_key_health(self, index: int, exhausted_until: float, busy_until: float) -> None:
+        self.key_health[index] = (exhausted_until, busy_until)
+
+    def load_key_health(self) -> dict[int, tuple[float, float]]:
+        return dict(self.key_health)
+
+    def lock(self, channel: str) -> asyncio.Lock:
+        lock = self.locks.get(channel)
+        if lock is None:
+            lock = self.locks[channel] = asyncio.Lock()
+        return lock
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite のファイルに保存する。同じマシンの複数のプロセス (uvicorn のワーカー) で共有できる。
+
+    WAL モードにして、読み込みが書き込みを待たないようにしています。
+    チャンネルのロックはリースとして表に書き、持ち主のプロセスが落ちても lease_seconds 秒で外れます。
+    ロックを持っている間は lease_seconds の 1/3 ごとに期限を延ばすので、長い返答の途中で外れることはありません。
+
+    ほかのプロセスの書き込みを待つと数秒止まることがあるので、イベントループからは run を通して呼びます。
+    結果の要らない書き込み (noisyなコメント・APIキーの休止期限・リースの返却) は専用のスレッドで後から書き、
+    呼び出し元を待たせません。APIキーの休止期限は手元に写しを持ち、読むときはその写しを返します。
+
+    WebSocket へ送るメッセージは broadcasts 表に書いて、ほかのワーカーに中継します。
+    中継の遅れを取り戻せるよう message_retention_seconds 秒は残し、それより古いものは書くついでに消します。
+    ほかのワーカーと共有しないなら relays_messages=False にして、書き込みと読み込みを省きます。
+    """
+
+    # 古いメッセージを消すのは、この件数を書くごとに1回
+    MESSAGE_PRUNE_EVERY = 100
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS channels (
+            channel TEXT PRIMARY KEY,
+            interaction_id TEXT,
+            api_key_index INTEGER,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            role TEXT NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_channel ON history (channel, id);
+        CREATE TABLE IF NOT EXISTS story (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            display_name TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS key_health (
+            key_index INTEGER PRIMARY KEY,
+            exhausted_until REAL NOT NULL,
+            busy_until REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leases (
+            channel TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+    """
+
+    def __init__(
+        self,
+        path: str,
+        lease_seconds: float = 120.0,
+        poll_interval: float = 0.05,
+        message_retention_seconds: float = 60.0,
+        relays_messages: bool = True,
+    ):
+        self.path = path
+        self.relays_messages = relays_messages
+        # 返答の生成 (503 のリトライを含む) より長くしておく
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.message_retention_seconds = message_retention_seconds
+        self.published = 0
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self)}"
+        # 自動コミットにして、トランザクションは BEGIN IMMEDIATE で明示的に始める
+        self.conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # 接続はスレッド間で共有するので、使うときはこのロックを取る
+        self.conn_lock = threading.Lock()
+        self.local_locks: dict[str, asyncio.Lock] = {}
+        # 後から書く書き込みの待ち行列と、それを書くスレッド
+        self.writes: queue.Queue[tuple[Callable, tuple] | None] = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="session-store-writer", daemon=True)
+        self.writer.start()
+        self.key_health: dict[int, tuple[float, float]] = {}
+        self.key_health_refreshing = False
+
+    async def run(self, func: Callable, *args):
+        return await asyncio.to_thread(func, *args)
+
+    def _write_loop(self) -> None:
+        while True:
+            item = self.writes.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                with self.conn_lock:
+                    func(*args)
+            except Exception as e:
+                logger.error("Failed to write to the session store: %s", e)
+            finally:
+                self.writes.task_done()
+
+    def _write_later(self, func: Callable, *args) -> None:
+        self.writes.put((func, args))
+
+    def flush(self) -> None:
+        self.writes.join()
+
+    def _transaction(self, func, *args, immediate: bool = True):
+        with self.conn_lock:
+            # 読むだけなら BEGIN にして、ほかのプロセスの書き込みを待たない (WAL の読み込み用スナップショット)
+            self.conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                result = func(*args)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def _bump(self, channel: str) -> int:
+        self.conn.execute(
+            "INSERT INTO channels (channel, version) VALUES (?, 1) "
+            "ON CONFLICT (channel) DO UPDATE SET version = version + 1",
+            (channel,),
+        )
+        return self.conn.execute("SELECT version FROM channels WHERE channel = ?", (channel,)).fetchone()[0]
+
+    def _update(self, channel: str, column: str, value) -> int:
+        version = self._bump(channel)
+        self.conn.execute(f"UPDATE channels SET {column} = ? WHERE channel = ?", (value, channel))
+        return version
+
+    def get_version(self, channel: str) -> int:
+        with self.conn_lock:
+            row = self.conn.execute("SELECT version FROM channels WHERE channel = ?", (channel,)).fetchone()
+        return row[0] if row else 0
+
+    def load(self, channel: str) -> SessionState:
+        def load() -> SessionState:
+            row = self.conn.execute(
+                "SELECT interaction_id, api_key_index, version FROM channels WHERE channel = ?", (channel,)
+            ).fetchone()
+            if row is None:
+                return SessionState()
+            history = self.conn.execute(
+                "SELECT role, text FROM history WHERE channel = ? ORDER BY id", (channel,)
+            ).fetchall()
+            return SessionState(row[0], row[1], [tuple(r) for r in history], row[2])
+
+        # 状態と履歴を同じ時点のものとして読む
+        return self._transaction(load, immediate=False)
+
+    def save_history(self, channel: str, interaction_id: str, records: list[tuple[str, str]], keep: int) -> int:
+        def save() -> int:
+            version = self._update(channel, "interaction_id", interaction_id)
+            if records:
+                self.conn.executemany(
+                    "INSERT INTO history (channel, role, text) VALUES (?, ?, ?)",
+                    [(channel, role, text) for role, text in records],
+                )
+                self.conn.execute(
+                    "DELETE FROM history WHERE channel = ? AND id NOT IN "
+                    "(SELECT id FROM history WHERE channel = ? ORDER BY id DESC LIMIT ?)",
+                    (channel, channel, keep),
+                )
+            return version
+
+        return self._transaction(save)
+
+    def save_interaction_id(self, channel: str, interaction_id: str | None) -> int:
+        return self._transaction(self._update, channel, "interaction_id", interaction_id)
+
+    def save_api_key_index(self, channel: str, index: int) -> int:
+        return self._transaction(self._update, channel, "api_key_index", index)
+
+    def _clear(self, channel: str) -> int:
+        version = self._update(channel, "interaction_id", None)
+        self.conn.execute("DELETE FROM history WHERE channel = ?", (channel,))
+        return version
+
+    def clear(self, channel: str) -> int:
+        return self._transaction(self._clear, channel)
+
+    def clear_all(self) -> None:
+        def clear_all() -> None:
+            for (channel,) in self.conn.execute("SELECT channel FROM channels").fetchall():
+                self._clear(channel)
+            self.conn.execute("DELETE FROM history")
+            self.conn.execute("DELETE FROM story")
+
+        self._transaction(clear_all)
+
+    def append_story(self, channel: str, display_name: str, content: str) -> None:
+        self._write_later(
+            self.conn.execute,
+            "INSERT INTO story (channel, display_name, content) VALUES (?, ?, ?)",
+            (channel, display_name, content),
+        )
+
+    def take_story(self, channel: str) -> list[tuple[str, str]]:
+        # 後から書くことにしたコメントも取り出す
+        self.flush()
+
+        def take() -> list[tuple[str, str]]:
+            rows = self.conn.execute(
+                "SELECT display_name, content FROM story WHERE channel = ? ORDER BY id", (channel,)
+            ).fetchall()
+            self.conn.execute("DELETE FROM story WHERE channel = ?", (channel,))
+            return [tuple(r) for r in rows]
+
+        return self._transaction(take)
+
+    def clear_story(self, channel: str) -> None:
+        self._write_later(self.conn.execute, "DELETE FROM story WHERE channel = ?", (channel,))
+
+    def save_key_health(self, index: int, exhausted_until: float, busy_until: float) -> None:
+        self.key_health[index] = (exhausted_until, busy_until)
+        self._write_later(
+            self.conn.execute,
+            "INSERT OR REPLACE INTO key_health (key_index, exhausted_until, busy_until) VALUES (?, ?, ?)",
+            (index, exhausted_until, busy_until),
+        )
+
+    def load_key_health(self) -> dict[int, tuple[float, float]]:
+        """手元の写しを返し、ほかのプロセスが書いた休止期限は書き込み用のスレッドで読み込んでおく。"""
+        if not self.key_health_refreshing:
+            self.key_health_refreshing = True
+            self._write_later(self._refresh_key_health)
+        return dict(self.key_health)
+
+    def _refresh_key_health(self) -> None:
+        try:
+            rows = self.conn.execute("SELECT key_index, exhausted_until, busy_until FROM key_health").fetchall()
+        finally:
+            self.key_health_refreshing = False
+        for index, exhausted_until, busy_until in rows:
+            current = self.key_health.get(index, (0.0, 0.0))
+            self.key_health[index] = (max(current[0], exhausted_until), max(current[1], busy_until))
+
+    def try_acquire_lease(self, channel: str) -> bool:
+        def acquire() -> bool:
+            now = time.time()
+            row = self.conn.execute("SELECT owner, expires_at FROM leases WHERE channel = ?", (channel,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                return False
+            self.conn.execute(
+                "INSERT OR REPLACE INTO leases (channel, owner, expires_at) VALUES (?, ?, ?)",
+                (channel, self.owner, now + self.lease_seconds),
+            )
+            return True
+
+        return self._transaction(acquire)
+
+    def renew_lease(self, channel: str) -> bool:
+        """持っているリースの期限を延ばす。ほかのプロセスに取られていれば False"""
+
+        def renew() -> bool:
+            cursor = self.conn.execute(
+                "UPDATE leases SET expires_at = ? WHERE channel = ? AND owner = ?",
+                (time.time() + self.lease_seconds, channel, self.owner),
+            )
+            return cursor.rowcount > 0
+
+        return self._transaction(renew)
+
+    async def _keep_lease(self, channel: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                renewed = await self.run(self.renew_lease, channel)
+            except Exception as e:
+                logger.warning("Failed to renew the lease of channel %s: %s", channel, e)
+                continue
+            if not renewed:
+                logger.warning("Lost the lease of channel %s", channel)
+                return
+
+    def release_lease(self, channel: str) -> None:
+        self._write_later(
+            self.conn.execute, "DELETE FROM leases WHERE channel = ? AND owner = ?", (channel, self.owner)
+        )
+
+    def publish(self, channel: str, message: str) -> None:
+        self._write_later(self._publish, channel, message, time.time())
+
+    def _publish(self, channel: str, message: str, created_at: float) -> None:
+        self.conn.execute(
+            "INSERT INTO broadcasts (channel, origin, message, created_at) VALUES (?, ?, ?, ?)",
+            (channel, self.owner, message, created_at),
+        )
+        self.published += 1
+        if self.published % self.MESSAGE_PRUNE_EVERY == 0:
+            self.conn.execute(
+                "DELETE FROM broadcasts WHERE created_at < ?", (created_at - self.message_retention_seconds,)
+            )
+
+    def latest_message_id(self) -> int:
+        with self.conn_lock:
+            row = self.conn.execute("SELECT MAX(id) FROM broadcasts").fetchone()
+        return row[0] or 0
+
+    def poll_messages(self, after_id: int) -> list[tuple[int, str, str]]:
+        with self.conn_lock:
+            rows = self.conn.execute(
+                "SELECT id, channel, message FROM broadcasts WHERE id > ? AND origin != ? ORDER BY id",
+                (after_id, self.owner),
+            ).fetchall()
+        return [tuple(r) for r in rows]
+
+    @asynccontextmanager
+    async def lock(self, channel: str) -> AsyncIterator[None]:
+        # 同じプロセスの中は asyncio.Lock で、プロセスの間はリースで1件ずつにする
+        local_lock = self.local_locks.get(channel)
+        if local_lock is None:
+            local_lock = self.local_locks[channel] = asyncio.Lock()
+        async with local_lock:
+            while not await self.run(self.try_acquire_lease, channel):
+                await asyncio.sleep(self.poll_interval)
+            # 返答に lease_seconds より長くかかっても、ほかのプロセスに取られないよう期限を延ばし続ける
+            keeper = asyncio.create_task(self._keep_lease(channel))
+            try:
+                yield
+            finally:
+                keeper.cancel()
+                self.release_lease(channel)
+
+    def close(self) -> None:
+        self.writes.put(None)
+        self.writer.join()
+        with self.conn_lock:
+            self.conn.close()
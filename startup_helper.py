@@ -0,0 +1,51 @@
+import argparse
+import time
+from typing import Mapping, Sequence
+
+STARTUP_CONTINUE = "continue"
+STARTUP_FRESH = "fresh"
+# コマンドライン引数がないときに見る環境変数
+STARTUP_MODE_ENV = "FUYUKA_STARTUP"
+
+
+def parse_startup_mode(argv: Sequence[str], environ: Mapping[str, str]) -> str | None:
+    """
+    --continue / --fresh または環境変数 FUYUKA_STARTUP から起動のしかたを決める。
+
+    どちらの指定もなければ None を返します (従来どおり起動時に確認する)。
+    コマンドライン引数を環境変数より優先し、知らない引数は無視します。
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--continue", dest="mode", action="store_const", const=STARTUP_CONTINUE)
+    group.add_argument("--fresh", dest="mode", action="store_const", const=STARTUP_FRESH)
+    args, _ = parser.parse_known_args(argv)
+    if args.mode is not None:
+        return args.mode
+    mode = environ.get(STARTUP_MODE_ENV, "").strip().lower()
+    if mode in (STARTUP_CONTINUE, STARTUP_FRESH):
+        return mode
+    return None
+
+
+class PhaseTimer:
+    """起動の段階ごとの経過時間を記録する。"""
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+
+    def mark(self, name: str) -> float:
+        """前回の mark からの経過時間を name の段階として記録して返す。"""
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.phases.append((name, elapsed))
+        self.last = now
+        return elapsed
+
+    def total(self) -> float:
+        return self.last - self.start
+
+    def format(self) -> str:
+        phases = ", ".join(f"{name} {elapsed * 1000:.0f}ms" for name, elapsed in self.phases)
+        return f"{phases} (total {self.total() * 1000:.0f}ms)"
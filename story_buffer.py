@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import time
+
+from session_store import SessionStore
+
+
+class StoryBuffer:
+    """
+    noisy なコメントを会話の流れとしてためておくバッファ。
+
+    コメントは deque に積み、合計文字数が max_chars を超えたら古いものから捨てます。
+    flush_chars 文字以上たまるか、最初のコメントから flush_seconds 秒たつと要約のタイミングになります。
+
+    store を指定するとコメントはそちらにも書き、取り出すときはほかのプロセスが受けた分もまとめて取り出します。
+    要約のタイミングは、このプロセスが受けたコメントだけで判断します。
+    """
+
+    def __init__(
+        self,
+        flush_chars: int = 1000,
+        max_chars: int = 4000,
+        flush_seconds: float = 60.0,
+        store: SessionStore | None = None,
+        channel: str = "default",
+    ):
+        self.flush_chars = flush_chars
+        # 0 以下なら無制限
+        self.max_chars = max_chars
+        # 0 以下なら時間では要約しない
+        self.flush_seconds = flush_seconds
+        self.entries: collections.deque[str] = collections.deque()
+        self.chars = 0
+        self.storyteller = ""
+        self.first_time: float | None = None
+        self.dropped = 0
+        self.wakeup: asyncio.Event | None = None
+        self.store = store
+        self.channel = channel
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, display_name: str, content: str) -> None:
+        if not content:
+            return
+        self.storyteller = display_name
+        if self.store is not None:
+            self.store.append_story(self.channel, display_name, content)
+        if self.first_time is None:
+            self.first_time = time.monotonic()
+        self.entries.append(content)
+        self.chars += len(content) + 1
+        while 0 < self.max_chars < self.chars and len(self.entries) > 1:
+            self.chars -= len(self.entries.popleft()) + 1
+            self.dropped += 1
+        if self.wakeup is not None:
+            # 待っている側で要約のタイミングを計算し直してもらう
+            self.wakeup.set()
+
+    def clear(self) -> None:
+        self._clear_local()
+        if self.store is not None:
+            self.store.clear_story(self.channel)
+
+    def _clear_local(self) -> None:
+        self.entries.clear()
+        self.chars = 0
+        self.first_time = None
+
+    def take(self) -> tuple[str, str] | None:
+        """ためたコメントを (発言者, 本文) として取り出し、バッファを空にする。空なら None"""
+        if self.store is not None:
+            return self._take_from_store()
+        if not self.entries:
+            return None
+        text = " ".join(self.entries)
+        self.clear()
+        return self.storyteller, text
+
+    async def atake(self) -> tuple[str, str] | None:
+        """take と同じ。store からはイベントループを止めずに取り出す。"""
+        if self.store is None:
+            return self.take()
+        self._clear_local()
+        return self._join_stories(await self.store.run(self.store.take_story, self.channel))
+
+    def _take_from_store(self) -> tuple[str, str] | None:
+        self._clear_local()
+        return self._join_stories(self.store.take_story(self.channel))
+
+    def _join_stories(self, stories: list[tuple[str, str]]) -> tuple[str, str] | None:
+        if not stories:
+            return None
+        contents = collections.deque(content for _, content in stories)
+        chars = sum(len(content) + 1 for content in contents)
+        while 0 < self.max_chars < chars and len(contents) > 1:
+            chars -= len(contents.popleft()) + 1
+            self.dropped += 1
+        return stories[-1][0], " ".join(contents)
+
+    def seconds_until_due(self) -> float | None:
+        """時間で要約のタイミングになるまでの秒数。空または時間で要約しない場合は None"""
+        if self.first_time is None or self.flush_seconds <= 0:
+            return None
+        return max(self.first_time + self.flush_seconds - time.monotonic(), 0.0)
+
+    def is_due(self) -> bool:
+        if not self.entries:
+            return False
+        if self.chars >= self.flush_chars:
+            return True
+        return self.seconds_until_due() == 0.0
+
+    async def wait_due(self) -> None:
+        """要約のタイミングになるまで待つ。"""
+        self.wakeup = asyncio.Event()
+        while not self.is_due():
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.seconds_until_due())
+            except asyncio.TimeoutError:
+                pass
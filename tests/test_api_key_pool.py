@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from api_key_pool import ApiKeyPool
+from session_store import MemorySessionStore
+
+
+class TestApiKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ApiKeyPool(["key_0", "key_1", "key_2"])
+
+    def test_keeps_preferred_key(self):
+        """優先したいキーが使える場合はそのキーを返すこと"""
+        self.assertEqual(2, self.pool.acquire(2).index)
+        self.assertEqual(2, self.pool.acquire(2).index)
+
+    def test_spreads_to_least_recently_used(self):
+        """優先キーがなければ、最も長く使われていないキーを順に選ぶこと"""
+        indexes = [self.pool.acquire().index for _ in range(4)]
+        self.assertEqual([0, 1, 2, 0], indexes)
+
+    def test_skips_exhausted_key(self):
+        """429 で休止中のキーは優先キーでも選ばれないこと"""
+        self.pool.mark_exhausted(0)
+        self.assertNotEqual(0, self.pool.acquire(0).index)
+
+    def test_returns_none_when_all_exhausted(self):
+        """すべてのキーが休止中なら None を返すこと"""
+        for i in range(3):
+            self.pool.mark_exhausted(i)
+        self.assertIsNone(self.pool.acquire(0))
+
+    def test_busy_key_kept_for_preferred_but_avoided_otherwise(self):
+        """503 で休止中のキーは会話の継続には使えるが、新しい割り当てでは避けること"""
+        self.pool.mark_busy(0)
+        self.assertEqual(0, self.pool.acquire(0).index)
+        self.assertNotEqual(0, self.pool.acquire().index)
+
+    def test_exhausted_key_recovers_after_cooldown(self):
+        """休止期限を過ぎたキーは再び選ばれること"""
+        pool = ApiKeyPool(["key_0"], exhausted_cooldown=0)
+        pool.mark_exhausted(0)
+        self.assertEqual(0, pool.acquire(0).index)
+
+    def test_stats(self):
+        """キーごとの利用回数と休止回数が統計に反映されること"""
+        self.pool.acquire(1)
+        self.pool.mark_exhausted(1)
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats["keys"][1]["requests"])
+        self.assertEqual(1, stats["keys"][1]["exhaustedCount"])
+        self.assertTrue(stats["keys"][1]["exhausted"])
+        self.assertFalse(stats["keys"][0]["clientReady"])
+
+    def test_get_client_creates_once_across_threads(self):
+        """prewarm のスレッドとイベントループから同時に呼ばれても、クライアントを一つだけ作ること"""
+        pool = ApiKeyPool(["key_0"])
+
+        def create_client(api_key):
+            # 作るのに時間がかかる間に、ほかのスレッドも client is None を見るようにする
+            time.sleep(0.05)
+            pool.clients_created += 1
+            return object()
+
+        with patch.object(pool, "create_client", side_effect=create_client):
+            clients = []
+            threads = [threading.Thread(target=lambda: clients.append(pool.get_client(0))) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, pool.clients_created)
+        self.assertEqual(1, len({id(client) for client in clients}))
+
+    def test_count_connections(self):
+        """接続プールまでたどれれば接続数を、たどれなければ None を返すこと"""
+        pool = SimpleNamespace(connections=[object(), object()])
+        transport = SimpleNamespace(_pool=pool)
+        client = SimpleNamespace(
+            _api_client=SimpleNamespace(_async_httpx_client=SimpleNamespace(_transport=transport))
+        )
+        self.assertEqual(2, ApiKeyPool.count_connections(client))
+        self.assertIsNone(ApiKeyPool.count_connections(None))
+        # 版が変わって属性の名前や中身が変わっていても例外にしない
+        transport._pool = SimpleNamespace()
+        self.assertIsNone(ApiKeyPool.count_connections(client))
+        pool.connections = object()
+        transport._pool = pool
+        self.assertIsNone(ApiKeyPool.count_connections(client))
+
+    def test_shares_health_through_store(self):
+        """store を共有するほかのプールで休止したキーを選ばないこと"""
+        store = MemorySessionStore()
+        pool = ApiKeyPool(["key_0", "key_1"], store=store)
+        other = ApiKeyPool(["key_0", "key_1"], store=store)
+        pool.mark_exhausted(0)
+        self.assertEqual(1, other.acquire(0).index)
@@ -0,0 +1,99 @@
+import asyncio
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from channel_registry import ChannelLimitError, ChannelRegistry
+
+
+class TestChannelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.factory = MagicMock(side_effect=lambda name: MagicMock(name=name))
+        self.registry = ChannelRegistry(self.factory, max_channels=2)
+
+    def test_creates_session_once_per_channel(self):
+        """同じチャンネルには同じセッションを返し、初回だけ作ること"""
+        session = self.registry.get("alpha")
+        self.assertIs(session, self.registry.get("alpha"))
+        self.factory.assert_called_once_with("alpha")
+        self.assertIn("alpha", self.registry)
+
+    def test_rejects_invalid_name(self):
+        """ファイル名に使えない文字を含むチャンネル名は拒否すること"""
+        for name in ["../etc", "a/b", "", "x" * 65]:
+            with self.assertRaises(ValueError):
+                self.registry.get(name)
+        self.factory.assert_not_called()
+
+    def test_rejects_over_limit(self):
+        """上限を超えるチャンネルは作らないこと"""
+        self.registry.get("a")
+        self.registry.get("b")
+        with self.assertRaises(ChannelLimitError):
+            self.registry.get("c")
+        # 既存のチャンネルは引き続き使える
+        self.registry.get("a")
+
+
+def make_session(idle: bool = True) -> MagicMock:
+    session = MagicMock()
+    session.is_idle.return_value = idle
+    session.aclose = AsyncMock()
+    return session
+
+
+class TestChannelRegistryEviction(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.busy = set()
+        self.factory = MagicMock(side_effect=lambda name: make_session(name not in self.busy))
+        self.registry = ChannelRegistry(self.factory, max_channels=2, idle_seconds=10)
+
+    async def test_evicts_idle_channels(self):
+        """使われていない何もしていないチャンネルだけを閉じること"""
+        self.busy.add("busy")
+        idle = self.registry.get("idle")
+        busy = self.registry.get("busy")
+        self.assertEqual(0, await self.registry.evict_idle())
+
+        self.assertEqual(1, await self.registry.evict_idle(time.monotonic() + 10))
+        idle.aclose.assert_awaited_once()
+        busy.aclose.assert_not_awaited()
+        self.assertNotIn("idle", self.registry)
+        self.assertIn("busy", self.registry)
+        self.assertEqual({"idle"}, self.registry.evicted)
+        # 閉じたチャンネルも、次に使われたら作り直す
+        self.assertIsNot(idle, self.registry.get("idle"))
+
+    async def test_makes_room_at_limit(self):
+        """上限に達していたら、使われていないチャンネルを閉じて空きを作ること"""
+        a = self.registry.get("a")
+        self.registry.get("b")
+        self.registry.last_used["a"] -= 10
+        self.registry.get("c")
+        await self.registry.aclose()
+        a.aclose.assert_awaited_once()
+
+    async def test_wait_closed_until_evicted_session_is_closed(self):
+        """閉じている途中のチャンネルは、閉じ終わるまで wait_closed で待たせること"""
+        closed = asyncio.Event()
+        session = self.registry.get("a")
+        session.aclose.side_effect = closed.wait
+        self.registry.last_used["a"] -= 10
+        self.registry.get("b")
+        self.registry.get("c")
+
+        waiter = asyncio.create_task(self.registry.wait_closed("a"))
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        closed.set()
+        await waiter
+        self.assertNotIn("a", self.registry.closing_tasks)
+        # 閉じていないチャンネルは待たない
+        await self.registry.wait_closed("b")
+
+    async def test_disabled_when_idle_seconds_is_zero(self):
+        """idle_seconds が 0 なら閉じないこと"""
+        self.registry.idle_seconds = 0
+        self.registry.get("a")
+        self.assertEqual(0, await self.registry.evict_idle(time.monotonic() + 3600))
+        self.assertIn("a", self.registry)
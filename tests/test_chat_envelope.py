@@ -0,0 +1,44 @@
+import json
+import unittest
+
+import chat_envelope
+from chat_envelope import ChatEnvelope
+
+
+class TestChatEnvelope(unittest.TestCase):
+    def tearDown(self):
+        chat_envelope.set_encoder("json")
+
+    def test_to_json_matches_json_dumps(self):
+        """フィールドと追加指示を、辞書を json.dumps したのと同じ内容の JSON にすること"""
+        json_data = {"id": "a", "content": "こんにちは\n", "story": {"displayName": "B"}, "additionalRequests": ["<length>"]}
+        envelope = ChatEnvelope.from_dict(json_data)
+        self.assertEqual(json_data, json.loads(envelope.to_json()))
+        self.assertEqual(json_data, dict(envelope))
+        self.assertEqual({}, json.loads(ChatEnvelope({}).to_json()))
+        self.assertEqual({"additionalRequests": ["x"]}, json.loads(ChatEnvelope({}, ("x",)).to_json()))
+
+    def test_with_request_shares_fields(self):
+        """やり直しの追加指示を足しても元は変わらず、フィールドの JSON を共有すること"""
+        envelope = ChatEnvelope({"content": "やあ"}, ("<length>",))
+        retry = envelope.with_request("NGを含めないでください。")
+        self.assertEqual(["<length>"], envelope["additionalRequests"])
+        self.assertEqual(["<length>", "NGを含めないでください。"], retry["additionalRequests"])
+        self.assertIs(envelope.fields_json(), retry.fields_json())
+        self.assertIs(retry.to_json(), retry.to_json())
+
+    def test_is_immutable(self):
+        """属性もフィールドも変更できないこと"""
+        envelope = ChatEnvelope({"content": "やあ"})
+        with self.assertRaises(AttributeError):
+            envelope.additional_requests = ("x",)
+        with self.assertRaises(TypeError):
+            envelope.fields["content"] = "x"
+
+    def test_set_encoder(self):
+        """orjson がなければ標準の json を使い、どちらでも同じ JSON になること"""
+        expected = ChatEnvelope({"content": "絵文字😂", "n": 1}, ("x",)).to_json()
+        name = chat_envelope.set_encoder("auto")
+        self.assertEqual("orjson" if chat_envelope.orjson is not None else "json", name)
+        self.assertEqual(expected, ChatEnvelope({"content": "絵文字😂", "n": 1}, ("x",)).to_json())
+        self.assertEqual("json", chat_envelope.set_encoder("json"))
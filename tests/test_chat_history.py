@@ -0,0 +1,32 @@
+import unittest
+
+from chat_history import ChatHistory
+
+
+class TestChatHistory(unittest.TestCase):
+    def test_render_formats_lines(self):
+        """役割ごとのラベルを付けて改行区切りで整形されること"""
+        history = ChatHistory([("user", "こんにちは"), ("model", "やっほー")])
+        self.assertEqual("ユーザー: こんにちは\nアシスタント: やっほー", history.render())
+
+    def test_render_is_cached_until_changed(self):
+        """変更がなければ同じ文字列を使い回し、変更後は作り直すこと"""
+        history = ChatHistory([("user", "1"), ("model", "a")])
+        rendered = history.render()
+        self.assertIs(rendered, history.render())
+
+        history.append("user", "2")
+        self.assertEqual("ユーザー: 1\nアシスタント: a\nユーザー: 2", history.render())
+
+    def test_trim_keeps_pairs(self):
+        """古いものから1往復単位で削除されること"""
+        history = ChatHistory([("user", "1"), ("model", "a"), ("user", "2"), ("model", "b")])
+        self.assertEqual(2, history.trim(3))
+        self.assertEqual([("user", "2"), ("model", "b")], list(history))
+
+    def test_trim_by_chars(self):
+        """文字数の上限を超えた分が削除され、文字数も追従すること"""
+        history = ChatHistory([("user", "1"), ("model", "a"), ("user", "2"), ("model", "b")])
+        history.trim(10, max_chars=len("ユーザー: 2") + len("アシスタント: b"))
+        self.assertEqual([("user", "2"), ("model", "b")], list(history))
+        self.assertEqual(len(history.render()) - 1, history.chars)
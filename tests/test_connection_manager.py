@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+
+from connection_manager import SLOW_CLIENT_DISCONNECT, ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self, blocked: bool = False, broken: bool = False):
+        self.sent: list[str] = []
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+        self.broken = broken
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self.broken:
+            raise RuntimeError("connection lost")
+        await self.unblocked.wait()
+        self.sent.append(message)
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+
+
+async def drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+class TestConnectionManager(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_client_does_not_block_others(self):
+        """遅いクライアントがいても、ほかのクライアントには届くこと"""
+        manager = ConnectionManager()
+        slow, fast = FakeWebSocket(blocked=True), FakeWebSocket()
+        await manager.connect(slow)
+        await manager.connect(fast)
+
+        await asyncio.wait_for(manager.broadcast_json({"response": "こんにちは"}), 1)
+        await drain()
+        self.assertEqual(['{"response":"こんにちは"}'], fast.sent)
+        self.assertEqual([], slow.sent)
+
+        slow.unblocked.set()
+        await drain()
+        self.assertEqual(['{"response":"こんにちは"}'], slow.sent)
+        await manager.aclose()
+
+    async def test_drop_oldest_when_queue_is_full(self):
+        """送信待ちがあふれたら古いメッセージから捨てること"""
+        manager = ConnectionManager(queue_size=2)
+        slow = FakeWebSocket(blocked=True)
+        await manager.connect(slow)
+        await drain()
+        await manager.broadcast_json({"seq": 0})
+        await drain()
+        for i in range(1, 4):
+            await manager.broadcast_json({"seq": i})
+        slow.unblocked.set()
+        await drain()
+        # 1件目は送信中だったので届き、2件目が捨てられる
+        self.assertEqual(['{"seq":0}', '{"seq":2}', '{"seq":3}'], slow.sent)
+        await manager.aclose()
+
+    async def test_disconnect_slow_client_by_policy(self):
+        """切断する設定なら、あふれたクライアントを切断すること"""
+        manager = ConnectionManager(queue_size=1, slow_client_policy=SLOW_CLIENT_DISCONNECT)
+        slow = FakeWebSocket(blocked=True)
+        await manager.connect(slow)
+        await drain()
+        for i in range(3):
+            await manager.broadcast_json({"seq": i})
+        await drain()
+        self.assertEqual(0, len(manager))
+        self.assertTrue(slow.closed)
+        await manager.aclose()
+
+    async def test_broken_client_is_removed(self):
+        """送信に失敗したクライアントは一覧から除外されること"""
+        manager = ConnectionManager()
+        broken = FakeWebSocket(broken=True)
+        await manager.connect(broken)
+        await manager.broadcast_json({"response": "a"})
+        await drain()
+        self.assertEqual([], manager.active_connections)
+        await manager.aclose()
+
+    async def test_relay_receives_broadcasts(self):
+        """broadcast したメッセージは relay にも渡し、broadcast_local では渡さないこと"""
+        relayed = []
+        manager = ConnectionManager(relay=relayed.append)
+        client = FakeWebSocket()
+        await manager.connect(client)
+
+        await manager.broadcast_json({"response": "こんにちは"})
+        await manager.broadcast_local('{"response":"中継"}')
+        await drain()
+        self.assertEqual(['{"response":"こんにちは"}'], relayed)
+        self.assertEqual(['{"response":"こんにちは"}', '{"response":"中継"}'], client.sent)
+        await manager.aclose()
+
+    async def test_relay_without_local_clients(self):
+        """このプロセスにクライアントがいなくても relay には渡すこと"""
+        relayed = []
+        manager = ConnectionManager(relay=relayed.append)
+        await manager.broadcast_json({"response": "こんにちは"})
+        self.assertEqual(['{"response":"こんにちは"}'], relayed)
@@ -1,5 +1,7 @@
+import asyncio
 import os
 import tempfile
+import time
 import unittest
 from unittest.mock import AsyncMock, MagicMock, patch
 
@@ -11,6 +13,7 @@ g.BASE_PROMPT = "You are a test assistant."
 g.ERROR_MESSAGE = "ERROR_MESSAGE"
 g.STOP_CANDIDATE_MESSAGE = "STOP_CANDIDATE_MESSAGE"
 g.RESOURCE_EXHAUSTED_MESSAGE = "RESOURCE_EXHAUSTED_MESSAGE"
+g.TIMEOUT_MESSAGE = "TIMEOUT_MESSAGE"
 g.config = {
     "google": {
         "geminiApiKey": ["key_0", "key_1", "key_2"],
@@ -21,7 +24,9 @@ g.config = {
 
 from google.genai import errors
 
-from genai_interactions import GenAIInteractions
+from chat_history import ChatHistory
+from genai_interactions import UNKNOWN_ERROR_CODE, GenAIInteractions
+from session_store import SqliteSessionStore
 
 
 def make_api_error(code: int) -> errors.APIError:
@@ -37,6 +42,29 @@ def make_interaction_mock(output_text: str, interaction_id: str = "test_id_001")
     return mock
 
 
+class FakeStream:
+    """ストリーミング応答に相当するイベント列を返す非同期イテレータ。"""
+
+    def __init__(self, texts: list[str], interaction_id: str = "stream_id_001"):
+        created = MagicMock(event_type="interaction.created")
+        created.interaction.id = interaction_id
+        deltas = [MagicMock(event_type="step.delta", delta=MagicMock(type="text", text=t)) for t in texts]
+        self.events = [created, *deltas, MagicMock(event_type="interaction.completed", interaction=created.interaction)]
+        self.closed = False
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for event in self.events:
+            if self.closed:
+                return
+            yield event
+
+    async def close(self):
+        self.closed = True
+
+
 class TestBuildContextInput(unittest.TestCase):
     """build_context_input メソッドのテスト。"""
 
@@ -50,10 +78,10 @@ class TestBuildContextInput(unittest.TestCase):
 
     def test_injects_history_as_context(self):
         """履歴がある場合、コンテキストが先頭に埋め込まれること。"""
-        self.gi.history = [
+        self.gi.history = ChatHistory([
             ("user", "My name is Fuyuka."),
             ("model", "Nice to meet you, Fuyuka!"),
-        ]
+        ])
         result = self.gi.build_context_input("What is my name?")
         self.assertIn("[直前の会話の文脈]", result)
         self.assertIn("ユーザー: My name is Fuyuka.", result)
@@ -74,35 +102,49 @@ class TestRemoveOldHistory(unittest.TestCase):
     def test_does_not_remove_within_limit(self):
         """maxHistoryLength 以内なら履歴が削除されないこと。"""
         # maxHistoryLength=4, 4エントリなら削除しない
-        self.gi.history = [
+        self.gi.history = ChatHistory([
             ("user", "1"), ("model", "a"),
             ("user", "2"), ("model", "b"),
-        ]
+        ])
         self.gi.remove_old_history()
         self.assertEqual(4, len(self.gi.history))
 
     def test_removes_oldest_pair_when_over_limit(self):
         """maxHistoryLength を超えたとき、最古の1往復（2エントリ）が削除されること。"""
-        self.gi.history = [
+        self.gi.history = ChatHistory([
             ("user", "1"), ("model", "a"),
             ("user", "2"), ("model", "b"),
             ("user", "3"), ("model", "c"),
-        ]
+        ])
         self.gi.remove_old_history()
         self.assertEqual(4, len(self.gi.history))
         # 最古の ("user","1"), ("model","a") が消えていること
         self.assertEqual("2", self.gi.history[0][1])
 
-    def test_removes_one_pair_at_a_time(self):
-        """1回の呼び出しで削除されるのは1往復（2エントリ）だけであること。"""
-        self.gi.history = [
+    def test_removes_until_within_limit(self):
+        """上限を大きく超えている場合、1回の呼び出しで上限内まで削除されること。"""
+        self.gi.history = ChatHistory([
             ("user", "1"), ("model", "a"),
             ("user", "2"), ("model", "b"),
             ("user", "3"), ("model", "c"),
             ("user", "4"), ("model", "d"),
-        ]
+        ])
         self.gi.remove_old_history()
-        self.assertEqual(6, len(self.gi.history))
+        self.assertEqual(4, len(self.gi.history))
+        self.assertEqual("3", self.gi.history[0][1])
+
+    def test_removes_by_char_budget(self):
+        """maxHistoryChars を超えた場合、文字数の上限内まで古い往復が削除されること。"""
+        g.config["google"]["maxHistoryChars"] = 30
+        try:
+            self.gi.history = ChatHistory([
+                ("user", "1" * 10), ("model", "a"),
+                ("user", "2"), ("model", "b"),
+            ])
+            self.gi.remove_old_history()
+            self.assertEqual([("user", "2"), ("model", "b")], list(self.gi.history))
+        finally:
+            del g.config["google"]["maxHistoryChars"]
 
 
 class TestResetChatHistory(unittest.TestCase):
@@ -114,10 +156,10 @@ class TestResetChatHistory(unittest.TestCase):
     def test_clears_interaction_id_and_history(self):
         """リセット後に interaction_id と history がクリアされること。"""
         self.gi.interaction_id = "some_id"
-        self.gi.history = [("user", "hello"), ("model", "hi")]
+        self.gi.history = ChatHistory([("user", "hello"), ("model", "hi")])
         self.gi.reset_chat_history()
         self.assertIsNone(self.gi.interaction_id)
-        self.assertEqual([], self.gi.history)
+        self.assertEqual([], list(self.gi.history))
 
 
 class TestLoadChatHistory(unittest.TestCase):
@@ -135,7 +177,7 @@ class TestLoadChatHistory(unittest.TestCase):
     def _use_temp_files(self):
         tmp_dir = tempfile.mkdtemp()
         id_path = os.path.join(tmp_dir, "interaction_id.txt")
-        hist_path = os.path.join(tmp_dir, "history.pkl")
+        hist_path = os.path.join(tmp_dir, "history.jsonl")
         GenAIInteractions.FILENAME_INTERACTION_ID = id_path
         GenAIInteractions.FILENAME_CHAT_HISTORY = hist_path
         return id_path, hist_path
@@ -156,6 +198,73 @@ class TestLoadChatHistory(unittest.TestCase):
         self.assertTrue(result)
         self.assertEqual("test_interaction_id", self.gi.interaction_id)
 
+    def test_save_and_load_round_trip(self):
+        """保存した interaction_id と履歴が、書き込み完了後に読み込めること。"""
+        self._use_temp_files()
+        self.gi.history = ChatHistory([("user", "hello"), ("model", "hi")])
+        self.gi.save_chat_history("saved_id", list(self.gi.history))
+        self.gi.flush_chat_history()
+
+        other = GenAIInteractions()
+        self.assertTrue(other.load_chat_history())
+        self.assertEqual("saved_id", other.interaction_id)
+        self.assertEqual([("user", "hello"), ("model", "hi")], list(other.history))
+
+    def test_fresh_start_replaces_old_journal(self):
+        """前回の履歴を読み込まずに始めたら、最初の保存で前回の会話を書き直して消すこと。"""
+        self._use_temp_files()
+        self.gi.history = ChatHistory([("user", "old"), ("model", "old reply")])
+        self.gi.save_chat_history("old_id", list(self.gi.history))
+        self.gi.flush_chat_history()
+
+        fresh = GenAIInteractions()
+        fresh.history = ChatHistory([("user", "new"), ("model", "new reply")])
+        fresh.save_chat_history("new_id", list(fresh.history))
+        fresh.save_chat_history("new_id_2", [])
+        fresh.flush_chat_history()
+
+        other = GenAIInteractions()
+        self.assertTrue(other.load_chat_history())
+        self.assertEqual("new_id_2", other.interaction_id)
+        self.assertEqual([("user", "new"), ("model", "new reply")], list(other.history))
+
+
+class TestSessionStore(unittest.TestCase):
+    """store を共有する複数のプロセスのテスト。"""
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), "sessions.sqlite3")
+        # 同じファイルを別々に開き、2つのワーカーのプロセスに見立てる
+        self.stores = [SqliteSessionStore(path), SqliteSessionStore(path)]
+        self.workers = [GenAIInteractions(channel="ch", store=store) for store in self.stores]
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+    def test_sync_from_store(self):
+        """ほかのプロセスが進めた会話を読み込み直し、自分の書き込みでは読み込み直さないこと。"""
+        a, b = self.workers
+        self.assertFalse(a.sync_from_store())
+        a.history.extend([("user", "hello"), ("model", "hi")])
+        a.save_chat_history("id_a", list(a.history))
+        self.assertFalse(a.sync_from_store())
+
+        self.assertTrue(b.sync_from_store())
+        self.assertEqual("id_a", b.interaction_id)
+        self.assertEqual([("user", "hello"), ("model", "hi")], list(b.history))
+        self.assertFalse(b.sync_from_store())
+
+    def test_reset_is_shared(self):
+        """リセットがほかのプロセスにも反映されること。"""
+        a, b = self.workers
+        a.save_chat_history("id_a", [("user", "hello"), ("model", "hi")])
+        b.sync_from_store()
+        b.reset_chat_history()
+        self.assertTrue(a.sync_from_store())
+        self.assertIsNone(a.interaction_id)
+        self.assertEqual([], list(a.history))
+
 
 class TestGenerateText(unittest.IsolatedAsyncioTestCase):
     """generate_text メソッドのテスト（API 呼び出しをモック）。"""
@@ -189,11 +298,19 @@ class TestGenerateText(unittest.IsolatedAsyncioTestCase):
         result = await self.gi.generate_text("Hi")
         self.assertEqual("Hello!", result)
 
+    async def test_unexpected_error_sets_error_code(self):
+        """ステータスコードの分からないエラーでも、エラーメッセージとエラーコードを返すこと。"""
+        self._set_create_side_effect(RuntimeError("unexpected"))
+        result = await self.gi.generate_text("Hi")
+        self.assertEqual(g.ERROR_MESSAGE, result)
+        self.assertEqual(UNKNOWN_ERROR_CODE, self.gi.last_error_code)
+        self.assertEqual(0, len(self.gi.history))
+
     async def test_success_appends_to_history(self):
         """正常応答後に history にユーザー/モデルのペアが追加されること。"""
         self._set_create_response(make_interaction_mock("Hi there!"))
         await self.gi.generate_text("Hello")
-        self.assertEqual([("user", "Hello"), ("model", "Hi there!")], self.gi.history)
+        self.assertEqual([("user", "Hello"), ("model", "Hi there!")], list(self.gi.history))
 
     async def test_uses_interaction_id_when_present(self):
         """interaction_id がある場合、params に previous_interaction_id が設定されること。"""
@@ -206,7 +323,7 @@ class TestGenerateText(unittest.IsolatedAsyncioTestCase):
     async def test_uses_context_injection_when_no_interaction_id(self):
         """interaction_id がなく history がある場合、コンテキスト注入が行われること。"""
         self.gi.interaction_id = None
-        self.gi.history = [("user", "I am Fuyuka."), ("model", "Hello Fuyuka!")]
+        self.gi.history = ChatHistory([("user", "I am Fuyuka."), ("model", "Hello Fuyuka!")])
         self._set_create_response(make_interaction_mock("response"))
         await self.gi.generate_text("next message")
         call_kwargs = self.mock_client.aio.interactions.create.call_args.kwargs
@@ -216,7 +333,7 @@ class TestGenerateText(unittest.IsolatedAsyncioTestCase):
     async def test_429_switches_api_key_and_retries(self):
         """429 エラー時にAPIキーが切り替わり、次のキーでリトライして成功し、新しいIDが保存されること。"""
         self.gi.interaction_id = "old_id"
-        self.gi.history = [("user", "prev"), ("model", "resp")]
+        self.gi.history = ChatHistory([("user", "prev"), ("model", "resp")])
         self._set_create_side_effect([
             make_api_error(429),
             make_interaction_mock("success after key switch", interaction_id="new_key_id"),
@@ -230,7 +347,7 @@ class TestGenerateText(unittest.IsolatedAsyncioTestCase):
     async def test_429_clears_interaction_id_but_keeps_history(self):
         """429 エラー後に interaction_id が引き継がれず（クリア扱いでリトライされ）、history は保持されること。"""
         self.gi.interaction_id = "some_id"
-        self.gi.history = [("user", "A"), ("model", "B")]
+        self.gi.history = ChatHistory([("user", "A"), ("model", "B")])
         self._set_create_side_effect([
             make_api_error(429),
             make_interaction_mock("ok", interaction_id="new_id_after_429"),
@@ -263,3 +380,88 @@ class TestGenerateText(unittest.IsolatedAsyncioTestCase):
         with patch("genai_interactions.asyncio.sleep", new_callable=AsyncMock):
             result = await self.gi.generate_text("message")
         self.assertEqual(g.STOP_CANDIDATE_MESSAGE, result)
+
+    async def test_cancels_request_after_deadline(self):
+        """期限までに返答がなければ呼び出し中のリクエストを取り消し、タイムアウトのメッセージを返すこと。"""
+        cancelled = asyncio.Event()
+
+        async def create(**params):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        self.mock_client.aio.interactions.create = create
+        result = await self.gi.generate_text("message", deadline=time.monotonic() + 0.01)
+        self.assertEqual(g.TIMEOUT_MESSAGE, result)
+        self.assertEqual(504, self.gi.last_error_code)
+        self.assertTrue(cancelled.is_set())
+
+    async def test_503_gives_up_when_backoff_exceeds_deadline(self):
+        """503 のリトライを待つと期限を過ぎる場合は、待たずにタイムアウトのメッセージを返すこと。"""
+        self._set_create_side_effect([make_api_error(503), make_interaction_mock("unused")])
+        with patch("genai_interactions.asyncio.sleep", new_callable=AsyncMock) as sleep:
+            result = await self.gi.generate_text("message", deadline=time.monotonic() + 0.5)
+        self.assertEqual(g.TIMEOUT_MESSAGE, result)
+        sleep.assert_not_called()
+        self.assertEqual(1, self.mock_client.aio.interactions.create.call_count)
+
+    async def test_returns_error_without_calling_api_when_all_keys_exhausted(self):
+        """すべてのキーが休止中なら API を呼ばずにエラーメッセージを返すこと。"""
+        self._set_create_response(make_interaction_mock("unused"))
+        for i in range(3):
+            self.gi.get_key_pool().mark_exhausted(i)
+        result = await self.gi.generate_text("message")
+        self.assertEqual(g.RESOURCE_EXHAUSTED_MESSAGE, result)
+        self.assertEqual(429, self.gi.last_error_code)
+        self.mock_client.aio.interactions.create.assert_not_called()
+
+    async def test_stream_passes_deltas_and_saves_history(self):
+        """ストリーミング時は差分ごとに on_delta が呼ばれ、結合したテキストが履歴に残ること。"""
+        self._set_create_response(FakeStream(["Hel", "lo!"]))
+        deltas = []
+
+        async def on_delta(delta):
+            deltas.append(delta)
+
+        result = await self.gi.generate_text("message", on_delta)
+        self.assertEqual("Hello!", result)
+        self.assertEqual(["Hel", "lo!"], deltas)
+        self.assertEqual("stream_id_001", self.gi.interaction_id)
+        self.assertTrue(self.mock_client.aio.interactions.create.call_args.kwargs["stream"])
+        self.assertEqual([("user", "message"), ("model", "Hello!")], list(self.gi.history))
+
+    async def test_stream_aborted_by_on_delta_is_not_saved(self):
+        """on_delta が False を返したら打ち切り、その返答を会話に残さないこと。"""
+        stream = FakeStream(["Hel", "lo!"])
+        self._set_create_response(stream)
+        self.gi.interaction_id = "old_id"
+
+        async def on_delta(delta):
+            return False
+
+        result = await self.gi.generate_text("message", on_delta)
+        self.assertEqual("Hel", result)
+        self.assertTrue(stream.closed)
+        self.assertEqual("old_id", self.gi.interaction_id)
+        self.assertEqual(0, len(self.gi.history))
+
+    async def test_stream_is_closed_when_cancelled(self):
+        """読んでいる途中で取り消されても、ストリームを閉じること。"""
+        stream = FakeStream(["Hel", "lo!"])
+        self._set_create_response(stream)
+        received = asyncio.Event()
+
+        async def on_delta(delta):
+            received.set()
+            # 次の差分を待っている間に取り消される
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(self.gi.generate_text("message", on_delta))
+        await received.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertTrue(stream.closed)
+        self.assertEqual(0, len(self.gi.history))
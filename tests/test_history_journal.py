@@ -0,0 +1,118 @@
+import datetime
+import json
+import os
+import pickle
+import tempfile
+import unittest
+
+from history_journal import (
+    JOURNAL_FORMAT,
+    JOURNAL_VERSION,
+    JournalWriter,
+    migrate_pickle,
+    read_journal,
+)
+
+
+class TestHistoryJournal(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "history.jsonl")
+        self.writer = JournalWriter()
+
+    def test_append_and_read(self):
+        """追記したレコードが順番どおりに読み込めること"""
+        self.writer.append(self.path, [("user", "1"), ("model", "a")])
+        self.writer.append(self.path, [("user", "2\n改行"), ("model", "b")])
+        self.writer.flush()
+        self.assertEqual(
+            [("user", "1"), ("model", "a"), ("user", "2\n改行"), ("model", "b")],
+            read_journal(self.path),
+        )
+
+    def test_recovers_from_torn_last_record(self):
+        """末尾のレコードが壊れていても、それより前は読めて追記も続けられること"""
+        self.writer.append(self.path, [("user", "1"), ("model", "a")])
+        self.writer.flush()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write('{"role":"user","te')
+
+        self.assertEqual([("user", "1"), ("model", "a")], read_journal(self.path))
+
+        self.writer.append(self.path, [("user", "2"), ("model", "b")])
+        self.writer.flush()
+        self.assertEqual(
+            [("user", "1"), ("model", "a"), ("user", "2"), ("model", "b")],
+            read_journal(self.path),
+        )
+
+    def test_compact_replaces_file(self):
+        """compact でファイルが指定した履歴だけに置き換わること"""
+        self.writer.append(self.path, [("user", "1"), ("model", "a"), ("user", "2"), ("model", "b")])
+        self.writer.compact(self.path, [("user", "2"), ("model", "b")])
+        self.writer.flush()
+        self.assertEqual([("user", "2"), ("model", "b")], read_journal(self.path))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_remove(self):
+        """remove でファイルが削除されること"""
+        self.writer.append(self.path, [("user", "1"), ("model", "a")])
+        self.writer.remove(self.path)
+        self.writer.flush()
+        self.assertEqual([], read_journal(self.path))
+
+    def test_writes_versioned_header(self):
+        """新しいファイルの1行目に形式と版のヘッダーが書かれること"""
+        self.writer.append(self.path, [("user", "1"), ("model", "a")])
+        self.writer.append(self.path, [("user", "2"), ("model", "b")])
+        self.writer.flush()
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual({"format": JOURNAL_FORMAT, "version": JOURNAL_VERSION}, json.loads(lines[0]))
+        self.assertEqual(5, len(lines))
+
+    def test_reads_only_tail_with_limit(self):
+        """limit を指定すると末尾の limit 件だけを読むこと"""
+        self.writer.append(self.path, [("user", str(i)) for i in range(10)])
+        self.writer.flush()
+        self.assertEqual([("user", "8"), ("user", "9")], read_journal(self.path, 2))
+        self.assertEqual(10, len(read_journal(self.path, 100)))
+
+    def test_upgrades_legacy_file(self):
+        """ヘッダーのない旧形式のファイルも読め、ヘッダー付きに書き直されること"""
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write('{"role":"user","text":"1"}\n{"role":"model","text":"a"}\n')
+        self.assertEqual([("user", "1"), ("model", "a")], read_journal(self.path))
+        with open(self.path, encoding="utf-8") as f:
+            self.assertTrue(f.readline().startswith('{"format"'))
+        self.assertEqual([("user", "1"), ("model", "a")], read_journal(self.path))
+
+    def test_ignores_newer_version(self):
+        """対応していない新しい版のファイルは読まずにそのまま残すこと"""
+        content = '{"format":"%s","version":%d}\n{"x":1}\n' % (JOURNAL_FORMAT, JOURNAL_VERSION + 1)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(content)
+        self.assertEqual([], read_journal(self.path))
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(content, f.read())
+
+    def test_migrates_pickle(self):
+        """旧形式の .pkl を読み込んでジャーナルに書き直し、.pkl は .bak に残すこと"""
+        pickle_path = os.path.join(os.path.dirname(self.path), "history.pkl")
+        with open(pickle_path, "wb") as f:
+            pickle.dump([("user", "1"), ("model", "a")], f)
+
+        migrated = migrate_pickle(pickle_path, self.path, lambda r: {"role": r[0], "text": r[1]})
+        self.assertTrue(migrated)
+        self.assertEqual([("user", "1"), ("model", "a")], read_journal(self.path))
+        self.assertFalse(os.path.exists(pickle_path))
+        self.assertTrue(os.path.exists(pickle_path + ".bak"))
+
+    def test_migrate_pickle_rejects_unknown_classes(self):
+        """許可していないクラスを含む .pkl は読み込まないこと"""
+        pickle_path = os.path.join(os.path.dirname(self.path), "history.pkl")
+        with open(pickle_path, "wb") as f:
+            pickle.dump([("user", datetime.date(2026, 1, 1))], f)
+
+        self.assertFalse(migrate_pickle(pickle_path, self.path, lambda r: {"role": r[0], "text": str(r[1])}))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(pickle_path))
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 指定すると、main を読み込むだけにかかってよい時間 (秒) も確かめる。マシンの速さに左右されるので既定では確かめない
+IMPORT_TIME_BUDGET_ENV = "FUYUKA_IMPORT_TIME_BUDGET"
+# 読み込み時には読み込まず、使うときに読み込むモジュール
+LAZY_MODULES = ("google.genai", "uvicorn")
+
+
+def loaded_modules(module: str) -> set[str]:
+    """新しいプロセスで module を読み込み、読み込まれたモジュールの名前を返す。"""
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print('\\n'.join(sys.modules))"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(result.stdout.splitlines())
+
+
+def measure_import(module: str) -> dict[str, int]:
+    """python -X importtime で module を読み込み、読み込まれたモジュールごとの累積時間 (マイクロ秒) を返す。"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_heavy_modules_are_lazy(self):
+        """main を読み込んだだけでは重いモジュールを読み込まないこと"""
+        modules = loaded_modules("main")
+        self.assertIn("main", modules)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules)
+
+    @unittest.skipUnless(os.environ.get(IMPORT_TIME_BUDGET_ENV), f"{IMPORT_TIME_BUDGET_ENV} is not set")
+    def test_main_import_is_within_budget(self):
+        """main の読み込みが予算内に収まること"""
+        times = measure_import("main")
+        self.assertIn("main", times)
+        self.assertLess(times["main"] / 1_000_000, float(os.environ[IMPORT_TIME_BUDGET_ENV]))
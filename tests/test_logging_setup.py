@@ -0,0 +1,105 @@
+import contextlib
+import gzip
+import io
+import logging
+import os
+import queue
+import tempfile
+import unittest
+
+from logging_setup import (
+    DeferredQueueHandler,
+    create_file_handler,
+    setup_app_logging,
+    shutdown_app_logging,
+)
+
+
+class MutableArg:
+    """文字列にされた回数を数える引数"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return "arg"
+
+
+class TestLoggingSetup(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "app.log")
+        self.root_handlers = logging.getLogger().handlers[:]
+        # run_tests.py で無効化されているログを有効にし、終わったら元に戻す
+        self.addCleanup(logging.disable, logging.root.manager.disable)
+        logging.disable(logging.NOTSET)
+        # 画面に出るログはテストの出力に混ぜずに、メモリに書かせる
+        self.stdout = io.StringIO()
+
+    def tearDown(self):
+        shutdown_app_logging()
+        root_logger = logging.getLogger()
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+            handler.close()
+        for handler in self.root_handlers:
+            root_logger.addHandler(handler)
+
+    def setup_logging(self, log_level_str: str) -> None:
+        with contextlib.redirect_stdout(self.stdout):
+            setup_app_logging(log_level_str, self.path)
+
+    def read_log(self) -> str:
+        with open(self.path, encoding="utf-8") as f:
+            return f.read()
+
+    def test_queue_keeps_force_filter(self):
+        """待ち行列を通しても、しきい値未満は捨て、force 付きは通すこと"""
+        self.setup_logging("WARNING")
+        logger = logging.getLogger("test_logging_setup")
+        logger.info("dropped")
+        logger.info("forced", extra={"force": True})
+        logger.warning("warned %s", "lazily")
+        shutdown_app_logging()
+
+        log = self.read_log()
+        self.assertNotIn("dropped", log)
+        self.assertIn("forced", log)
+        self.assertIn("warned lazily", log)
+        self.assertIn("warned lazily", self.stdout.getvalue())
+
+    def test_filtered_record_is_not_formatted(self):
+        """しきい値未満のログは引数を文字列にしないこと"""
+        self.setup_logging("WARNING")
+        arg = MutableArg()
+        logging.getLogger("test_logging_setup").debug("value: %s", arg)
+        shutdown_app_logging()
+        self.assertEqual(0, arg.count)
+
+    def test_message_is_built_when_queued(self):
+        """待ち行列に積むときに msg % args を組み立て、後から引数を変えても変わらないこと"""
+        handler = DeferredQueueHandler(queue.SimpleQueue())
+        values = ["before"]
+        record = logging.makeLogRecord({"msg": "value: %s", "args": (values,)})
+        handler.handle(record)
+        values[0] = "after"
+
+        queued = handler.queue.get_nowait()
+        self.assertEqual("value: ['before']", queued.getMessage())
+        self.assertIsNone(queued.args)
+        self.assertEqual("value: %s", record.msg)
+
+    def test_rotated_file_is_compressed(self):
+        """サイズでローテートした古いファイルが gzip 圧縮されること"""
+        handler = create_file_handler(self.path, max_bytes=100, backup_count=2, compress=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for i in range(5):
+            handler.emit(logging.makeLogRecord({"msg": f"{i}" * 60}))
+        handler.close()
+        handler.rotator.join()
+
+        with gzip.open(self.path + ".1.gz", "rt", encoding="utf-8") as f:
+            self.assertEqual("3" * 60 + "\n", f.read())
+        self.assertFalse(os.path.exists(self.path + ".1.gz.pending"))
+        self.assertFalse(os.path.exists(self.path + ".3.gz"))
@@ -1,7 +1,35 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
-from unittest.mock import AsyncMock, Mock
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from starlette.requests import Request
 
 import main  # main.pyをインポート
+from api_key_pool import ApiKeyPool
+from genai_interactions import GenAIInteractions
+from ng_word_matcher import NgWordMatcher
+from reply_cache import ReplyCache
+from session_store import MemorySessionStore
+
+
+def make_request(disconnected: bool = False) -> Request:
+    """エンドポイントに渡すリクエスト。disconnected なら、本文を送った後にすぐ切断したことにする"""
+
+    async def receive():
+        if not disconnected:
+            # 返答を待っている間は何も届かない
+            await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    return Request({"type": "http", "method": "POST", "headers": []}, receive)
+
+
+def setUpModule():
+    # 設定ファイルのひな形からアプリを作る (APIキーのクライアントは使うまで作られない)
+    main.create_app()
 
 
 class TestMainLogic(unittest.IsolatedAsyncioTestCase):
@@ -13,9 +41,9 @@ class TestMainLogic(unittest.IsolatedAsyncioTestCase):
             "ありがとう",
         ]
 
-        self.read_ng_words = Mock()
-        main.read_ng_words = self.read_ng_words
-        self.read_ng_words.return_value = ["初コメ"]
+        main.ng_word_matcher = NgWordMatcher.from_words(["初コメ"])
+        main.story_buffer.clear()
+        main.reply_cache = ReplyCache(max_size=0)
 
     async def test_send_message_genai_chat(self):
         json_data = {
@@ -24,13 +52,274 @@ class TestMainLogic(unittest.IsolatedAsyncioTestCase):
         }
         response_text = await main.send_message_genai_chat(json_data)
         self.assertEqual("ありがとう", response_text)
+        # やり直し時はNGワードを指摘した内容で再送されること
+        retry_json = self.genai_chat.send_message_by_json.call_args.args[0]
+        self.assertIn("`初コメ`", retry_json["additionalRequests"][-1])
+
+    async def test_send_message_genai_chat_gives_up_after_max_retries(self):
+        self.genai_chat.send_message_by_json.side_effect = ["初コメ"] * (main.ng_word_max_retries + 1)
+        response_text = await main.send_message_genai_chat({"dateTime": "", "id": "id"})
+        self.assertEqual("", response_text)
+        self.assertEqual(main.ng_word_max_retries + 1, self.genai_chat.send_message_by_json.call_count)
+
+    async def test_send_message_genai_chat_aborts_stream_on_ng_word(self):
+        async def send_message_by_json(json_data, on_delta, deadline=None, accept=None):
+            chunks = ["初", "コメ", "です"] if "additionalRequests" not in json_data else ["ありが", "とう"]
+            text = ""
+            for chunk in chunks:
+                text += chunk
+                if await on_delta(chunk) is False:
+                    break
+            return text
+
+        self.genai_chat.send_message_by_json.side_effect = send_message_by_json
+        manager = AsyncMock()
+        stream = main.DeltaBroadcaster("id", manager)
+        response_text = await main.send_message_genai_chat({"dateTime": "", "id": "id"}, stream)
+        self.assertEqual("ありがとう", response_text)
+        # NGワードが見つかった時点で打ち切られ、残りのチャンクは読まれないこと
+        self.assertEqual(2, self.genai_chat.send_message_by_json.call_count)
+        # 打ち切った返答の表示は破棄させ、NGワードを含む部分はクライアントに送らないこと
+        frames = [call.args[0] for call in manager.broadcast_json.call_args_list]
+        self.assertIn("reset", [frame["type"] for frame in frames])
+        self.assertNotIn("初コメ", "".join(frame.get("delta", "") for frame in frames))
+
+    async def test_send_message_genai_chat_does_not_chain_rejected_reply(self):
+        """ストリーミングしない返答がNGワードを含んでいたら、会話にも履歴にも残さずに作り直すこと"""
+        chat = GenAIInteractions(ApiKeyPool(["key_0"]), store=MemorySessionStore())
+        client = MagicMock()
+        rejected, accepted = MagicMock(id="id1", output_text="初コメです"), MagicMock(id="id2", output_text="ありがとう")
+        client.aio.interactions.create = AsyncMock(side_effect=[rejected, accepted])
+        chat.get_client = MagicMock(return_value=client)
+        main.genai_chat = chat
+
+        response_text = await main.send_message_genai_chat({"dateTime": "", "id": "id", "content": "こんにちは"})
+        self.assertEqual("ありがとう", response_text)
+        # 作り直しは、受け入れなかった返答の interaction に続けない
+        self.assertNotIn("previous_interaction_id", client.aio.interactions.create.call_args_list[1].kwargs)
+        self.assertEqual("id2", chat.interaction_id)
+        self.assertEqual(["user", "model"], [role for role, _ in chat.history])
+        self.assertEqual("ありがとう", chat.history[-1][1])
+
+    async def test_send_message_genai_chat_streams_only_with_consumer(self):
+        """差分を受け取るクライアントがいなければ、ストリーミングせずに呼ぶこと"""
+        self.genai_chat.send_message_by_json.side_effect = ["ありがとう"]
+        await main.send_message_genai_chat({"dateTime": "", "id": "id"})
+        self.assertIsNone(self.genai_chat.send_message_by_json.call_args.args[1])
 
     async def test_chat_endpoint(self):
         json_data = main.ChatModel()
         json_data.noisy=True
         json_data.content="a"
-        await main.chat_endpoint("", json_data)
+        await main.chat_endpoint("", json_data, make_request())
         json_data.content="b"
-        await main.chat_endpoint("", json_data)
+        await main.chat_endpoint("", json_data, make_request())
         json_data.content="c"
-        await main.chat_endpoint("", json_data)
+        await main.chat_endpoint("", json_data, make_request())
+
+    async def test_chat_endpoint_returns_error_code_of_own_request(self):
+        self.genai_chat.send_message_by_json.side_effect = ["こんにちは"]
+        self.genai_chat.last_error_code = None
+        json_data = main.ChatModel()
+        response = await main.chat_endpoint("", json_data, make_request())
+        body = json.loads(response.body)
+        self.assertEqual("こんにちは", body["response"])
+        self.assertIsNone(body["errorCode"])
+
+    async def test_chat_endpoint_gives_up_when_client_disconnects(self):
+        """返答を待つ間にクライアントが切断したら、返答を待たずに 499 を返すこと"""
+        replied = asyncio.Event()
+
+        async def send_message_by_json(*args, **kwargs):
+            await replied.wait()
+            return "こんにちは"
+
+        self.genai_chat.send_message_by_json.side_effect = send_message_by_json
+        self.genai_chat.last_error_code = None
+        try:
+            response = await main.chat_endpoint("", main.ChatModel(), make_request(disconnected=True))
+            self.assertEqual(499, response.status_code)
+        finally:
+            replied.set()
+
+    async def test_reply_genai_chat_attaches_pending_story(self):
+        """要約前の流れは、別に送らず次の返答のリクエストに添えること"""
+        self.genai_chat.send_message_by_json.side_effect = ["こんにちは"]
+        self.genai_chat.last_error_code = None
+        main._flow_story({"displayName": "A", "content": "わこつ"})
+        await main.reply_genai_chat({"dateTime": "", "id": "id", "content": "やあ"})
+
+        self.assertEqual(1, self.genai_chat.send_message_by_json.call_count)
+        sent_json = self.genai_chat.send_message_by_json.call_args.args[0]
+        self.assertEqual({"displayName": "A", "content": "わこつ"}, sent_json["story"])
+        self.assertEqual(0, len(main.story_buffer))
+
+    async def test_reply_genai_chat_sends_fixed_requests_by_key(self):
+        """毎回同じ追加指示はキーで送り、システム指示には一度だけ書くこと"""
+        self.genai_chat.send_message_by_json.side_effect = ["こんにちは"]
+        self.genai_chat.last_error_code = None
+        await main.reply_genai_chat({"dateTime": "", "id": "id", "content": "やあ", "additionalRequests": [main.LENGTH_REQUEST]})
+
+        sent_json = self.genai_chat.send_message_by_json.call_args.args[0]
+        self.assertEqual(["<length>"], sent_json["additionalRequests"])
+        self.assertEqual(1, main.g.BASE_PROMPT.count(main.LENGTH_REQUEST))
+
+    async def test_reply_genai_chat_uses_reply_cache(self):
+        """同じようなコメントにはモデルを呼ばずに以前の返答を使い回すこと"""
+        main.reply_cache = ReplyCache(max_size=16)
+        self.genai_chat.send_message_by_json.side_effect = ["たろうさん、こんにちは！"]
+        self.genai_chat.last_error_code = None
+        await main.reply_genai_chat({"dateTime": "", "id": "a", "nickname": "たろう", "content": "こんにちは"})
+        result = await main.reply_genai_chat({"dateTime": "", "id": "b", "nickname": "はなこ", "content": "こんにちは！"})
+
+        self.assertEqual(("はなこさん、こんにちは！", None), result)
+        self.assertEqual(1, self.genai_chat.send_message_by_json.call_count)
+
+    async def test_reply_genai_chat_does_not_cache_errors(self):
+        """エラーで返した定型文は返答キャッシュに残さないこと"""
+        main.reply_cache = ReplyCache(max_size=16)
+        self.genai_chat.send_message_by_json.side_effect = [main.g.ERROR_MESSAGE, "こんにちは！"]
+        self.genai_chat.last_error_code = 500
+        result = await main.reply_genai_chat({"dateTime": "", "id": "a", "content": "こんにちは"})
+        self.assertEqual(500, result[1])
+
+        self.genai_chat.last_error_code = None
+        result = await main.reply_genai_chat({"dateTime": "", "id": "b", "content": "こんにちは"})
+        self.assertEqual(("こんにちは！", None), result)
+        self.assertEqual(2, self.genai_chat.send_message_by_json.call_count)
+
+    async def test_cache_stats_across_channels(self):
+        """/cache_stats はすべてのチャンネルを合わせた統計と、チャンネルごとの統計を返すこと"""
+        main.reply_cache = ReplyCache(max_size=16)
+        main.reply_cache.hits = 1
+        session = main.get_channel_session("stats")
+        session.reply_cache = ReplyCache(max_size=16)
+        session.reply_cache.misses = 1
+
+        body = json.loads((await main.cache_stats()).body)
+        self.assertEqual(1, body["hits"])
+        self.assertEqual(1, body["misses"])
+        self.assertEqual(0.5, body["hitRate"])
+        self.assertEqual(1, body["channels"]["stats"]["misses"])
+
+        body = json.loads((await main.cache_stats("stats")).body)
+        self.assertEqual(0, body["hits"])
+        with self.assertRaises(main.HTTPException):
+            await main.cache_stats("unknown")
+
+    async def test_reply_genai_chat_batch(self):
+        """まとめた返答をコメントごとに振り分け、返答できなかった分は個別に処理すること"""
+        self.genai_chat.send_message_by_json.side_effect = [
+            '```json\n{"0": "いらっしゃい！", "1": "初コメありがとう"}\n```',
+            "ようこそ！",
+        ]
+        self.genai_chat.last_error_code = None
+        args_list = [
+            ({"dateTime": "", "id": "a", "content": "こんにちは", "additionalRequests": [main.LENGTH_REQUEST]},),
+            ({"dateTime": "", "id": "b", "content": "はじめまして"},),
+        ]
+        requests = main.prompt_compactor.requests
+        results = await main.reply_genai_chat_batch(args_list)
+        self.assertEqual([("いらっしゃい！", None), ("ようこそ！", None)], results)
+        # まとめて送った分はコメントの数によらず 1 件、個別に送り直した分をもう 1 件と数えること
+        self.assertEqual(requests + 2, main.prompt_compactor.requests)
+
+        batch_json = self.genai_chat.send_message_by_json.call_args_list[0].args[0]
+        self.assertEqual(["0", "1"], [c["commentId"] for c in batch_json["comments"]])
+        # コメントごとの定型の追加指示もキーで送り、元のリクエストは変えないこと
+        self.assertEqual(["<length>"], batch_json["comments"][0]["additionalRequests"])
+        self.assertEqual([main.LENGTH_REQUEST], args_list[0][0]["additionalRequests"])
+
+    async def test_metrics_endpoint(self):
+        """/metrics がPrometheusのテキスト形式でNGワードのやり直しなどを返すこと"""
+        await main.send_message_genai_chat({"dateTime": "", "id": "id"})
+        response = await main.metrics()
+        body = response.body.decode()
+        self.assertIn("# TYPE fuyuka_ng_word_regenerations_total counter", body)
+        self.assertIn("fuyuka_reply_seconds_count", body)
+        self.assertIn("fuyuka_request_queue_depth 0", body)
+
+    async def test_channels_are_isolated(self):
+        """チャンネルごとに会話・流れのバッファ・保存先が分かれ、APIキーのプールは共有されること"""
+        session = main.create_channel_session("other")
+        try:
+            default = main.get_session()
+            self.assertIsNot(default.story_buffer, session.story_buffer)
+            self.assertNotEqual(main.GenAIInteractions.FILENAME_CHAT_HISTORY, session.genai_chat.FILENAME_CHAT_HISTORY)
+            self.assertIs(main.api_key_pool, session.genai_chat.key_pool)
+
+            main._flow_story({"displayName": "A", "content": "わこつ"}, session)
+            self.assertEqual(0, len(default.story_buffer))
+            self.assertEqual(1, len(session.story_buffer))
+        finally:
+            await session.aclose()
+
+    async def test_reopened_channel_waits_for_previous_flush(self):
+        """閉じている途中のチャンネルを作り直したら、前の書き出しを待ってから履歴をスレッドで読むこと"""
+        registry = main.channel_registry
+        flushed = asyncio.Event()
+        registry.closing_tasks["reopened"] = asyncio.create_task(flushed.wait())
+        registry.evicted.add("reopened")
+        self.addCleanup(registry.evicted.discard, "reopened")
+        with patch.object(main.GenAIInteractions, "load_chat_history", return_value=True) as load_chat_history:
+            session = main.create_channel_session("reopened")
+            try:
+                await asyncio.sleep(0)
+                self.assertFalse(session.ready.is_set())
+                load_chat_history.assert_not_called()
+
+                flushed.set()
+                await asyncio.wait_for(session.ready.wait(), 1)
+                load_chat_history.assert_called_once()
+            finally:
+                await session.aclose()
+
+    async def test_sqlite_store_relays_only_with_workers(self):
+        """WebSocket へ送るメッセージは、複数のワーカーで store を共有するときだけ中継すること"""
+        path = os.path.join(tempfile.mkdtemp(), "sessions.sqlite3")
+        for workers, relays in ((1, False), (2, True)):
+            with patch.dict(main.g.config["fuyukaApi"], sessionStore="sqlite", sessionStorePath=path, workers=workers):
+                store = main.create_session_store()
+            try:
+                self.assertEqual(relays, store.relays_messages)
+            finally:
+                store.close()
+
+    async def test_get_priority(self):
+        """初見さんと返答が必要なコメントを優先し、いつものコメントだけ待たせすぎたら捨てること"""
+        self.assertEqual(main.PRIORITY_NEEDS_RESPONSE, main.get_priority({"isFirst": True}))
+        self.assertEqual(main.PRIORITY_NEEDS_RESPONSE, main.get_priority({"needsResponse": True}))
+        self.assertEqual(main.PRIORITY_STREAM_FIRST, main.get_priority({"isFirstOnStream": True}))
+        self.assertEqual(main.PRIORITY_REGULAR, main.get_priority({}))
+        self.assertIsNone(main.get_max_wait(main.PRIORITY_NEEDS_RESPONSE))
+
+    async def test_restore_history_gates_replies(self):
+        """履歴の復元が終わるまで返答を待たせ、終わったら処理すること"""
+        original = main.history_restored
+        main.history_restored = asyncio.Event()
+        self.addCleanup(setattr, main, "history_restored", original)
+        self.genai_chat.load_chat_history = MagicMock(return_value=False)
+        self.genai_chat.last_error_code = None
+        self.genai_chat.send_message_by_json.side_effect = None
+        self.genai_chat.send_message_by_json.return_value = "こんにちは"
+
+        reply = asyncio.create_task(main.reply_genai_chat({"dateTime": "", "id": "id", "content": "a"}))
+        await asyncio.sleep(0)
+        self.assertFalse(reply.done())
+        self.genai_chat.send_message_by_json.assert_not_called()
+
+        await main.restore_history()
+        self.assertEqual(("こんにちは", None), await reply)
+        self.genai_chat.load_chat_history.assert_called_once()
+
+    async def test_create_app_uses_injected_backends(self):
+        """渡した store・APIキーのプール・会話を、設定から作る代わりに使うこと"""
+        store = MemorySessionStore()
+        key_pool = ApiKeyPool([])
+        app = main.create_app(store=store, key_pool=key_pool, chat=self.genai_chat, restore=True)
+        self.addCleanup(main.create_app)
+        self.assertIs(store, main.session_store)
+        self.assertIs(key_pool, main.api_key_pool)
+        self.assertIs(self.genai_chat, main.genai_chat)
+        self.assertFalse(main.history_restored.is_set())
+        self.assertIn("/chat/{id}", app.openapi()["paths"])
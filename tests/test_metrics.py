@@ -0,0 +1,43 @@
+import unittest
+
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_with_labels(self):
+        """ラベルの値ごとに数え、テキスト形式で出力すること"""
+        counter = Counter("requests_total", "Requests.", ("code",), registry=self.registry)
+        counter.inc("200")
+        counter.inc("200")
+        counter.inc("429", amount=3)
+        text = self.registry.render()
+        self.assertIn("# TYPE requests_total counter", text)
+        self.assertIn('requests_total{code="200"} 2', text)
+        self.assertIn('requests_total{code="429"} 3', text)
+
+    def test_gauge_function(self):
+        """関数を登録したゲージは出力するときに値を求めること"""
+        depth = [1]
+        Gauge("queue_depth", "Depth.", registry=self.registry).set_function(lambda: depth[0])
+        depth[0] = 5
+        self.assertIn("queue_depth 5", self.registry.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        """バケットは累積で、+Inf と合計・件数も出力すること"""
+        histogram = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        text = self.registry.render()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("latency_seconds_sum 2.65", text)
+        self.assertIn("latency_seconds_count 4", text)
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("errors_total", "Errors.", ("message",), registry=self.registry)
+        counter.inc('a "b"\n')
+        self.assertIn('errors_total{message="a \\"b\\"\\n"} 1', self.registry.render())
@@ -0,0 +1,79 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ng_word_matcher import NgWordMatcher
+
+
+class TestNgWordMatcher(unittest.TestCase):
+    def test_find_words_ignore_case(self):
+        """大文字小文字を区別せずにマッチすること"""
+        matcher = NgWordMatcher.from_words(["thinking"])
+        self.assertEqual(["Thinking"], matcher.find_words("Thinking..."))
+
+    def test_find_all_words(self):
+        """複数のNGワードを重複なしで出現順に返すこと"""
+        matcher = NgWordMatcher.from_words(["考え中", "初コメ"])
+        text = "初コメありがとう！考え中…初コメ"
+        self.assertEqual(["初コメ", "考え中"], matcher.find_words(text))
+
+    def test_find_matches_positions(self):
+        """マッチ位置を返すこと"""
+        matcher = NgWordMatcher.from_words(["初見さん"])
+        self.assertEqual([(3, 7, "初見さん")], matcher.find_matches("いらっ初見さん"))
+
+    def test_longest_word_first(self):
+        """短い語より長い語が優先してマッチすること"""
+        matcher = NgWordMatcher.from_words(["初コメ", "初コメント"])
+        self.assertEqual(["初コメント"], matcher.find_words("初コメントです"))
+
+    def test_words_are_escaped(self):
+        """正規表現の特殊文字がそのままの文字として扱われること"""
+        matcher = NgWordMatcher.from_words(["a.b", "(笑)"])
+        self.assertEqual([], matcher.find_words("axb 笑"))
+        self.assertEqual(["a.b", "(笑)"], matcher.find_words("a.b (笑)"))
+
+    def test_scanner_finds_word_across_chunks(self):
+        """チャンクの境目をまたぐNGワードを見つけ、NGワードの一部を先に返さないこと"""
+        scanner = NgWordMatcher.from_words(["初コメ", "考え中"]).scanner()
+        released = scanner.feed("ようこそ初")
+        # 最長のNGワードより1文字短い分は保留される
+        self.assertEqual("ようこ", released)
+        self.assertEqual("", scanner.feed("コメさん"))
+        self.assertEqual(["初コメ"], scanner.matched_words)
+
+    def test_scanner_releases_all_text_without_words(self):
+        """NGワードがなければ、保留分も含めてテキストをすべて返すこと"""
+        scanner = NgWordMatcher.from_words(["初コメ"]).scanner()
+        chunks = ["こんに", "ちは", "！"]
+        released = "".join(scanner.feed(c) for c in chunks) + scanner.finish()
+        self.assertEqual("こんにちは！", released)
+        self.assertEqual([], scanner.matched_words)
+
+    def test_empty_words(self):
+        """NGワードが空の場合は何もマッチしないこと"""
+        matcher = NgWordMatcher.from_words(["", ""])
+        self.assertEqual([], matcher.find_words("なんでも"))
+
+    def test_reload_only_when_modified(self):
+        """ファイルが更新された時だけ読み直すこと"""
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "ng_words.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(["初コメ"], f)
+
+        matcher = NgWordMatcher(path)
+        self.assertTrue(matcher.reload_if_modified())
+        self.assertFalse(matcher.reload_if_modified())
+        self.assertEqual(["初コメ"], matcher.find_words("初コメです"))
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(["考え中"], f)
+        # mtime を確実に進める
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+        self.assertTrue(matcher.reload_if_modified())
+        self.assertEqual([], matcher.find_words("初コメです"))
+        self.assertEqual(["考え中"], matcher.find_words("考え中です"))
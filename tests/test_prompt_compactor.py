@@ -0,0 +1,45 @@
+import unittest
+
+from prompt_compactor import PromptCompactor
+
+
+class TestPromptCompactor(unittest.TestCase):
+    def setUp(self):
+        self.compactor = PromptCompactor({"length": "30文字以内にまとめてください", "empty": "  "})
+
+    def test_system_instruction_lists_instructions_once(self):
+        """定型の指示をキーと一緒にシステム指示へ書き足し、空の指示は載せないこと"""
+        instruction = self.compactor.system_instruction("base")
+        self.assertTrue(instruction.startswith("base\n"))
+        self.assertIn("## <length>\n30文字以内にまとめてください", instruction)
+        self.assertNotIn("<empty>", instruction)
+
+    def test_compact_replaces_fixed_requests_with_keys(self):
+        """定型の指示だけをキーに置き換え、空の指示を除き、減ったバイト数を返すこと"""
+        json_data = {"additionalRequests": ["30文字以内にまとめてください", "", "返答にNGを含めないでください。"]}
+        saved = self.compactor.compact(json_data)
+        self.assertEqual(["<length>", "返答にNGを含めないでください。"], json_data["additionalRequests"])
+        self.assertGreater(saved, 0)
+        # 置き換えただけでは統計に数えない
+        self.assertEqual(0, self.compactor.get_stats()["requests"])
+
+    def test_record_counts_messages_and_net_savings(self):
+        """送るメッセージごとに一度だけ数え、システム指示で増えた分を引いて報告すること"""
+        base = "base"
+        instruction_bytes = len(self.compactor.system_instruction(base).encode("utf-8")) - len(base)
+        saved = sum(self.compactor.compact({"additionalRequests": ["30文字以内にまとめてください"]}) for _ in range(3))
+        self.compactor.record(saved)
+        stats = self.compactor.get_stats()
+        self.assertEqual(1, stats["requests"])
+        self.assertEqual(instruction_bytes, stats["instructionBytes"])
+        self.assertEqual(saved, stats["savedBytes"])
+        self.assertEqual(saved - instruction_bytes, stats["netSavedBytes"])
+        self.assertEqual(saved - instruction_bytes, stats["netSavedBytesPerRequest"])
+
+    def test_disabled_compactor_keeps_requests(self):
+        """無効なら指示をそのまま送ること"""
+        compactor = PromptCompactor({"length": "30文字以内にまとめてください"}, enabled=False)
+        json_data = {"additionalRequests": ["30文字以内にまとめてください"]}
+        self.assertEqual(0, compactor.compact(json_data))
+        self.assertEqual(["30文字以内にまとめてください"], json_data["additionalRequests"])
+        self.assertEqual("base", compactor.system_instruction("base"))
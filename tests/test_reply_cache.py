@@ -0,0 +1,61 @@
+import unittest
+from unittest.mock import patch
+
+from reply_cache import ReplyCache, normalize_content
+
+
+class TestNormalizeContent(unittest.TestCase):
+    def test_absorbs_variations(self):
+        """全角半角・記号・空白・同じ文字の連続の違いを吸収すること"""
+        self.assertEqual(normalize_content("こんにちは"), normalize_content("こんにちは！ "))
+        self.assertEqual(normalize_content("888"), normalize_content("８８８８８"))
+        self.assertEqual(normalize_content("hello"), normalize_content("HELLO!!"))
+        self.assertNotEqual(normalize_content("草"), normalize_content("草草草"))
+
+
+class TestReplyCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ReplyCache(max_size=2, ttl=60, max_content_length=10)
+
+    def test_hit_replaces_nickname(self):
+        """呼び名をテンプレート化し、取り出すときに相手の呼び名へ差し替えること"""
+        key = self.cache.make_key("こんにちは", "regular", [])
+        self.cache.put(key, "たろうさん、こんにちは！", nickname="たろう")
+        key = self.cache.make_key("こんにちは！", "regular", [])
+        self.assertEqual("はなこさん、こんにちは！", self.cache.get(key, nickname="はなこ"))
+        self.assertEqual(1, self.cache.get_stats()["hits"])
+
+    def test_key_depends_on_viewer_status_and_requests(self):
+        """viewerStatus や追加リクエストが違えば別のキーになること"""
+        key = self.cache.make_key("こんにちは", "regular", [])
+        self.cache.put(key, "こんにちは！")
+        self.assertIsNone(self.cache.get(self.cache.make_key("こんにちは", "newViewer", [])))
+        self.assertIsNone(self.cache.get(self.cache.make_key("こんにちは", "regular", ["短く"])))
+
+    def test_long_content_is_not_cached(self):
+        """長いコメントはキャッシュの対象外であること"""
+        self.assertIsNone(self.cache.make_key("今日の配信は何時までやりますか", "regular", []))
+
+    def test_disabled_by_default_size(self):
+        """サイズが0なら無効であること"""
+        self.assertIsNone(ReplyCache(max_size=0).make_key("草", "regular", []))
+
+    def test_lru_eviction(self):
+        """上限を超えたら最も使われていないものから追い出すこと"""
+        keys = [self.cache.make_key(c, "regular", []) for c in ("a", "b", "c")]
+        self.cache.put(keys[0], "A")
+        self.cache.put(keys[1], "B")
+        self.cache.get(keys[0])
+        self.cache.put(keys[2], "C")
+        self.assertEqual("A", self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_ttl_expiry(self):
+        """TTLを過ぎたら使い回さないこと"""
+        key = self.cache.make_key("草", "regular", [])
+        with patch("reply_cache.time.monotonic", return_value=100.0):
+            self.cache.put(key, "www")
+        with patch("reply_cache.time.monotonic", return_value=161.0):
+            self.assertIsNone(self.cache.get(key))
+        self.assertEqual(1, self.cache.expired)
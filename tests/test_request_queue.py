@@ -0,0 +1,228 @@
+import asyncio
+import unittest
+from contextlib import asynccontextmanager
+
+from request_queue import RequestDroppedError, RequestQueue, RequestQueueFullError
+
+
+class TestRequestQueue(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await self.queue.stop()
+
+    async def test_runs_requests_in_order_one_at_a_time(self):
+        """リクエストが到着順に1件ずつ処理されること"""
+        self.queue = RequestQueue(8)
+        events = []
+
+        async def job(name):
+            events.append(f"start {name}")
+            await asyncio.sleep(0)
+            events.append(f"end {name}")
+            return name
+
+        results = await asyncio.gather(*(self.queue.submit(job, n) for n in ["a", "b", "c"]))
+        self.assertEqual(["a", "b", "c"], results)
+        self.assertEqual(
+            ["start a", "end a", "start b", "end b", "start c", "end c"], events
+        )
+
+    async def test_rejects_when_full(self):
+        """待ち行列が満杯なら即座に RequestQueueFullError になること"""
+        self.queue = RequestQueue(1)
+        release = asyncio.Event()
+
+        async def job():
+            await release.wait()
+            return True
+
+        first = self.queue.submit_nowait(job)
+        await asyncio.sleep(0)  # 1件目を処理中にする
+        second = self.queue.submit_nowait(job)
+        with self.assertRaises(RequestQueueFullError):
+            self.queue.submit_nowait(job)
+
+        release.set()
+        self.assertTrue(await first)
+        self.assertTrue(await second)
+
+    async def test_exception_reaches_caller(self):
+        """例外は呼び出し元にだけ伝わり、後続は処理されること"""
+        self.queue = RequestQueue(8)
+
+        async def fail():
+            raise ValueError("boom")
+
+        async def ok():
+            return "ok"
+
+        failed = self.queue.submit_nowait(fail)
+        succeeded = self.queue.submit_nowait(ok)
+        with self.assertRaises(ValueError):
+            await failed
+        self.assertEqual("ok", await succeeded)
+
+    async def test_batches_when_backed_up(self):
+        """batch_threshold を超えて待っている場合、まとめて1回で処理されること"""
+        self.queue = RequestQueue(8, batch_threshold=2, batch_max_size=10)
+        release = asyncio.Event()
+        batches = []
+
+        async def block():
+            await release.wait()
+
+        async def job(name):
+            return f"single {name}"
+
+        async def batch_job(args_list):
+            batches.append([args[0] for args in args_list])
+            return [f"batch {args[0]}" for args in args_list]
+
+        blocker = self.queue.submit_nowait(block)
+        await asyncio.sleep(0)  # 先頭のリクエストを処理中にする
+        futures = [self.queue.submit_nowait(job, n, batch_func=batch_job) for n in "abc"]
+        release.set()
+        await blocker
+
+        self.assertEqual(["batch a", "batch b", "batch c"], await asyncio.gather(*futures))
+        self.assertEqual([["a", "b", "c"]], batches)
+
+    async def test_no_batch_under_threshold(self):
+        """待ちが batch_threshold 以下なら個別に処理されること"""
+        self.queue = RequestQueue(8, batch_threshold=2, batch_max_size=10)
+
+        async def job(name):
+            return f"single {name}"
+
+        async def batch_job(args_list):
+            return [f"batch {args[0]}" for args in args_list]
+
+        futures = [self.queue.submit_nowait(job, n, batch_func=batch_job) for n in "ab"]
+        self.assertEqual(["single a", "single b"], await asyncio.gather(*futures))
+
+    async def test_runs_job_inside_lock(self):
+        """lock を指定すると、各リクエストをその中で処理すること"""
+        events = []
+
+        @asynccontextmanager
+        async def lock():
+            events.append("lock")
+            yield
+            events.append("unlock")
+
+        self.queue = RequestQueue(8, lock=lock)
+
+        async def job(name):
+            events.append(name)
+            return name
+
+        self.assertEqual("a", await self.queue.submit(job, "a"))
+        self.assertEqual(["lock", "a", "unlock"], events)
+
+    async def test_lock_failure_reaches_caller(self):
+        """ロックを取れなければその例外を呼び出し元に返し、次のリクエストは処理を続けること"""
+        failures = [RuntimeError("database is locked")]
+
+        @asynccontextmanager
+        async def lock():
+            if failures:
+                raise failures.pop()
+            yield
+
+        self.queue = RequestQueue(8, lock=lock)
+
+        async def job(name):
+            return name
+
+        with self.assertRaises(RuntimeError):
+            await asyncio.wait_for(self.queue.submit(job, "a"), 1)
+        self.assertEqual("b", await asyncio.wait_for(self.queue.submit(job, "b"), 1))
+
+    async def test_runs_higher_priority_first(self):
+        """priority の大きいリクエストが先に、同じ priority の中では到着順に処理されること"""
+        self.queue = RequestQueue(8)
+        release = asyncio.Event()
+        events = []
+
+        async def block():
+            await release.wait()
+
+        async def job(name):
+            events.append(name)
+
+        blocker = self.queue.submit_nowait(block)
+        await asyncio.sleep(0)  # 先頭のリクエストを処理中にする
+        futures = [
+            self.queue.submit_nowait(job, "a"),
+            self.queue.submit_nowait(job, "b", priority=2),
+            self.queue.submit_nowait(job, "c", priority=1),
+            self.queue.submit_nowait(job, "d", priority=2),
+        ]
+        release.set()
+        await asyncio.gather(blocker, *futures)
+        self.assertEqual(["b", "d", "c", "a"], events)
+
+    async def test_evicts_lower_priority_when_full(self):
+        """満杯でも priority の大きいリクエストは、小さいものと入れ替わること"""
+        self.queue = RequestQueue(1)
+        release = asyncio.Event()
+
+        async def job(name):
+            await release.wait()
+            return name
+
+        first = self.queue.submit_nowait(job, "first")
+        await asyncio.sleep(0)  # 1件目を処理中にする
+        regular = self.queue.submit_nowait(job, "regular")
+        with self.assertRaises(RequestQueueFullError):
+            self.queue.submit_nowait(job, "another")
+        urgent = self.queue.submit_nowait(job, "urgent", priority=1)
+        release.set()
+
+        self.assertEqual(["first", "urgent"], await asyncio.gather(first, urgent))
+        with self.assertRaises(RequestDroppedError):
+            await regular
+        self.assertEqual(1, self.queue.evicted)
+
+    async def test_drops_expired_request(self):
+        """max_wait のうちに処理を始められなかったリクエストは捨てられること"""
+        self.queue = RequestQueue(8)
+        release = asyncio.Event()
+
+        async def block():
+            await release.wait()
+
+        async def job(name):
+            return name
+
+        blocker = self.queue.submit_nowait(block)
+        await asyncio.sleep(0)  # 先頭のリクエストを処理中にする
+        stale = self.queue.submit_nowait(job, "stale", max_wait=0.01)
+        fresh = self.queue.submit_nowait(job, "fresh")
+        await asyncio.sleep(0.02)
+        release.set()
+
+        await blocker
+        self.assertEqual("fresh", await fresh)
+        with self.assertRaises(RequestDroppedError):
+            await stale
+        self.assertEqual(1, self.queue.expired)
+
+    async def test_cancels_job_when_caller_gives_up(self):
+        """処理中のリクエストを待つ呼び出し元がいなくなったら、処理も取り消されること"""
+        self.queue = RequestQueue(8)
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def job():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        future = self.queue.submit_nowait(job)
+        await started.wait()
+        future.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        self.assertEqual("next", await self.queue.submit(asyncio.sleep, 0, "next"))
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from session_store import MemorySessionStore, SessionStore, SqliteSessionStore
+
+
+class SessionStoreTests:
+    """MemorySessionStore と SqliteSessionStore に共通のテスト。"""
+
+    def create_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_version_increases_on_write(self):
+        """書き換えるたびに version が増えること"""
+        self.assertEqual(0, self.store.get_version("a"))
+        v1 = self.store.save_api_key_index("a", 2)
+        v2 = self.store.save_interaction_id("a", "id_1")
+        self.assertLess(v1, v2)
+        self.assertEqual(v2, self.store.get_version("a"))
+        self.assertEqual(0, self.store.get_version("b"))
+
+    def test_save_history_keeps_newest(self):
+        """履歴を追記し、新しいほうから keep 件だけ残すこと"""
+        self.store.save_history("a", "id_1", [("user", "1"), ("model", "2")], keep=3)
+        self.store.save_history("a", "id_2", [("user", "3"), ("model", "4")], keep=3)
+        state = self.store.load("a")
+        self.assertEqual("id_2", state.interaction_id)
+        self.assertEqual([("model", "2"), ("user", "3"), ("model", "4")], state.history)
+
+    def test_clear(self):
+        """interaction_id と履歴を消し、APIキーの番号は残すこと"""
+        self.store.save_api_key_index("a", 1)
+        self.store.save_history("a", "id_1", [("user", "1")], keep=10)
+        self.store.clear("a")
+        state = self.store.load("a")
+        self.assertIsNone(state.interaction_id)
+        self.assertEqual([], state.history)
+        self.assertEqual(1, state.api_key_index)
+
+    def test_take_story(self):
+        """ためたコメントを古い順に取り出し、空になること"""
+        self.store.append_story("a", "A", "こんにちは")
+        self.store.append_story("a", "B", "わこつ")
+        self.store.append_story("b", "C", "888")
+        self.assertEqual([("A", "こんにちは"), ("B", "わこつ")], self.store.take_story("a"))
+        self.assertEqual([], self.store.take_story("a"))
+        self.assertEqual([("C", "888")], self.store.take_story("b"))
+
+    def test_key_health(self):
+        """APIキーの休止期限を保存して読み込めること"""
+        self.store.save_key_health(1, 100.0, 50.0)
+        self.assertEqual({1: (100.0, 50.0)}, self.store.load_key_health())
+
+    def test_lock_serializes_jobs(self):
+        """同じチャンネルの処理は lock で1件ずつになること"""
+        events = []
+
+        async def job(name):
+            async with self.store.lock("a"):
+                events.append(f"start {name}")
+                await asyncio.sleep(0.01)
+                events.append(f"end {name}")
+
+        async def run():
+            await asyncio.gather(job(1), job(2))
+
+        asyncio.run(run())
+        self.assertEqual(["start 1", "end 1", "start 2", "end 2"], events)
+
+
+class TestMemorySessionStore(SessionStoreTests, unittest.TestCase):
+    def create_store(self):
+        return MemorySessionStore()
+
+
+class TestSqliteSessionStore(SessionStoreTests, unittest.TestCase):
+    def create_store(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "sessions.sqlite3")
+        return SqliteSessionStore(self.path, poll_interval=0.001)
+
+    def test_shared_between_connections(self):
+        """同じファイルを開いた別の接続 (別のプロセス) から状態が見えること"""
+        other = SqliteSessionStore(self.path)
+        try:
+            self.store.save_history("a", "id_1", [("user", "1")], keep=10)
+            self.assertEqual(self.store.get_version("a"), other.get_version("a"))
+            self.assertEqual("id_1", other.load("a").interaction_id)
+        finally:
+            other.close()
+
+    def test_lease_excludes_other_owner(self):
+        """ほかの持ち主のリースは期限まで取れず、期限が切れたら取れること"""
+        other = SqliteSessionStore(self.path, lease_seconds=0.05)
+        try:
+            self.assertTrue(other.try_acquire_lease("a"))
+            self.assertFalse(self.store.try_acquire_lease("a"))
+            self.assertTrue(self.store.try_acquire_lease("b"))
+            # 持ち主が落ちてリースが残っても、期限が切れれば取れる
+            asyncio.run(asyncio.sleep(0.06))
+            self.assertTrue(self.store.try_acquire_lease("a"))
+            self.store.release_lease("a")
+            self.store.flush()
+            self.assertTrue(other.try_acquire_lease("a"))
+        finally:
+            other.close()
+
+    def test_lease_renewed_while_locked(self):
+        """lock の間は期限を延ばし続け、lease_seconds を過ぎてもほかの持ち主に取られないこと"""
+        store = SqliteSessionStore(self.path, lease_seconds=0.06, poll_interval=0.001)
+        other = SqliteSessionStore(self.path)
+        try:
+            async def run():
+                async with store.lock("a"):
+                    await asyncio.sleep(0.15)
+                    return other.try_acquire_lease("a")
+
+            self.assertFalse(asyncio.run(run()))
+            store.flush()
+            self.assertTrue(other.try_acquire_lease("a"))
+        finally:
+            store.close()
+            other.close()
+
+    def test_run_calls_in_another_thread(self):
+        """run はイベントループのスレッドとは別のスレッドで呼ぶこと"""
+        thread = asyncio.run(self.store.run(threading.current_thread))
+        self.assertIsNot(threading.current_thread(), thread)
+
+    def test_key_health_from_other_connection(self):
+        """ほかの接続が書いた休止期限は、書き込み用のスレッドで読み込んだ後に見えること"""
+        other = SqliteSessionStore(self.path)
+        try:
+            other.save_key_health(2, 300.0, 0.0)
+            other.flush()
+            self.store.load_key_health()
+            self.store.flush()
+            self.assertEqual({2: (300.0, 0.0)}, self.store.load_key_health())
+        finally:
+            other.close()
+
+
+    def test_relays_messages_to_other_connection(self):
+        """publish したメッセージはほかの接続からだけ、古い順に読めること"""
+        other = SqliteSessionStore(self.path)
+        try:
+            after_id = other.latest_message_id()
+            self.store.publish("a", "1")
+            self.store.publish("b", "2")
+            other.publish("a", "mine")
+            self.store.flush()
+            other.flush()
+            messages = other.poll_messages(after_id)
+            self.assertEqual([("a", "1"), ("b", "2")], [(channel, message) for _, channel, message in messages])
+            self.assertEqual([], other.poll_messages(messages[-1][0]))
+            self.assertEqual(["mine"], [message for _, _, message in self.store.poll_messages(after_id)])
+        finally:
+            other.close()
+
+class TestSessionStoreBase(unittest.TestCase):
+    def test_is_abstract(self):
+        """SessionStore はそのままでは作れないこと"""
+        with self.assertRaises(TypeError):
+            SessionStore()
@@ -0,0 +1,37 @@
+import unittest
+
+from startup_helper import (
+    STARTUP_CONTINUE,
+    STARTUP_FRESH,
+    STARTUP_MODE_ENV,
+    PhaseTimer,
+    parse_startup_mode,
+)
+
+
+class TestStartupHelper(unittest.TestCase):
+    def test_parse_startup_mode_from_argv(self):
+        """--continue / --fresh で起動のしかたが決まり、知らない引数は無視されること"""
+        self.assertEqual(STARTUP_CONTINUE, parse_startup_mode(["--continue"], {}))
+        self.assertEqual(STARTUP_FRESH, parse_startup_mode(["--other", "--fresh"], {}))
+
+    def test_parse_startup_mode_from_environ(self):
+        """引数がなければ環境変数を見て、引数を優先すること"""
+        self.assertEqual(STARTUP_CONTINUE, parse_startup_mode([], {STARTUP_MODE_ENV: "Continue"}))
+        self.assertEqual(STARTUP_CONTINUE, parse_startup_mode(["--continue"], {STARTUP_MODE_ENV: "fresh"}))
+        self.assertIsNone(parse_startup_mode([], {STARTUP_MODE_ENV: "maybe"}))
+        self.assertIsNone(parse_startup_mode([], {}))
+
+    def test_phase_timer(self):
+        """段階ごとの経過時間を記録し、合計とあわせて表示できること"""
+        timer = PhaseTimer()
+        timer.mark("config")
+        timer.mark("server")
+        self.assertEqual(["config", "server"], [name for name, _ in timer.phases])
+        self.assertAlmostEqual(timer.total(), sum(elapsed for _, elapsed in timer.phases))
+        self.assertIn("config", timer.format())
+        self.assertIn("total", timer.format())
+
+
+if __name__ == "__main__":
+    unittest.main()
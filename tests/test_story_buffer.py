@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from session_store import MemorySessionStore
+from story_buffer import StoryBuffer
+
+
+class TestStoryBuffer(unittest.TestCase):
+    def test_take_joins_comments(self):
+        """ためたコメントを最後の発言者と一緒に取り出し、空になること"""
+        buffer = StoryBuffer()
+        buffer.append("A", "こんにちは")
+        buffer.append("B", "わこつ")
+        self.assertEqual(("B", "こんにちは わこつ"), buffer.take())
+        self.assertIsNone(buffer.take())
+
+    def test_take_from_shared_store(self):
+        """store を共有するほかのバッファが受けたコメントもまとめて取り出すこと"""
+        store = MemorySessionStore()
+        buffer = StoryBuffer(store=store)
+        other = StoryBuffer(store=store)
+        buffer.append("A", "こんにちは")
+        other.append("B", "わこつ")
+        self.assertEqual(("B", "こんにちは わこつ"), buffer.take())
+        self.assertIsNone(other.take())
+
+    def test_atake_from_shared_store(self):
+        """atake でも store からまとめて取り出すこと"""
+        store = MemorySessionStore()
+        buffer = StoryBuffer(store=store)
+        StoryBuffer(store=store).append("B", "わこつ")
+        buffer.append("A", "こんにちは")
+        self.assertEqual(("A", "わこつ こんにちは"), asyncio.run(buffer.atake()))
+        self.assertIsNone(asyncio.run(buffer.atake()))
+
+    def test_drops_oldest_over_max_chars(self):
+        """上限を超えたら古いコメントから捨てること"""
+        buffer = StoryBuffer(flush_chars=100, max_chars=8)
+        for content in ["111", "222", "333"]:
+            buffer.append("A", content)
+        self.assertEqual(("A", "222 333"), buffer.take())
+        self.assertEqual(1, buffer.dropped)
+
+    def test_due_by_chars(self):
+        """文字数がしきい値に達したら要約のタイミングになること"""
+        buffer = StoryBuffer(flush_chars=5, flush_seconds=0)
+        buffer.append("A", "abc")
+        self.assertFalse(buffer.is_due())
+        buffer.append("A", "d")
+        self.assertTrue(buffer.is_due())
+
+    def test_due_by_time(self):
+        """最初のコメントから一定時間たったら要約のタイミングになること"""
+        buffer = StoryBuffer(flush_seconds=10)
+        with patch("story_buffer.time.monotonic", return_value=100.0):
+            buffer.append("A", "abc")
+        with patch("story_buffer.time.monotonic", return_value=105.0):
+            self.assertFalse(buffer.is_due())
+        with patch("story_buffer.time.monotonic", return_value=110.0):
+            self.assertTrue(buffer.is_due())
+
+
+class TestStoryBufferWait(unittest.IsolatedAsyncioTestCase):
+    async def test_wait_due_wakes_on_append(self):
+        """待機中にしきい値を超えるコメントが届いたら待ちが終わること"""
+        buffer = StoryBuffer(flush_chars=5, flush_seconds=0)
+        waiter = asyncio.create_task(buffer.wait_due())
+        await asyncio.sleep(0)
+        buffer.append("A", "ab")
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        buffer.append("A", "cd")
+        await asyncio.wait_for(waiter, 1)
@@ -45,3 +45,18 @@ class TestTextCleaner(unittest.TestCase):
         input_text = 'a<img alt=\'b\' src="x">c<img alt="d" src="y">e'
         expected_output = "a b c d e"
         self.assertEqual(clean_and_extract_alt(input_text), expected_output)
+
+    def test_entities_are_unescaped(self):
+        # 8. 文字参照を元の文字に戻し、タグとしては扱わないテスト
+        input_text = "<b>A&amp;B</b> &lt;i&gt;そのまま&lt;/i&gt;"
+        expected_output = "A&B <i>そのまま</i>"
+        self.assertEqual(clean_and_extract_alt(input_text), expected_output)
+
+    def test_emoji_img_runs(self):
+        # 9. YouTubeやわんコメの絵文字imgが連続するテスト
+        input_text = (
+            '草<img class="emoji" src="https://yt3.ggpht.com/a" alt=":face-blue-smiling:" shared-tooltip-text=":face-blue-smiling:">'
+            '<img src="/emoji/1f44f.svg" alt=👏 class=emoji/><img data-alt="x" src="y">'
+        )
+        expected_output = "草 :face-blue-smiling: 👏"
+        self.assertEqual(clean_and_extract_alt(input_text), expected_output)